@@ -20,11 +20,24 @@ GEONIS-specific module to handle or parse Esri geometries.
 
 import json as _json
 import math as _math
+import multiprocessing as _mp
+import os as _os
+import sys as _sys
+from collections import deque as _deque
+from itertools import chain as _chain
+from itertools import islice as _islice
+from itertools import izip as _izip
 from xml.etree import cElementTree as _Xml
 
 import gpf.common.iterutils as _iter
 import gpf.common.validate as _vld
 
+try:
+    import numpy as _np
+except ImportError:
+    # NumPy is optional: ring orientations are calculated in pure Python without it
+    _np = None
+
 _JSON_NAN = 'NaN'
 _JSON_PATHS = 'paths'
 _JSON_CURVEPATHS = 'curvePaths'
@@ -76,23 +89,23 @@ _ESRI_ENUM_EARC = 16
 # Use fairly accurate tolerance, so we don't screw up the arcs (midpoints)
 XY_TOLERANCE = 1e-09
 
+# Default number of geometries per chunk for serialize_many()
+_CHUNK_SIZE = 1000
 
-class GeometrySerializationError(ValueError):
-    pass
+# Minimum number of ring vertices for which the vectorized (NumPy) Shoelace formula is used.
+# For smaller rings, the conversion to an array takes more time than the pure Python calculation.
+_NUMPY_MIN_VERTICES = 64
 
+# Minimum number of circular arcs in a geometry for which the vectorized (NumPy) arc kernel is used
+_NUMPY_MIN_ARCS = 8
 
-def _get_slopes(p1, p2, p3):
-    """ Calculates the slopes between `p1` and `p2`, and `p2` and `p3`. Returns a tuple (slope_a, slope_b). """
 
-    dx_a = p2[0] - p1[0]
-    dy_a = float(p2[1] - p1[1])
-    dx_b = p3[0] - p2[0]
-    dy_b = float(p3[1] - p2[1])
+class GeometrySerializationError(ValueError):
+    pass
 
-    if _math.fabs(dx_a) <= XY_TOLERANCE and _math.fabs(dy_b) <= XY_TOLERANCE:
-        return None, None
 
-    return dy_a / dx_a, dy_b / dx_b
+# Errors that can occur when a geometry is serialized or converted
+SERIALIZE_ERRORS = (GeometrySerializationError, NotImplementedError, TypeError)
 
 
 def _get_distance(p1, p2):
@@ -102,46 +115,22 @@ def _get_distance(p1, p2):
     return _math.sqrt(dx * dx + dy * dy)
 
 
-def _is_perpendicular(p1, p2, p3):
-    """ Looks if the 3 input points are perpendicular and/or parallel to on another. """
-
-    dx_a = p2[0] - p1[0]
-    dy_a = p2[1] - p1[1]
-    dx_b = p3[0] - p2[0]
-    dy_b = p3[1] - p2[1]
-
-    if _math.fabs(dx_a) <= XY_TOLERANCE and _math.fabs(dy_b) <= XY_TOLERANCE:
-        # Points are perpendicular and parallel to x-y axis
-        return False
-
-    if _math.fabs(dy_a) <= XY_TOLERANCE or _math.fabs(dy_b) <= XY_TOLERANCE:
-        # A line of two points is perpendicular to x-axis 1 or 2
-        return True
-
-    if _math.fabs(dx_a) <= XY_TOLERANCE or _math.fabs(dx_b) <= XY_TOLERANCE:
-        # A line of two points is perpendicular to y-axis 1 or 2
-        return True
-
-    return False
-
-
-def _reorder(p1, p2, p3):
-    """ Returns a tuple of the input points, possibly reordered such that no points are perpendicular. """
+def _get_arc(start_point, mid_point, end_point):
+    """
+    Returns the offset (dx, dy) of the center of the defined 3-point arc relative to the start point.
 
-    if not _is_perpendicular(p1, p2, p3):
-        return p1, p2, p3
-    elif not _is_perpendicular(p1, p3, p2):
-        return p1, p3, p2
-    elif not _is_perpendicular(p2, p1, p3):
-        return p2, p1, p3
-    elif not _is_perpendicular(p2, p3, p1):
-        return p2, p3, p1
-    elif not _is_perpendicular(p3, p2, p1):
-        return p3, p2, p1
-    elif not _is_perpendicular(p3, p1, p2):
-        return p3, p1, p2
-    else:
-        raise GeometrySerializationError('All arc points are perpendicular')
+    The center is calculated in closed form (the circumcenter of the 3 points). Because the other points are
+    translated to the start point first, large (e.g. projected) coordinates do not lose precision.
+    """
+    x, y = start_point[:2]
+    bx, by = mid_point[0] - x, mid_point[1] - y
+    cx, cy = end_point[0] - x, end_point[1] - y
+    d = 2.0 * (bx * cy - by * cx)
+    if _math.fabs(d) <= 2.0 * XY_TOLERANCE * _math.hypot(bx, by) * _math.hypot(cx, cy):
+        raise GeometrySerializationError('All arc points are colinear')
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    return (cy * b2 - by * c2) / d, (bx * c2 - cx * b2) / d
 
 
 def get_angle(center_point, from_arcpoint, to_arcpoint):
@@ -175,22 +164,8 @@ def get_arc_center(start_point, mid_point, end_point):
     :return:            A tuple of X, Y ``float`` values.
     :rtype:             tuple
     """
-    p1, p2, p3 = _reorder(start_point, mid_point, end_point)
-
-    x1, y1 = p1[:2]
-    x2, y2 = p2[:2]
-    x3, y3 = p3[:2]
-
-    slope_a, slope_b = _get_slopes(p1, p2, p3)
-    if slope_a is None and slope_b is None:
-        return 0.5 * (x2 + x3), 0.5 * (y1 + y2)
-
-    if _math.fabs(slope_a - slope_b) <= XY_TOLERANCE:
-        raise GeometrySerializationError('All arc points are colinear')
-
-    x = (slope_a * slope_b * (y1 - y3) + slope_b * (x1 + x2) - slope_a * (x2 + x3)) / 2.0 * (slope_b - slope_a)
-    y = -1.0 * (x - (x1 + x2) / 2.0) / slope_a + (y1 + y2) / 2.0
-    return x, y
+    dx, dy = _get_arc(start_point, mid_point, end_point)
+    return start_point[0] + dx, start_point[1] + dy
 
 
 def is_minor(start_point, mid_point, end_point):
@@ -205,8 +180,71 @@ def is_minor(start_point, mid_point, end_point):
     :type end_point:    tuple, list
     :rtype:             bool
     """
-    center = get_arc_center(start_point, mid_point, end_point)
-    return get_angle(center, start_point, end_point) < 180
+    # The arc is minor if the mid point and the center lie on opposite sides of the chord
+    dx, dy = _get_arc(start_point, mid_point, end_point)
+    bx, by = mid_point[0] - start_point[0], mid_point[1] - start_point[1]
+    cx, cy = end_point[0] - start_point[0], end_point[1] - start_point[1]
+    return (cx * by - cy * bx) * (cx * dy - cy * dx) < 0
+
+
+def get_arc_properties(arcs):
+    """
+    Calculates the center points, orientations and minor flags for many 3-point arcs at once (using NumPy).
+    The results are the same as those of :func:`get_arc_center`, :func:`is_clockwise` (for the arc points)
+    and :func:`is_minor` for each arc separately.
+
+    :param arcs:    A sequence of (start point, mid point, end point) tuples (each point as ``(x, y, ...)``).
+    :type arcs:     tuple, list
+    :return:        A tuple of NumPy arrays: the centers (1 row of X, Y per arc), the clockwise flags
+                    and the minor flags.
+    :rtype:         tuple
+    :raises GeometrySerializationError: If the points of any arc are colinear.
+    """
+    _vld.raise_if(_np is None, NotImplementedError, 'get_arc_properties() requires NumPy')
+
+    coords = _np.array([(s[0], s[1], m[0], m[1], e[0], e[1]) for s, m, e in arcs], dtype=float).reshape(-1, 6)
+    sx, sy, mx, my, ex, ey = coords.T
+    bx, by = mx - sx, my - sy
+    cx, cy = ex - sx, ey - sy
+    d = 2.0 * (bx * cy - by * cx)
+    if (_np.fabs(d) <= 2.0 * XY_TOLERANCE * _np.hypot(bx, by) * _np.hypot(cx, cy)).any():
+        raise GeometrySerializationError('All arc points are colinear')
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    dx, dy = (cy * b2 - by * c2) / d, (bx * c2 - cx * b2) / d
+
+    # Shoelace formula for the ring [start, mid, end, start], with the same operation order as is_clockwise()
+    clockwise = (sx * my + mx * ey + ex * sy) - (mx * sy + ex * my + sx * ey) > 0
+    minor = (cx * by - cy * bx) * (cx * dy - cy * dx) < 0
+    return _np.column_stack((sx + dx, sy + dy)), clockwise, minor
+
+
+def _get_carcs(parts):
+    """ Returns a list of (start point, interior point, end point) tuples for all circular arcs in the parts. """
+    arcs = []
+    for path in parts:
+        for p1, p2 in zip(path, path[1:]):
+            if isinstance(p2, dict):
+                curve_type, curve_points = _read_curve(p2)
+                if curve_type == _CURVE_CARC:
+                    end_point, interior_point = curve_points
+                    arcs.append((_fix_start(p1), interior_point, end_point))
+    return arcs
+
+
+def _get_carc_attrs(parts):
+    """
+    Returns an iterator of (isCCW, isMinor) XML attribute values for all circular arcs in the given EsriJSON parts.
+    If there are many arcs, they are all calculated at once (see :func:`get_arc_properties`).
+    Otherwise, each arc is calculated when the iterator reaches it.
+    """
+    arcs = _get_carcs(parts)
+    if _np is None or len(arcs) < _NUMPY_MIN_ARCS:
+        return ((_XML_FALSE if is_clockwise([s, m, e, s]) else _XML_TRUE,
+                 _XML_TRUE if is_minor(s, m, e) else _XML_FALSE) for s, m, e in arcs)
+
+    _, clockwise, minor = get_arc_properties(arcs)
+    return ((_XML_FALSE if cw else _XML_TRUE, _XML_TRUE if mn else _XML_FALSE) for cw, mn in _izip(clockwise, minor))
 
 
 def is_clockwise(ring):
@@ -215,18 +253,60 @@ def is_clockwise(ring):
 
     This is achieved by calculating an area approximation for the ring using the Shoelace formula.
     When the area is positive, the ring turns clockwise. When negative, the ring turns counterclockwise.
+    If NumPy is available, the area of large rings is calculated by NumPy. The ring can also be passed in as
+    a NumPy array (1 row of X, Y, ... values per vertex), which avoids any conversion.
 
-    :param ring:    An EsriJSON ring.
-    :type ring:     tuple, list
+    :param ring:    An EsriJSON ring or a NumPy array of ring coordinates.
+    :type ring:     tuple, list, numpy.ndarray
     :rtype:         bool
     """
+    coords = _get_array(ring)
+    if coords is not None:
+        # The ring only consists of coordinates (arcs would have failed the conversion)
+        return _get_shoelace(coords) > 0
+
     if not all(isinstance(v, (list, tuple)) for v in ring):
         # If the ring contains arcs, we'll simplify it to a list of coordinates.
         # Note that this will no longer produce an accurate area.
         ring = _simplify_ring(ring)
 
-    return ((sum(pair[0][0] * pair[1][1] for pair in zip(ring[:-1], ring[1:])) +
-             sum(-(pair[1][0] * pair[0][1]) for pair in zip(ring[:-1], ring[1:]))) / 2.0) > 0
+    return _get_shoelace(ring) > 0
+
+
+def _get_array(ring):
+    """
+    Returns a NumPy array (1 row per vertex) for the given ring coordinates in a single conversion pass,
+    or ``None`` if NumPy is not available, if the ring is too small or if not all vertices are coordinates
+    of the same dimensions (e.g. if the ring contains arcs). NumPy arrays are returned as-is.
+    """
+    if _np is None:
+        return None
+    if isinstance(ring, _np.ndarray):
+        return ring
+    if len(ring) < _NUMPY_MIN_VERTICES:
+        return None
+    # The vertex lengths are checked first (at C speed), because a mix of dimensions could fill the array as well
+    dims = set(map(len, ring))
+    if len(dims) != 1:
+        return None
+    size = dims.pop()
+    try:
+        return _np.fromiter(_chain.from_iterable(ring), float, len(ring) * size).reshape(-1, size)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_shoelace(ring):
+    """
+    Returns twice the signed area of the given ring coordinates (or NumPy array), using the Shoelace formula.
+    Large rings (and arrays) are calculated by NumPy, if available.
+    """
+    coords = _get_array(ring)
+    if coords is None:
+        return (sum(pair[0][0] * pair[1][1] for pair in zip(ring[:-1], ring[1:])) +
+                sum(-(pair[1][0] * pair[0][1]) for pair in zip(ring[:-1], ring[1:])))
+    x, y = coords[:, 0], coords[:, 1]
+    return float(_np.dot(x[:-1], y[1:]) - _np.dot(x[1:], y[:-1]))
 
 
 def _fix_start(start_object):
@@ -310,19 +390,21 @@ def _serialize_line(p1, p2):
     return line_xml
 
 
-def _serialize_carc(start_point, end_point, interior_point):
+def _serialize_carc(start_point, end_point, interior_point, carc_attrs):
     """
     Serializes the EsriJSON circular arc to XML.
 
     :param start_point:     Start point [x, y, ...]
     :param end_point:       End point [x, y, ...]
     :param interior_point:  Interior a.k.a. midpoint [x, y, ...]
+    :param carc_attrs:      An iterator of circular arc attribute values (see :func:`_get_carc_attrs`).
     :return:                An XML 'CircularArc' element.
     """
+    ccw, minor = next(carc_attrs)
     curve_xml = _Xml.Element(_TAG_CARC, {
         _ATTR_ENUM: str(_ESRI_ENUM_CARC),
-        _ATTR_CCW: _XML_FALSE if is_clockwise([start_point, interior_point, end_point, start_point]) else _XML_TRUE,
-        _ATTR_MINOR: _XML_TRUE if is_minor(start_point, interior_point, end_point) else _XML_FALSE
+        _ATTR_CCW: ccw,
+        _ATTR_MINOR: minor
     })
     curve_xml.append(_serialize_point(*interior_point[:2]))
     curve_xml.append(_serialize_point(*start_point[:2]))
@@ -371,18 +453,19 @@ def _serialize_bezier(start_point, end_point, control_p1, control_p2):
     return curve_xml
 
 
-def _serialize_curve(start_object, curve_object):
+def _serialize_curve(start_object, curve_object, carc_attrs):
     """
     Serializes the EsriJSON curve object definition to XML.
 
     :param start_object:    The start point (x, y) for the curve or the previous curve object.
     :param curve_object:    An EsriJSON curve object value (dict).
+    :param carc_attrs:      An iterator of circular arc attribute values (see :func:`_get_carc_attrs`).
     :return:                An XML 'CircularArc', 'EllipticArc' or 'BezierCurve' element.
     """
     start_point = _fix_start(start_object)
     curve_type, curve_points = _read_curve(curve_object)
     if curve_type == _CURVE_CARC:
-        return _serialize_carc(start_point, *curve_points)
+        return _serialize_carc(start_point, *curve_points, carc_attrs=carc_attrs)
     elif curve_type == _CURVE_EARC:
         return _serialize_earc(start_point, *curve_points)
     elif curve_type == _CURVE_BEZIER:
@@ -390,32 +473,34 @@ def _serialize_curve(start_object, curve_object):
     raise GeometrySerializationError('{!r} is an unsupported curve object type')
 
 
-def _serialize_ring(ring):
+def _serialize_ring(ring, carc_attrs):
     """
     Serializes the EsriJSON ring definition to XML.
 
-    :param ring:    A single EsriJSON 'curveRings' or 'rings' object value.
-    :return:        An XML 'Ring' element.
+    :param ring:        A single EsriJSON 'curveRings' or 'rings' object value.
+    :param carc_attrs:  An iterator of circular arc attribute values (see :func:`_get_carc_attrs`).
+    :return:            An XML 'Ring' element.
     """
     # Calculate "isexterior" property: Esri defines this as "ring orientation is clockwise, area > 0".
     is_ext = is_clockwise(ring)
     ring_xml = _Xml.Element(_TAG_RING,
                             {_ATTR_ENUM: str(_ESRI_ENUM_RING), _ATTR_EXT: _XML_TRUE if is_ext else _XML_FALSE})
-    _serialize_path(ring, ring_xml)
+    _serialize_path(ring, ring_xml, carc_attrs)
     return ring_xml
 
 
-def _serialize_path(path, parent_node):
+def _serialize_path(path, parent_node, carc_attrs):
     """
     Serializes an EsriJSON `path` to XML and adds the elements to `parent_node`.
 
-    :param path:    A single EsriJSON 'curvePaths/Rings' or 'paths/rings' object value.
+    :param path:        A single EsriJSON 'curvePaths/Rings' or 'paths/rings' object value.
+    :param carc_attrs:  An iterator of circular arc attribute values (see :func:`_get_carc_attrs`).
     """
     for p1, p2 in zip(path, path[1:]):
         if isinstance(p2, list):
             parent_node.append(_serialize_line(p1, p2))
         elif isinstance(p2, dict):
-            parent_node.append(_serialize_curve(p1, p2))
+            parent_node.append(_serialize_curve(p1, p2, carc_attrs))
 
 
 def _serialize_polyline(polyline):
@@ -430,10 +515,11 @@ def _serialize_polyline(polyline):
 
     polyline_xml = _Xml.Element(_TAG_POLYLINE, {_ATTR_ENUM: str(_ESRI_ENUM_POLYLINE)})
     is_multi = len(polyline) > 1  # Does the GEONIS Protocol really never write Paths for single part polylines?
+    carc_attrs = _get_carc_attrs(polyline)
     for path in polyline:
         _serialize_path(path,
                         _Xml.SubElement(polyline_xml, _TAG_PATH, {_ATTR_ENUM: str(_ESRI_ENUM_PATH)})
-                        if is_multi else polyline_xml)
+                        if is_multi else polyline_xml, carc_attrs)
     return polyline_xml
 
 
@@ -447,8 +533,9 @@ def _serialize_polygon(polygons):
     _vld.pass_if(polygons, GeometrySerializationError, 'Polygon does not have any geometry parts')
 
     polygon_xml = _Xml.Element(_TAG_POLYGON, {_ATTR_ENUM: str(_ESRI_ENUM_POLYGON)})
+    carc_attrs = _get_carc_attrs(polygons)
     for path in polygons:
-        polygon_xml.append(_serialize_ring(path))
+        polygon_xml.append(_serialize_ring(path, carc_attrs))
     return polygon_xml
 
 
@@ -483,19 +570,18 @@ def _serialize_geometry(esri_json):
     return xml_geom
 
 
-def serialize(geometry):
+def to_esri_json(geometry):
     """
-    Serializes Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable into GEONIS Protocol XML geometry.
-    Regardless of the dimensions of the input geometry, the output geometry will always be 2D.
+    Converts Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable into an EsriJSON dictionary.
 
-    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or a coordinate iterable.
-    :type geometry:     Geometry, str, unicode, tuple, list
-    :return:            An XML 'Geometry' element.
-    :rtype:             Element
-
-    .. seealso::        :class:`gntools.protocol.Logger`, :class:`gntools.protocol.Feature`
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or dictionary or a coordinate iterable.
+    :type geometry:     Geometry, str, unicode, dict, tuple, list
+    :rtype:             dict
     """
 
+    if isinstance(geometry, dict):
+        return geometry
+
     json_shape = None
 
     try:
@@ -517,4 +603,364 @@ def serialize(geometry):
         raise GeometrySerializationError('serialize() requires an EsriJSON string, '
                                          'Geometry or Point instance, or a coordinate tuple: {}'.format(e))
 
-    return _serialize_geometry(json_shape)
+    return json_shape
+
+
+def serialize(geometry):
+    """
+    Serializes Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable into GEONIS Protocol XML geometry.
+    Regardless of the dimensions of the input geometry, the output geometry will always be 2D.
+
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or a coordinate iterable.
+    :type geometry:     Geometry, str, unicode, tuple, list
+    :return:            An XML 'Geometry' element.
+    :rtype:             Element
+
+    .. seealso::        :class:`gntools.protocol.Logger`, :class:`gntools.protocol.Feature`
+    """
+    return _serialize_geometry(to_esri_json(geometry))
+
+
+def _tag_format(tag, *attrs):
+    """
+    Returns a format string for the (unclosed) start tag of an XML element with the given attributes.
+    The attributes are sorted by name, like ElementTree does. An attribute is either a name, which becomes a
+    positional format field (numbered in the given order), or a (name, value) tuple for a fixed attribute value.
+    """
+    fields = {}
+    index = 0
+    for attr in attrs:
+        if isinstance(attr, tuple):
+            name, value = attr
+            fields[name] = str(value)
+        else:
+            fields[attr] = '{{{}}}'.format(index)
+            index += 1
+    return '<{}{}'.format(tag, ''.join(' {}="{}"'.format(k, v) for k, v in sorted(fields.iteritems())))
+
+
+_FMT_POINT = _tag_format(_TAG_POINT, (_ATTR_ENUM, _ESRI_ENUM_POINT), _XML_X, _XML_Y) + ' />'
+_FMT_LINE = _tag_format(_TAG_LINE, (_ATTR_ENUM, _ESRI_ENUM_LINE)) + '>'
+_FMT_CARC = _tag_format(_TAG_CARC, (_ATTR_ENUM, _ESRI_ENUM_CARC), _ATTR_CCW, _ATTR_MINOR) + '>'
+_FMT_EARC = _tag_format(_TAG_EARC, (_ATTR_ENUM, _ESRI_ENUM_EARC), (_ATTR_ESTD, _XML_FALSE),
+                        _ATTR_CCW, _ATTR_ANGLE, _ATTR_RATIO) + '>'
+_FMT_BEZIER = _tag_format(_TAG_BEZIER, (_ATTR_ENUM, _ESRI_ENUM_BEZIER)) + '>'
+_FMT_PATH = _tag_format(_TAG_PATH, (_ATTR_ENUM, _ESRI_ENUM_PATH))
+_FMT_RING = _tag_format(_TAG_RING, (_ATTR_ENUM, _ESRI_ENUM_RING), _ATTR_EXT)
+_FMT_POLYLINE = _tag_format(_TAG_POLYLINE, (_ATTR_ENUM, _ESRI_ENUM_POLYLINE))
+_FMT_POLYGON = _tag_format(_TAG_POLYGON, (_ATTR_ENUM, _ESRI_ENUM_POLYGON)) + '>'
+
+
+def _child(indent):
+    """ Returns the indentation for the children of an element with the given *indent* (empty if not indented). """
+    return indent and indent + '\t'
+
+
+def _write_point(write, indent, x, y):
+    """ Writes the XML 'Point' element for the given coordinate values. """
+    if x in (None, _JSON_NAN) or y in (None, _JSON_NAN):
+        raise GeometrySerializationError('Points should have valid numeric X and Y values')
+    write(indent + _FMT_POINT.format(str(x), str(y)))
+
+
+def _write_points(write, indent, *points):
+    """ Writes the XML 'Point' elements for the given points ([x, y, ...]). """
+    for point in points:
+        _write_point(write, indent, *point[:2])
+
+
+def _write_line(write, indent, p1, p2):
+    """ Writes the XML 'Line' element for the EsriJSON line from `p1` (point or last curve object) to `p2`. """
+    write(indent + _FMT_LINE)
+    _write_points(write, _child(indent), _fix_start(p1), p2)
+    write('{}</{}>'.format(indent, _TAG_LINE))
+
+
+def _write_curve(write, indent, start_object, curve_object, carc_attrs):
+    """
+    Writes the XML 'CircularArc', 'EllipticArc' or 'BezierCurve' element for the EsriJSON curve object.
+    The attribute values of circular arcs are taken from the *carc_attrs* iterator (see :func:`_get_carc_attrs`).
+    """
+    start_point = _fix_start(start_object)
+    curve_type, curve_points = _read_curve(curve_object)
+    if curve_type == _CURVE_CARC:
+        end_point, interior_point = curve_points
+        tag, points = _TAG_CARC, (interior_point, start_point, end_point)
+        write(indent + _FMT_CARC.format(*next(carc_attrs)))
+    elif curve_type == _CURVE_EARC:
+        end_point, center_point, _, cw, rotation, _, ratio = curve_points
+        tag, points = _TAG_EARC, (center_point, start_point, end_point)
+        write(indent + _FMT_EARC.format(_XML_FALSE if cw else _XML_TRUE, str(rotation), str(ratio)))
+    elif curve_type == _CURVE_BEZIER:
+        end_point, control_p1, control_p2 = curve_points
+        tag, points = _TAG_BEZIER, (start_point, control_p1, end_point, control_p2)
+        write(indent + _FMT_BEZIER)
+    else:
+        raise GeometrySerializationError('{!r} is an unsupported curve object type')
+    _write_points(write, _child(indent), *points)
+    write('{}</{}>'.format(indent, tag))
+
+
+def _write_path(write, indent, path, carc_attrs, start_tag=None, tag=None):
+    """
+    Writes the XML elements for the segments of an EsriJSON `path`.
+    If a `start_tag` is given, the segments are enclosed by an element with that start tag (and `tag` name),
+    which is self-closing if the path does not have any segments.
+    """
+    if start_tag:
+        if not any(isinstance(p, (list, dict)) for p in path[1:]):
+            write('{}{} />'.format(indent, start_tag))
+            return
+        write(indent + start_tag + '>')
+        parent_indent, indent = indent, _child(indent)
+
+    for p1, p2 in zip(path, path[1:]):
+        if isinstance(p2, list):
+            _write_line(write, indent, p1, p2)
+        elif isinstance(p2, dict):
+            _write_curve(write, indent, p1, p2, carc_attrs)
+
+    if start_tag:
+        write('{}</{}>'.format(parent_indent, tag))
+
+
+def write_geometry(write, geometry, level=None):
+    """
+    Writes Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable as GEONIS Protocol XML geometry text
+    using the given *write* function, without building any XML elements.
+
+    The output is identical to the ElementTree output of :func:`serialize` (i.e. ``tostring(serialize(geometry))``).
+    If a *level* is specified, each element is put on a new line and indented by tabs instead,
+    where the <geometry> element itself is indented *level* times.
+
+    :param write:       A function (e.g. ``file.write``) that accepts the XML text fragments (``str``).
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or dictionary or a coordinate iterable.
+    :param level:       An optional indentation level. If ``None`` (default), no whitespace is written at all.
+    :type write:        function
+    :type geometry:     Geometry, str, unicode, dict, tuple, list
+    :type level:        int
+
+    .. note::           If the geometry cannot be serialized, some of the XML text may already have been written.
+                        Use :func:`serialize_to_bytes` if this is not acceptable.
+    """
+    esri_json = to_esri_json(geometry)
+    _vld.pass_if(isinstance(esri_json, dict), TypeError, 'EsriJSON object should be a dictionary')
+
+    indent = '' if level is None else '\n' + '\t' * level
+    if not esri_json:
+        # EsriJSON is empty (this should not happen actually)
+        write('{}<{} />'.format(indent, _TAG_GEOMETRY))
+        return
+
+    if _JSON_X in esri_json or _JSON_Y in esri_json:
+        write('{}<{}>'.format(indent, _TAG_GEOMETRY))
+        _write_point(write, _child(indent), esri_json.get(_JSON_X), esri_json.get(_JSON_Y))
+
+    elif _JSON_CURVEPATHS in esri_json or _JSON_PATHS in esri_json:
+        polyline = esri_json.get(_JSON_CURVEPATHS) or esri_json.get(_JSON_PATHS)
+        _vld.pass_if(polyline, GeometrySerializationError, 'Polyline does not have any geometry parts')
+        write('{}<{}>'.format(indent, _TAG_GEOMETRY))
+        child = _child(indent)
+        carc_attrs = _get_carc_attrs(polyline)
+        if len(polyline) > 1:
+            write(child + _FMT_POLYLINE + '>')
+            for path in polyline:
+                _write_path(write, _child(child), path, carc_attrs, _FMT_PATH, _TAG_PATH)
+            write('{}</{}>'.format(child, _TAG_POLYLINE))
+        else:
+            _write_path(write, child, polyline[0], carc_attrs, _FMT_POLYLINE, _TAG_POLYLINE)
+
+    elif _JSON_CURVERINGS in esri_json or _JSON_RINGS in esri_json:
+        polygons = esri_json.get(_JSON_CURVERINGS) or esri_json.get(_JSON_RINGS)
+        _vld.pass_if(polygons, GeometrySerializationError, 'Polygon does not have any geometry parts')
+        write('{}<{}>'.format(indent, _TAG_GEOMETRY))
+        child = _child(indent)
+        carc_attrs = _get_carc_attrs(polygons)
+        write(child + _FMT_POLYGON)
+        for ring in polygons:
+            # Calculate "isexterior" property: Esri defines this as "ring orientation is clockwise, area > 0".
+            ring_tag = _FMT_RING.format(_XML_TRUE if is_clockwise(ring) else _XML_FALSE)
+            _write_path(write, _child(child), ring, carc_attrs, ring_tag, _TAG_RING)
+        write('{}</{}>'.format(child, _TAG_POLYGON))
+
+    else:
+        raise NotImplementedError('Geometries other than point, polyline or polygon are not supported')
+
+    write('{}</{}>'.format(indent, _TAG_GEOMETRY))
+
+
+def serialize_to_bytes(geometry, level=None):
+    """
+    Serializes Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable into GEONIS Protocol XML geometry text.
+    The result is identical to ``tostring(serialize(geometry))``, but no XML elements are built.
+
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or dictionary or a coordinate iterable.
+    :param level:       An optional indentation level (see :func:`write_geometry`).
+    :type geometry:     Geometry, str, unicode, dict, tuple, list
+    :type level:        int
+    :rtype:             str
+    """
+    parts = []
+    write_geometry(parts.append, geometry, level)
+    return ''.join(parts)
+
+
+def get_shape(geometry):
+    """
+    Returns a raw (picklable) shape for the given geometry, which can be serialized later on (e.g. by another process).
+    Esri Geometry instances are converted to EsriJSON strings and Esri Points to coordinate tuples.
+    Other geometries (e.g. EsriJSON strings) are returned as-is.
+
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or dictionary or a coordinate iterable.
+    :type geometry:     Geometry, str, unicode, dict, tuple, list
+    """
+    if hasattr(geometry, 'JSON'):
+        return geometry.JSON
+    if hasattr(geometry, 'X') and hasattr(geometry, 'Y'):
+        return geometry.X, geometry.Y
+    return geometry
+
+
+def try_serialize(geometry, level=None):
+    """
+    Returns the serialized GEONIS XML geometry text for *geometry* (see :func:`serialize_to_bytes`).
+    If the geometry could not be serialized, the error is returned instead of raised,
+    so that a single invalid geometry does not abort a whole chunk in a worker process.
+
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or dictionary or a coordinate iterable.
+    :param level:       An optional indentation level (see :func:`write_geometry`).
+    :type geometry:     Geometry, str, unicode, dict, tuple, list
+    :type level:        int
+    :rtype:             str, Exception
+    """
+    try:
+        return serialize_to_bytes(geometry, level)
+    except SERIALIZE_ERRORS as e:
+        return e
+
+
+def _can_start_workers():
+    """
+    Returns ``True`` if the current process is a Python interpreter, so that worker processes can be started.
+    This is not the case if Python is embedded in a host application (e.g. ArcMap or ArcGIS Pro),
+    because the worker processes would start the host application executable instead.
+    """
+    return _os.path.basename(_sys.executable or '').lower().startswith('python')
+
+
+def serialize_many(geometries, workers=1, chunksize=_CHUNK_SIZE, strict=True):
+    """
+    Serializes an iterable of geometries into GEONIS Protocol XML geometry text (see :func:`serialize_to_bytes`),
+    optionally using a pool of worker processes. Yields the results in input order.
+
+    The geometries are read and sent to the workers in chunks. While the results of a chunk are consumed,
+    the next chunk is already being serialized, so that only about two chunks are held in memory at any time.
+    Esri Geometry instances are converted to EsriJSON strings before they are sent to the workers,
+    but it's faster to pass in the EsriJSON strings (e.g. from a ``SHAPE@JSON`` cursor field) directly.
+
+    :param geometries:  An iterable of EsriJSON strings or dictionaries, Esri Geometry or Point instances
+                        or coordinate iterables.
+    :param workers:     The number of worker processes. If 1 (default), the geometries are serialized by the
+                        current process. If ``None``, the number of CPUs is used.
+    :param chunksize:   The number of geometries per chunk (default = 1000).
+    :param strict:      If ``True`` (default), the error for the first geometry that could not be serialized
+                        is raised. If ``False``, the error instance is yielded in place of the geometry text.
+    :type geometries:   iterable
+    :type workers:      int
+    :type chunksize:    int
+    :type strict:       bool
+    :rtype:             generator
+
+    .. warning::        On Windows, each worker process imports the main module of the calling process again.
+                        A calling script must therefore protect its entry point with an
+                        ``if __name__ == '__main__':`` guard, or each worker will run the script again.
+                        If Python does not run as a standalone interpreter (e.g. in ArcMap or ArcGIS Pro),
+                        no worker processes are started and the geometries are serialized by the current process.
+    """
+    if workers is None:
+        workers = _mp.cpu_count()
+    _vld.pass_if(isinstance(workers, (int, long)) and not isinstance(workers, bool) and workers > 0, ValueError,
+                 'workers must be a positive integer')
+    _vld.pass_if(isinstance(chunksize, (int, long)) and not isinstance(chunksize, bool) and chunksize > 0, ValueError,
+                 'chunksize must be a positive integer')
+
+    def check(result):
+        if strict and isinstance(result, Exception):
+            raise result
+        return result
+
+    if workers == 1 or not _can_start_workers():
+        for geometry in geometries:
+            yield check(try_serialize(geometry))
+        return
+
+    geometries = (get_shape(g) for g in geometries)
+    pool = _mp.Pool(workers)
+    pending = _deque()
+    try:
+        while True:
+            chunk = list(_islice(geometries, chunksize))
+            if chunk:
+                pending.append(pool.map_async(try_serialize, chunk))
+                if len(pending) < 2:
+                    continue
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                yield check(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _wkt_coords(path):
+    """ Returns the WKT coordinate list (without parentheses) for an EsriJSON path or ring. """
+    return ', '.join('{!r} {!r}'.format(float(p[0]), float(p[1])) for p in path)
+
+
+def to_wkt(geometry):
+    """
+    Converts Esri Geometry, an Esri Point, EsriJSON or a coordinate iterable into a (2D) WKT string.
+    Arcs and curves are approximated by their control points and end points.
+    Polygon rings that are exterior rings (see :func:`is_clockwise`, which also sets the "isexterior" attribute
+    of the GEONIS XML) start a new polygon, while the other (interior) rings are added as holes to the preceding one.
+
+    :param geometry:    An Esri Geometry or Point instance, an Esri JSON string or a coordinate iterable.
+    :type geometry:     Geometry, str, unicode, tuple, list
+    :rtype:             str
+    """
+    esri_json = to_esri_json(geometry)
+    _vld.pass_if(isinstance(esri_json, dict), TypeError, 'EsriJSON object should be a dictionary')
+
+    if _JSON_X in esri_json or _JSON_Y in esri_json:
+        x, y = esri_json.get(_JSON_X), esri_json.get(_JSON_Y)
+        if x in (None, _JSON_NAN) or y in (None, _JSON_NAN):
+            return 'POINT EMPTY'
+        return 'POINT ({!r} {!r})'.format(float(x), float(y))
+
+    paths = esri_json.get(_JSON_CURVEPATHS) or esri_json.get(_JSON_PATHS)
+    if paths is not None:
+        if not paths:
+            return 'LINESTRING EMPTY'
+        lines = ['({})'.format(_wkt_coords(_simplify_ring(path))) for path in paths]
+        if len(lines) == 1:
+            return 'LINESTRING {}'.format(lines[0])
+        return 'MULTILINESTRING ({})'.format(', '.join(lines))
+
+    rings = esri_json.get(_JSON_CURVERINGS) or esri_json.get(_JSON_RINGS)
+    if rings is not None:
+        if not rings:
+            return 'POLYGON EMPTY'
+        polygons = []
+        for ring in rings:
+            ring = _simplify_ring(ring)
+            if is_clockwise(ring) or not polygons:
+                polygons.append([])
+            polygons[-1].append('({})'.format(_wkt_coords(ring)))
+        polygons = ['({})'.format(', '.join(p)) for p in polygons]
+        if len(polygons) == 1:
+            return 'POLYGON {}'.format(polygons[0])
+        return 'MULTIPOLYGON ({})'.format(', '.join(polygons))
+
+    raise NotImplementedError('Geometries other than point, polyline or polygon are not supported')
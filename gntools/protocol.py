@@ -19,16 +19,43 @@ This module can be used to write text and features to the GEONIS Protocol (XML).
 The Protocol is typically used to report issues (e.g. validation) with certain features.
 """
 
+import atexit as _atexit
+import cPickle as _pickle
+import csv as _csv
+import hashlib as _hashlib
+import heapq as _heapq
+import io as _io
+import json as _json
+import multiprocessing as _mp
 import os as _os
+import random as _random
+import re as _re
+import shutil as _shutil
+import struct as _struct
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
+import zlib as _zlib
 from calendar import timegm as _timegm
+from collections import Counter as _Counter
+from collections import OrderedDict as _ODict
+from collections import deque as _deque
 from datetime import datetime as _dt
 from datetime import timedelta as _td
+from itertools import chain as _chain
+from itertools import count as _count
+from itertools import izip as _izip
+from operator import attrgetter as _attrgetter
 from time import mktime as _mktime
+from warnings import warn as _warn
 from xml.etree import cElementTree as _Xml
 
+import arcpy as _arcpy
+
 import gntools.common.geometry as _geometry
 import gntools.common.const as _const
 import gpf.common.guids as _guids
+import gpf.cursors as _cursors
 import gpf.common.textutils as _tu
 import gpf.common.validate as _vld
 import gpf.paths as _paths
@@ -43,6 +70,20 @@ _GNLOG_TYPE_WARNING = 3
 _GNLOG_TYPE_FAILURE = 4
 _GNLOG_TYPE_NOTICE = 5  # In Delphi code, this is called GnLogInfo
 
+# Message type names that can be used instead of the message type values (e.g. for Logger.log_many)
+_GNLOG_TYPE_NAMES = {
+    'header': _GNLOG_TYPE_HEADER1,
+    'subheader': _GNLOG_TYPE_HEADER2,
+    'message': _GNLOG_TYPE_MESSAGE,
+    'warn': _GNLOG_TYPE_WARNING,
+    'warning': _GNLOG_TYPE_WARNING,
+    'error': _GNLOG_TYPE_FAILURE,
+    'failure': _GNLOG_TYPE_FAILURE,
+    'info': _GNLOG_TYPE_NOTICE,
+    'notice': _GNLOG_TYPE_NOTICE
+}
+_GNLOG_TYPES = frozenset(_GNLOG_TYPE_NAMES.values())
+
 _ATTR_CONN = 'con'
 _ATTR_TABLE = 'tbl'
 _ATTR_FIELD = 'fld'
@@ -61,65 +102,1456 @@ _TAG_OBJECT = 'Object'
 _TAG_CFUNC = 'CustomFunctions'
 _TAG_FEATURE = 'feature'
 _TAG_DATAID = 'dataid'
+_TAG_GEOMETRY = 'geometry'
+
+# Tags and attributes for the index file that lists the parts of a rotated protocol
+_TAG_PARTS = 'ProtocolParts'
+_TAG_PART = 'Part'
+_ATTR_FILE = 'file'
+_ATTR_ENTRIES = 'entries'
+_PART_SUFFIX = '_{:03d}'
+_PARTS_SUFFIX = '_parts'
+
+# Entry orders that can be used when the Logger runs in concurrent mode
+_ORDER_DATE = 'date'
+_ORDER_SUBMISSION = 'submission'
+
+# Pattern for GlobalID values that are already formatted as Esri expects them (as returned by cursors)
+_GUID_PATTERN = _re.compile(r'^{[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}}$')
+
+# Number of entries that are pickled per batch in a protocol fragment file
+_FRAGMENT_BATCH = 1000
+
+# Number of bytes reserved in the root start tag of a streamed protocol for the project attributes
+_STREAM_RESERVE = 1024
+
+# Number of bytes at the start and end of an existing protocol that are read to find the encoding and closing tag
+_APPEND_SCAN = 4096
+
+# Sidecar index file suffix, header (magic, base offset, protocol size) and record layout
+# (entry offset relative to base, entry length, message type, table name CRC-32, GlobalID hash)
+_INDEX_SUFFIX = '.idx'
+_INDEX_MAGIC = 'GNPX'
+_INDEX_HEADER = _struct.Struct('<4sQQ')
+_INDEX_RECORD = _struct.Struct('<QIBIQ')
+_INDEX_BATCH = 4096
+
+# Pattern to extract the encoding from an XML declaration
+_ENCODING_PATTERN = _re.compile(r'^<\?xml[^>]*encoding=[\'"]([\w.:-]+)[\'"]')
+
+# Pattern to find the tags in a serialized GEONIS XML geometry (which has no element text)
+_TAG_PATTERN = _re.compile(r'<[^>]+>')
 
 # Define constants for _get_delphi_time() function
 _DELPHI_EPOCH = _timegm(_dt(1899, 12, 30).timetuple())
 _TZ_OFFSET = _mktime(_dt.now().utctimetuple()) - _mktime(_dt.utcnow().utctimetuple())
 _DAY_SECONDS = _td(days=1).total_seconds()
 
-# Object caches for memoization of calculated values
-_time_cache = {}
-_table_cache = {}
+# Summary message of a limit (see Logger.set_limit()) for which entries have been dropped
+_LIMIT_SUMMARY = u'{} more entries were not logged (limit of {} entries reached for message type {}, message {})'
+_LIMIT_ANY = u'*'
+
+# Section header messages and temporary fragment file suffixes of a protocol diff (see diff_protocols())
+_DIFF_NEW = u'New entries ({})'
+_DIFF_RESOLVED = u'Resolved entries ({})'
+_DIFF_UNCHANGED = u'Unchanged entries ({})'
+_DIFF_SUFFIX = '.{}.tmp'
+
+# Geometry formats and fields of the line-oriented protocol sinks (JSON Lines, CSV)
+_SINK_ESRIJSON = 'esrijson'
+_SINK_WKT = 'wkt'
+_SINK_XML = 'xml'
+_SINK_FIELDS = (_ATTR_MSGTYPE, _ATTR_MSG, _ATTR_DATE, _ATTR_CONN, _ATTR_TABLE, _ATTR_FIELD, _ATTR_VALUE, _TAG_GEOMETRY)
+
+# Keys by which ProtocolReader.counts() can group the entries
+_READER_TYPE = 'type'
+_READER_KEYS = {
+    _READER_TYPE: _attrgetter('msg_type'),
+    'message': _attrgetter('message'),
+    'table': lambda entry: entry.data_id[1] if entry.data_id else None,
+    'connection': lambda entry: entry.data_id[0] if entry.data_id else None
+}
+
+# Default resolution (in seconds) of the protocol entry timestamps and maximum number of cached formatted timestamps
+_CLOCK_RESOLUTION = 1.0
+_CLOCK_CACHE_SIZE = 256
+
+# Object caches for memoization of calculated values
+_table_cache = {}
+
+# Persistent table properties store (see use_table_store())
+_table_store = None
+
+# Table properties store JSON keys
+_STORE_STAMP = 'stamp'
+_STORE_TABLES = 'tables'
+
+# System catalog table of a File Geodatabase, which only changes when the schema changes
+_GDB_CATALOG = 'a00000001.gdbtable'
+
+# Data types of the workspace elements for which table properties are prewarmed
+_PREWARM_TYPES = ['FeatureClass', 'Table']
+
+
+def _get_delphi_time(time=None, clock=None):
+    """
+    Gets the current time (optionally, for a given time) expressed as a formatted floating point string for Delphi.
+
+    :param time:    A datetime object. When not set, the current time of the protocol clock is used.
+    :param clock:   An optional :class:`_DelphiClock` to use instead of the default (module) clock.
+    :return:        A string-formatted floating point value, specifying the number of days since 1899/12/30.
+    :rtype:         str
+    """
+    clock = clock or _clock
+    if not time:
+        return clock.now()
+    if not isinstance(time, _dt):
+        raise TypeError("'time' should be a datetime object or None")
+    return clock.format(_mktime(time.timetuple()) + time.microsecond / 1000000.)
+
+
+def _get_message(msg):
+    """ Returns the (unicode) message for an entry or ``None`` if *msg* is empty (blank line). """
+    if msg in (_const.CHAR_EMPTY, None):
+        return None
+    return _tu.to_unicode(msg) if isinstance(msg, str) else msg
+
+
+def _get_msgtype(msg_type):
+    """ Returns the message type value for the given message type value or name (e.g. 'warning'). """
+    if isinstance(msg_type, basestring):
+        try:
+            return _GNLOG_TYPE_NAMES[msg_type.lower()]
+        except KeyError:
+            raise ValueError('Unknown message type {}'.format(_tu.to_repr(msg_type)))
+    _vld.pass_if(msg_type in _GNLOG_TYPES, ValueError, 'Unknown message type {!r}'.format(msg_type))
+    return int(msg_type)
+
+
+def _get_guid(global_id):
+    """ Returns a validated GlobalID string. Values that already have the expected format are not parsed again. """
+    if isinstance(global_id, basestring) and _GUID_PATTERN.match(global_id):
+        return str(global_id)
+    return str(_guids.Guid(global_id))
+
+
+def _get_table_key(table_path):
+    """ Returns the normalized (lower case) path of a table, which is used as table properties cache key. """
+    return _os.path.normpath(table_path).lower()
+
+
+def _hash64(text):
+    """ Returns a (stable) unsigned 64-bit integer hash for the given (unicode) text. """
+    return _struct.unpack('<Q', _hashlib.md5(_tu.to_unicode(text).encode('utf-8')).digest()[:8])[0]
+
+
+def _get_table_hash(table):
+    """ Returns the (unsigned) CRC-32 of a table name, by which entries can be looked up in a sidecar index. """
+    return _zlib.crc32(_tu.to_unicode(table).lower().encode('utf-8')) & 0xffffffff
+
+
+def _get_guid_hash(global_id):
+    """ Returns the 64-bit hash of a GlobalID, by which entries can be looked up in a sidecar index. """
+    return _hash64(global_id.upper())
+
+
+def _get_table_props(table_path):
+    """
+    Returns a memoized _TableProps object for *table_path* (or creates and stores a new one).
+    If a persistent table store is in use, it is consulted before the table is described.
+    """
+    global _table_cache
+
+    table = _get_table_key(table_path)
+    try:
+        # Get memoized table properties, if any
+        props = _table_cache[table]
+    except KeyError:
+        props = _table_store.get(table_path) if _table_store else None
+        if not props:
+            # Create new _TableProps object and store it
+            props = _TableProps(table_path)
+            if _table_store:
+                # The store is saved in batches (see _TableStore.save()), not for every new table
+                _table_store.put(table_path, props)
+        _table_cache[table] = props
+    return props
+
+
+def _get_workspace_stamp(workspace):
+    """
+    Returns a value that changes when the schema of the given root *workspace* may have changed.
+    This is the contents of the GEONIS version table. If a local workspace has no (readable) version table,
+    the modification time of its system catalog table is used instead. The modification time of the workspace folder
+    itself is not used, because it changes whenever ArcGIS creates or removes a lock file.
+    Returns ``None`` (with a warning) if no stamp could be determined: the table store is then not used
+    for the tables of this workspace.
+    """
+    try:
+        with _cursors.SearchCursor(_paths.concat(workspace, _const.GNTABLE_VERSION)) as rows:
+            return repr(sorted(tuple(row) for row in rows))
+    except (RuntimeError, IOError) as e:
+        error = e
+    if not workspace.lower().endswith(_const.EXT_ESRI_SDE):
+        try:
+            return repr(_os.path.getmtime(_os.path.join(workspace, _GDB_CATALOG)))
+        except OSError as e:
+            error = e
+    _warn('Table store is not used for {}: {}'.format(_tu.to_repr(workspace), error))
+    return None
+
+
+class _TableProps(object):
+    """
+    Dataholder class for table properties (workspace path, table name, GlobalID field).
+
+    :param table_path:  The full path to the table or feature class for which the TableProps should be populated.
+    :type table_path:   str, unicode
+    """
+    def __init__(self, table_path):
+        # Extract the workspace root (Geodatabase) path from the table path
+        self.workspace = str(_paths.get_workspace(table_path, True))
+
+        # Store the unqualified table name
+        self.table = _paths.unqualify(table_path)
+
+        # Store the GlobalID field name
+        self.globalid_field = _meta.Describe(table_path).globalIDFieldName or _const.FIELD_GLOBALID
+
+    @classmethod
+    def from_record(cls, record):
+        """ Creates a _TableProps object from a (workspace, table, globalid_field) record without describing it. """
+        props = cls.__new__(cls)
+        props.workspace, props.table, props.globalid_field = record
+        return props
+
+    def to_record(self):
+        """ Returns the (workspace, table, globalid_field) record for the table properties. """
+        return [self.workspace, self.table, self.globalid_field]
+
+
+class _TableStore(object):
+    """
+    Small on-disk (JSON) store of table properties, so that tables do not have to be described in every new process.
+
+    The table properties are grouped by root workspace. Each workspace has a stamp (see :func:`_get_workspace_stamp`)
+    and when the stamp of a workspace has changed, all its stored table properties are discarded.
+
+    New table properties are kept in memory until :func:`save` is called (on flush, at exit or explicitly).
+    The store can be used by multiple threads at once.
+
+    :param store_path:  The full path to the JSON store file. If it does not exist yet, it will be created.
+    :type store_path:   str, unicode
+    """
+
+    __slots__ = ('_path', '_data', '_stamps', '_dirty', '_lock')
+
+    def __init__(self, store_path):
+        self._path = _os.path.realpath(store_path)
+        self._stamps = {}
+        self._data = {}
+        self._dirty = False
+        self._lock = _threading.Lock()
+        if _os.path.isfile(self._path):
+            try:
+                with open(self._path, 'rb') as f:
+                    self._data = _json.load(f)
+            except (IOError, ValueError) as e:
+                _warn('Ignored damaged table store {}: {}'.format(_tu.to_repr(self._path), e))
+
+    @property
+    def path(self):
+        """ Returns the path to the JSON store file. """
+        return self._path
+
+    def _get_workspace(self, workspace):
+        """
+        Returns the stored tables (dict) of a root workspace, if the workspace stamp is still valid.
+        The caller must hold the store lock.
+        """
+        key = workspace.lower()
+        if key not in self._stamps:
+            self._stamps[key] = _get_workspace_stamp(workspace)
+        stamp = self._stamps[key]
+        if stamp is None:
+            return None
+        stored = self._data.get(key)
+        if not stored or stored.get(_STORE_STAMP) != stamp:
+            stored = self._data[key] = {_STORE_STAMP: stamp, _STORE_TABLES: {}}
+            self._dirty = True
+        return stored[_STORE_TABLES]
+
+    def get(self, table_path):
+        """ Returns the stored :class:`_TableProps` for *table_path* or ``None`` if these are unknown or outdated. """
+        root = _paths.Workspace.get_root(table_path)
+        with self._lock:
+            tables = self._get_workspace(root)
+            record = tables.get(_get_table_key(table_path)) if tables else None
+        return _TableProps.from_record(record) if record else None
+
+    def put(self, table_path, props):
+        """ Stores the :class:`_TableProps` for *table_path* in memory. Call :func:`save` to write the store file. """
+        root = _paths.Workspace.get_root(table_path)
+        with self._lock:
+            tables = self._get_workspace(root)
+            if tables is None:
+                return
+            tables[_get_table_key(table_path)] = props.to_record()
+            self._dirty = True
+
+    def save(self):
+        """
+        Writes the store file if it has changed. A uniquely named temporary file is written first,
+        so that the store is never half-written and concurrent processes do not overwrite each other's file.
+        Failures are reported as a warning, because the store is only a cache.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = _json.dumps(self._data)
+            self._dirty = False
+
+        dirname, filename = _os.path.split(self._path)
+        tmp_path = None
+        try:
+            if not _os.path.isdir(dirname):
+                _os.makedirs(dirname)
+            fd, tmp_path = _tempfile.mkstemp('.tmp', filename + '.', dirname)
+            with _os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if _os.path.exists(self._path):
+                # On Windows, os.rename() does not overwrite existing files
+                _os.remove(self._path)
+            _os.rename(tmp_path, self._path)
+        except (IOError, OSError) as e:
+            _warn('Failed to save table store {}: {}'.format(_tu.to_repr(self._path), e))
+            if tmp_path and _os.path.isfile(tmp_path):
+                _os.remove(tmp_path)
+
+
+def _serialize_entries(entries, workers):
+    """
+    Yields the given :class:`_Entry` records, after their raw shapes (if any) have been serialized
+    by a pool of *workers* processes (see :func:`gntools.common.geometry.serialize_many`).
+    """
+    pending = _deque()
+
+    def get_shapes():
+        for entry in entries:
+            pending.append(entry)
+            if entry.shape is not None:
+                yield entry.shape
+
+    for geometry in _geometry.serialize_many(get_shapes(), workers, _FRAGMENT_BATCH, strict=False):
+        entry = pending.popleft()
+        while entry.shape is None:
+            yield entry
+            entry = pending.popleft()
+        entry.serialize(geometry)
+        yield entry
+    while pending:
+        yield pending.popleft()
+
+
+def _read_entry(element, geometry=False):
+    """ Returns an :class:`_Entry` record for the given <Entry> element. Reads the geometry if *geometry* is True. """
+    message = element.get(_ATTR_MSG)
+    dataid = element.find('{}/{}/{}'.format(_TAG_OBJECT, _TAG_FEATURE, _TAG_DATAID))
+    if dataid is not None:
+        dataid = tuple(dataid.get(a) for a in (_ATTR_CONN, _ATTR_TABLE, _ATTR_FIELD, _ATTR_VALUE))
+    if geometry:
+        geometry = element.find('{}/{}'.format(_TAG_OBJECT, _TAG_GEOMETRY))
+        if geometry is not None:
+            # Remove the indentation, so that the geometry can be written as-is
+            for child in geometry.iter():
+                child.text = child.tail = None
+            geometry = _Xml.tostring(geometry)
+    return _Entry(int(element.get(_ATTR_MSGTYPE)), None if message is None else _tu.to_unicode(message),
+                  element.get(_ATTR_DATE), dataid, geometry or None)
+
+
+def _escape_attr(value):
+    """ Escapes an XML attribute value (unicode) in the same way as ElementTree does. """
+    for char, entity in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), (_const.CHAR_LF, '&#10;')):
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+def _format_attrs(attrs):
+    """ Returns the (unicode) XML attributes string for the given dictionary, sorted by name like ElementTree does. """
+    if not attrs:
+        return u''
+    return u''.join(u' {}="{}"'.format(k, _escape_attr(_tu.to_unicode(v))) for k, v in sorted(attrs.iteritems()))
+
+
+def _is_file_like(output):
+    """ Returns ``True`` if *output* is a writable file-like object instead of a path. """
+    return not isinstance(output, basestring) and hasattr(output, 'write')
+
+
+def _spacing(level, pretty=True):
+    """ Returns the line break and indentation that should precede an element at the given *level*. """
+    return _const.CHAR_LF + level * _const.CHAR_TAB if pretty else _const.CHAR_EMPTY
+
+
+def _write_indented(write, xml, level=0):
+    """
+    Writes the (unicode) text of a serialized XML element without whitespace (e.g. a GEONIS XML geometry)
+    using the *write* function, where each element is put on a new line and indented by tabs,
+    starting at the given *level*. The text is not parsed: the tags are simply copied.
+    Note that element text is not supported (GEONIS Protocol elements only have attributes).
+    """
+    for tag in _TAG_PATTERN.findall(_tu.to_unicode(xml)):
+        if tag[1] == '/':
+            level -= 1
+            write(_spacing(level) + tag)
+        elif tag[-2] == '/':
+            write(_spacing(level) + tag)
+        else:
+            write(_spacing(level) + tag)
+            level += 1
+
+
+class _Entry(object):
+    """
+    Compact record that holds the data of a single protocol <Entry>.
+    The XML elements for the entry are only built when the protocol is written.
+
+    :param msg_type:    The message type (warning, error, etc.).
+    :param message:     The (unicode) message. ``None`` for blank lines.
+    :param date:        The Delphi-formatted date string.
+    :param data_id:     An optional tuple of (connection, table, GlobalID field, GlobalID) values.
+    :param geometry:    An optional serialized GEONIS XML geometry string.
+    :param shape:       An optional raw shape (e.g. EsriJSON string) that has not been serialized yet.
+                        The shape is only serialized when the entry is written (see :func:`serialize`),
+                        but it is kept afterwards, so that sinks can convert it to other formats.
+    """
+
+    __slots__ = ('msg_type', 'message', 'date', 'data_id', 'geometry', 'shape')
+
+    def __init__(self, msg_type, message, date, data_id=None, geometry=None, shape=None):
+        self.msg_type = msg_type
+        self.message = message
+        self.date = date
+        self.data_id = data_id
+        self.geometry = geometry
+        self.shape = shape
+
+    def __reduce__(self):
+        return _Entry, (self.msg_type, self.message, self.date, self.data_id, self.geometry, self.shape)
+
+    def serialize(self, geometry=None):
+        """
+        Serializes the raw shape of the entry (if any) into a GEONIS XML geometry string.
+        If the shape cannot be serialized, a warning is shown and the entry will not have a geometry.
+
+        :param geometry:    An optional geometry string (or error) that has already been serialized elsewhere
+                            (e.g. in a worker process) for the raw shape of this entry.
+        """
+        if self.shape is None or self.geometry is not None:
+            return
+        if geometry is None:
+            geometry = _geometry.try_serialize(self.shape)
+        if isinstance(geometry, Exception):
+            _warn('Omitted geometry of protocol entry {!r}: {}'.format(self.message, geometry))
+            geometry = _const.CHAR_EMPTY
+        self.geometry = geometry
+
+    def to_xml(self, pretty=True):
+        """
+        Returns the (unicode) XML text of the <Entry> element (and its children) for the current record.
+
+        :param pretty:  If ``True`` (default), the elements are put on separate lines and indented (as <Entry> child).
+        :rtype:         unicode
+        """
+        entry_attrs = {
+            _ATTR_MSGTYPE:  str(self.msg_type),
+            _ATTR_DATE:     self.date,
+            _ATTR_LASTMOD:  str(0),             # For a new Protocol, this will always be 0
+            _ATTR_READONLY: str(False).lower()  # Will this value ever be something else?
+        }
+        if self.message is not None:
+            entry_attrs[_ATTR_MSG] = self.message
+
+        indented = None
+        if pretty and self.shape is not None and self.geometry is None:
+            # Serialize the raw shape with indentation right away, instead of indenting the serialized text
+            indented = _geometry.try_serialize(self.shape, 3)
+            if isinstance(indented, Exception):
+                self.serialize(indented)
+                indented = None
+        else:
+            self.serialize()
+
+        parts = [u'{}<{}{}>'.format(_spacing(1, pretty), _TAG_ENTRY, _format_attrs(entry_attrs))]
+        if self.data_id or self.geometry or indented:
+            parts.append(u'{}<{}>'.format(_spacing(2, pretty), _TAG_OBJECT))
+            if self.data_id:
+                dataid_attrs = dict(zip((_ATTR_CONN, _ATTR_TABLE, _ATTR_FIELD, _ATTR_VALUE), self.data_id))
+                parts.append(u'{}<{}>'.format(_spacing(3, pretty), _TAG_FEATURE))
+                parts.append(u'{}<{}{} />'.format(_spacing(4, pretty), _TAG_DATAID, _format_attrs(dataid_attrs)))
+                parts.append(u'{}</{}>'.format(_spacing(3, pretty), _TAG_FEATURE))
+            if indented:
+                parts.append(_tu.to_unicode(indented))
+            elif self.geometry and pretty:
+                _write_indented(parts.append, self.geometry, 3)
+            elif self.geometry:
+                # The serialized geometry can be written as-is if no indentation is required
+                parts.append(_tu.to_unicode(self.geometry))
+            parts.append(u'{}</{}>'.format(_spacing(2, pretty), _TAG_OBJECT))
+        else:
+            parts.append(u'{}<{} />'.format(_spacing(2, pretty), _TAG_OBJECT))
+        parts.append(u'{}<{} />'.format(_spacing(2, pretty), _TAG_CFUNC))
+        parts.append(u'{}</{}>'.format(_spacing(1, pretty), _TAG_ENTRY))
+        return u''.join(parts)
+
+
+class _FragmentWriter(object):
+    """
+    Writes :class:`_Entry` records one by one to a protocol fragment file (pickled batches of records).
+
+    :param fragment_path:   The path of the fragment file to write.
+    """
+
+    __slots__ = ('_file', '_batch', 'count')
+
+    def __init__(self, fragment_path):
+        self._file = open(fragment_path, 'wb')
+        self._batch = []
+        self.count = 0
+
+    def _dump(self):
+        """ Pickles the current batch of records to the fragment file. """
+        _pickle.dump(self._batch, self._file, _pickle.HIGHEST_PROTOCOL)
+        self.count += len(self._batch)
+        self._batch = []
+
+    def add(self, entry):
+        """ Adds an :class:`_Entry` record to the fragment. """
+        self._batch.append(entry)
+        if len(self._batch) == _FRAGMENT_BATCH:
+            self._dump()
+
+    def close(self):
+        """ Writes the remaining records and closes the fragment file. """
+        try:
+            if self._batch:
+                self._dump()
+        finally:
+            self._file.close()
+
+
+def _write_fragment(fragment_path, entries):
+    """
+    Writes an iterable of :class:`_Entry` records to a protocol fragment file (pickled batches of records).
+
+    :param fragment_path:   The path of the fragment file to write.
+    :param entries:         An iterable of :class:`_Entry` records.
+    :return:                The number of written entries.
+    """
+    writer = _FragmentWriter(fragment_path)
+    try:
+        for entry in entries:
+            writer.add(entry)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def _read_fragment(fragment_path, tolerant=False):
+    """
+    Generator that reads the :class:`_Entry` records from a protocol fragment file (or journal), one batch at a time.
+    If *tolerant* is ``True``, reading stops at the first batch that cannot be read (e.g. a truncated journal).
+    """
+    with open(fragment_path, 'rb') as f:
+        size = _os.fstat(f.fileno()).st_size
+        while True:
+            pos = f.tell()
+            try:
+                batch = _pickle.load(f)
+            except Exception as e:
+                if isinstance(e, EOFError) and pos == size:
+                    return
+                if not tolerant:
+                    raise
+                _warn('Stopped reading {} at a damaged batch: {!r}'.format(_tu.to_repr(fragment_path), e))
+                return
+            for entry in batch:
+                yield entry
+
+
+def _merge_by_date(*sources):
+    """
+    Performs a k-way merge of the given iterables of :class:`_Entry` records, ordered by their date attribute.
+    Each iterable must already be ordered by date. Entries with the same date keep their source order.
+    """
+    def keyed(source, i):
+        return ((entry.date, i, n, entry) for n, entry in enumerate(source))
+
+    queues = [keyed(source, i) for i, source in enumerate(sources)]
+    return (item[-1] for item in _heapq.merge(*queues))
+
+
+class _Journal(object):
+    """
+    Write-ahead journal for protocol entries, which can be used to recover a protocol after a crash.
+
+    Entries are collected and appended to the journal file as a pickled batch (in the same format as
+    a protocol fragment) every *every* entries or every *interval* seconds, whichever comes first.
+    Each batch is flushed to disk, so that a crash can only lose the entries of the last (incomplete) batch.
+    If an *interval* is set, a daemon thread commits the pending batch when it is due, even if no new entries
+    are logged in the meantime (e.g. because the process hangs in a long-running call).
+
+    :param journal_path:    The path to the journal file. An existing journal file will be overwritten.
+    :param every:           The number of entries per batch.
+    :param interval:        An optional maximum number of seconds between batches.
+    """
+
+    __slots__ = ('_path', '_file', '_batch', '_every', '_interval', '_last', '_lock', '_closed', '_timer')
+
+    def __init__(self, journal_path, every=1000, interval=None):
+        _vld.pass_if(every > 0, ValueError, 'Number of entries per journal batch must be a positive integer')
+        _vld.pass_if(interval is None or interval > 0, ValueError, 'Journal interval must be a positive number')
+        self._path = _os.path.realpath(journal_path.strip())
+        self._file = open(self._path, 'wb')
+        self._batch = []
+        self._every = every
+        self._interval = interval
+        self._last = _time.time()
+        self._lock = _threading.Lock()
+        self._closed = _threading.Event()
+        self._timer = None
+        if interval:
+            self._timer = _threading.Thread(target=self._run_timer, name='ProtocolJournal')
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def path(self):
+        """ Returns the full path to the journal file. """
+        return self._path
+
+    def _commit(self):
+        """ Appends the current batch to the journal file and makes sure that it is written to disk. """
+        if self._batch:
+            _pickle.dump(self._batch, self._file, _pickle.HIGHEST_PROTOCOL)
+            self._file.flush()
+            _os.fsync(self._file.fileno())
+            self._batch = []
+        self._last = _time.time()
+
+    def _run_timer(self):
+        """ Commits the pending batch every *interval* seconds (timer thread), until the journal is closed. """
+        delay = self._interval
+        while not self._closed.wait(delay):
+            with self._lock:
+                if self._file.closed:
+                    return
+                delay = self._last + self._interval - _time.time()
+                if delay <= 0:
+                    self._commit()
+                    delay = self._interval
+
+    def add(self, entry):
+        """ Adds an :class:`_Entry` record to the journal. The batch is committed if it is full or due. """
+        with self._lock:
+            if self._file.closed:
+                # The journal has been closed by a flush in the meantime
+                return
+            self._batch.append(entry)
+            if len(self._batch) >= self._every or (self._interval and _time.time() - self._last >= self._interval):
+                self._commit()
+
+    def close(self, remove=True):
+        """ Commits the last batch and closes the journal. If *remove* is ``True`` (default), the file is deleted. """
+        self._closed.set()
+        with self._lock:
+            if not remove:
+                self._commit()
+            self._file.close()
+            if remove:
+                _os.remove(self._path)
+
+
+class _DelphiClock(object):
+    """
+    Clock that produces the formatted Delphi timestamps for the protocol entries.
+
+    The Delphi epoch and UTC offset are added once to a base value, so that a timestamp only requires a division.
+    Timestamps are truncated to the clock resolution and never go back in time (even if the system clock does).
+    The formatted values of the most recent ticks are cached, but the cache never exceeds a fixed size.
+
+    :param resolution:  The resolution of the timestamps in seconds (default = 1 second).
+    :type resolution:   float, int
+    """
+
+    __slots__ = ('_base', '_resolution', '_last', '_cache', '_lock')
+
+    def __init__(self, resolution=_CLOCK_RESOLUTION):
+        # add Delphi epoch offset + UTC time offset (no DST) to the timestamps
+        self._base = abs(_DELPHI_EPOCH) + _TZ_OFFSET
+        self._last = 0
+        self._cache = {}
+        self._lock = _threading.Lock()
+        self.resolution = resolution
+
+    @property
+    def resolution(self):
+        """ Returns or sets the resolution (in seconds) of the timestamps. """
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        _vld.pass_if(isinstance(value, (int, float)) and value > 0, ValueError,
+                     'resolution must be a positive number of seconds')
+        with self._lock:
+            self._resolution = float(value)
+            self._cache.clear()
+
+    def format(self, timestamp):
+        """
+        Returns the formatted Delphi time (number of days since 1899/12/30) for a POSIX timestamp.
+
+        :param timestamp:   The number of seconds since the POSIX epoch.
+        :type timestamp:    float
+        :rtype:             str
+        """
+        tick = int(timestamp // self._resolution)
+        try:
+            return self._cache[tick]
+        except KeyError:
+            if len(self._cache) >= _CLOCK_CACHE_SIZE:
+                self._cache.clear()
+            value = self._cache[tick] = '{:.13f}'.format((self._base + tick * self._resolution) / _DAY_SECONDS)
+            return value
+
+    def now(self):
+        """ Returns the formatted Delphi time for the current moment. """
+        with self._lock:
+            self._last = timestamp = max(_time.time(), self._last)
+        return self.format(timestamp)
+
+
+class _Fingerprints(object):
+    """
+    Index of protocol entry fingerprints, which is used to suppress duplicate entries.
+
+    A fingerprint is a 64-bit hash of the message type, message, table and GlobalID of an entry,
+    so that the memory use per unique entry does not depend on the length of the message.
+    The fingerprints are kept in a ``set``, which takes about 60 to 100 bytes per unique entry.
+    """
+
+    __slots__ = ('_hashes', '_lock', 'suppressed')
+
+    def __init__(self):
+        self._hashes = set()
+        self._lock = _threading.Lock()
+        self.suppressed = 0
+
+    @staticmethod
+    def _get_hash(msg_type, message, table, global_id):
+        """
+        Returns the 64-bit (integer) fingerprint for the given entry values.
+        The message is normalized like the entry message (see :func:`_get_message`), so that e.g. an empty string
+        and ``None`` have the same fingerprint.
+        """
+        message = _get_message(message) or u''
+        return _hash64(u'{}\0{}\0{}\0{}'.format(msg_type, message, _get_table_key(table), global_id))
+
+    def add(self, msg_type, message, table, global_id):
+        """
+        Adds the fingerprint of an entry to the index.
+        Returns ``False`` (and increments the :attr:`suppressed` count) if the fingerprint was already present.
+
+        :rtype: bool
+        """
+        fingerprint = self._get_hash(msg_type, message, table, global_id)
+        with self._lock:
+            if fingerprint in self._hashes:
+                self.suppressed += 1
+                return False
+            self._hashes.add(fingerprint)
+        return True
+
+    def clear(self):
+        """ Removes all fingerprints from the index (the :attr:`suppressed` count is kept). """
+        with self._lock:
+            self._hashes.clear()
+
+
+class _Limit(object):
+    """
+    Entry cap for a category of protocol entries, defined by a message type and/or a message pattern.
+
+    Up to *limit* entries of the category are logged and the remaining ones are only counted.
+    When *sample* is ``True``, the entries of the category are kept in a reservoir instead,
+    so that a random (but representative) subset of *limit* entries is logged when the protocol is written.
+
+    :param limit:       The maximum number of entries of the category.
+    :param msg_type:    The message type value of the category or ``None`` for any type.
+    :param pattern:     A regular expression that must match the start of the message or ``None`` for any message.
+    :param sample:      If ``True``, reservoir sampling is used instead of logging the first *limit* entries.
+    """
+
+    __slots__ = ('limit', 'msg_type', 'pattern', 'sample', 'count', '_reservoir', '_random', '_lock')
+
+    def __init__(self, limit, msg_type=None, pattern=None, sample=False):
+        self.limit = limit
+        self.msg_type = msg_type
+        self.pattern = pattern
+        self.sample = sample
+        self.count = 0
+        self._reservoir = []
+        self._random = _random.Random()
+        self._lock = _threading.Lock()
+
+    @property
+    def key(self):
+        """ Returns the (message type, message pattern string) tuple that identifies the category. """
+        return self.msg_type, None if self.pattern is None else self.pattern.pattern
+
+    def matches(self, msg_type, message):
+        """ Returns ``True`` if an entry with the given message type and message belongs to the category. """
+        if self.msg_type is not None and msg_type != self.msg_type:
+            return False
+        return self.pattern is None or bool(self.pattern.match(_tu.to_unicode(message or _const.CHAR_EMPTY)))
+
+    def add(self, make_entry):
+        """
+        Counts an entry of the category. The entry is only created (using the *make_entry* function)
+        if it will be logged. Returns the :class:`_Entry` if it should be logged right away,
+        or ``None`` if it has been dropped or has been kept in the sample reservoir.
+        """
+        with self._lock:
+            self.count += 1
+            if not self.sample:
+                return make_entry() if self.count <= self.limit else None
+            if self.count <= self.limit:
+                self._reservoir.append((self.count, make_entry()))
+            else:
+                i = self._random.randrange(self.count)
+                if i < self.limit:
+                    self._reservoir[i] = (self.count, make_entry())
+        return None
+
+    def pop(self):
+        """
+        Returns a tuple of (sampled entries, summary message) and resets the category count and sample.
+        The sampled entries are ordered by date. The summary message is ``None`` if no entries were dropped.
+        """
+        with self._lock:
+            reservoir, self._reservoir = self._reservoir, []
+            dropped, self.count = max(0, self.count - self.limit), 0
+        summary = None
+        if dropped:
+            summary = _LIMIT_SUMMARY.format(dropped, self.limit,
+                                            _LIMIT_ANY if self.msg_type is None else self.msg_type,
+                                            _LIMIT_ANY if self.pattern is None else repr(self.pattern.pattern))
+        return [entry for _, entry in sorted(reservoir)], summary
+
+
+class _ThreadBuffer(object):
+    """
+    Entry buffer for a single thread, which is used when the :class:`Logger` runs in concurrent mode.
+    Entries are stored as (sequence number, entry) tuples.
+
+    The lock is only acquired by the owning thread and by :func:`Logger.flush`, so it is (practically) uncontended.
+    Once the buffer has been closed by a flush, the owning thread must register a new buffer.
+    """
+
+    __slots__ = ('lock', 'entries', 'closed')
+
+    def __init__(self, entries=None):
+        self.lock = _threading.Lock()
+        self.entries = entries or []
+        self.closed = False
+
+
+class _IndexWriter(object):
+    """
+    Writes the sidecar index file of a protocol, which holds a fixed-size record for each <Entry>:
+    its byte offset and length, message type, table name CRC-32 and GlobalID hash (see :class:`ProtocolIndex`).
+    The offsets are relative to the end of the root start tag (the *base* offset), which is stored in the header.
+
+    :param xml_path:    The full path to the protocol XML for which the index should be written.
+    """
+
+    __slots__ = ('_path', '_file')
+
+    def __init__(self, xml_path):
+        self._path = xml_path + _INDEX_SUFFIX
+        self._file = open(self._path, 'wb')
+        self._file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, 0, 0))
+
+    @property
+    def path(self):
+        """ Returns the full path to the index file. """
+        return self._path
+
+    def add(self, offset, length, entry):
+        """ Writes the index record for an :class:`_Entry` that was written at the given (relative) offset. """
+        table_hash = guid_hash = 0
+        if entry.data_id:
+            table_hash, guid_hash = _get_table_hash(entry.data_id[1]), _get_guid_hash(entry.data_id[3])
+        self._file.write(_INDEX_RECORD.pack(offset, length, entry.msg_type, table_hash, guid_hash))
+
+    def close(self, base, size):
+        """ Writes the base offset and the size of the protocol XML to the header and closes the index file. """
+        try:
+            self._file.seek(0)
+            self._file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, base, size))
+        finally:
+            self._file.close()
+
+
+class _ProtocolStream(object):
+    """
+    Writes a GEONIS XML protocol to a file *while* entries are being logged, instead of buffering them.
+
+    Because the project root attributes are usually unknown until the protocol is closed,
+    a fixed amount of whitespace is reserved in the root start tag, which is overwritten in :func:`close`.
+    The attributes and the end of the start tag are written at the start of the reserved space,
+    so that the remaining whitespace ends up after the start tag (where it is ignored) instead of inside of it.
+    If the attributes do not fit, the file is rewritten once (by copying it in chunks).
+
+    :param output_path:     The full path to the output protocol XML that should be written.
+    :param project_path:    The full path to the GEONIS project (optional, if it's already known).
+    :param encoding:        Optional encoding to use for the protocol file (default = ISO-8859-1).
+    :param pretty:          If ``True`` (default), entries are written on separate lines and indented by tabs.
+                            If ``False``, no whitespace is written at all (for machine consumers).
+    :param append:          If ``True`` and the output protocol already exists, the entries are appended to it.
+                            The existing protocol is not parsed: the closing root tag is simply overwritten.
+                            The project attributes and the encoding of the existing protocol are kept.
+    :param index:           If ``True``, a sidecar index file (see :class:`ProtocolIndex`) is written as well.
+                            This is not supported in combination with *append*.
+
+    The *output_path* can also be a writable file-like object, in which case the encoded XML is written to it directly.
+    The *project_path* is then required (nothing is overwritten afterwards) and *append* and *index* are not supported.
+    The file-like object is not closed by :func:`close`.
+    """
+
+    __slots__ = ('_path', '_file', '_encoding', '_pretty', '_attr_pos', '_has_project', '_count',
+                 '_index', '_base', '_pos', '_owned')
+
+    def __init__(self, output_path, project_path=None, encoding=None, pretty=True, append=False, index=False):
+        self._encoding = encoding or _GNLOG_ENCODING
+        self._pretty = pretty
+        self._count = 0
+        self._index = None
+        self._owned = not _is_file_like(output_path)
+
+        if not self._owned:
+            _vld.raise_if(append or index, ValueError,
+                          'Cannot append or write an index when writing a protocol to a file-like object')
+            _vld.pass_if(project_path, ValueError,
+                         'A project path is required to write a protocol to a file-like object')
+            self._path = getattr(output_path, 'name', None)
+            self._file = output_path
+            self._has_project = True
+            self._write_header(self._get_project_attrs(project_path))
+            return
+
+        self._path = _os.path.realpath(output_path.strip())
+
+        if append and _os.path.isfile(self._path):
+            _vld.raise_if(index, ValueError, 'Cannot write an index when appending to an existing protocol')
+            self._has_project = True
+            self._file = open(self._path, 'r+b')
+            try:
+                self._seek_root_end()
+            except Exception:
+                self._file.close()
+                raise
+            return
+
+        dirname = _os.path.dirname(self._path)
+        if not _os.path.isdir(dirname):
+            _os.makedirs(dirname)
+
+        project_attrs = None if project_path is None else self._get_project_attrs(project_path)
+        self._has_project = project_attrs is not None
+        self._file = open(self._path, 'wb')
+        self._write_header(project_attrs)
+        if index:
+            self._base = self._pos = self._file.tell()
+            self._index = _IndexWriter(self._path)
+
+    def _seek_root_end(self):
+        """
+        Reads the encoding of the existing protocol and positions the file at its closing root tag
+        (or at the end of a self-closing root tag), so that new entries can be appended.
+        Only the first and last few kilobytes of the file are read.
+        """
+        match = _ENCODING_PATTERN.match(self._file.read(_APPEND_SCAN))
+        self._encoding = match.group(1) if match else 'utf-8'
+
+        self._file.seek(0, _os.SEEK_END)
+        size = self._file.tell()
+        offset = max(0, size - _APPEND_SCAN)
+        self._file.seek(offset)
+        tail = self._file.read().rstrip()
+
+        end_tag = '</{}>'.format(_TAG_ROOT)
+        if tail.endswith(end_tag):
+            # Position the file before the closing tag (and the whitespace that precedes it)
+            self._file.seek(offset + len(tail[:-len(end_tag)].rstrip()))
+        elif tail.endswith('/>') and '<{}'.format(_TAG_ROOT) in tail[tail.rfind('<'):]:
+            # The root element has no entries: turn it into a start tag
+            self._file.seek(offset + len(tail) - 2)
+            self._file.write('>')
+        else:
+            raise ValueError('{} does not end with a GEONIS Protocol root element'.format(_tu.to_repr(self._path)))
+
+    def _encode(self, text):
+        return _tu.to_unicode(text).encode(self._encoding, 'xmlcharrefreplace')
+
+    def _get_project_attrs(self, project_path):
+        """ Returns the encoded root project attributes string for the given *project_path*. """
+        prj_dir, prj_name = ProtocolWriter._split_prj(project_path)
+        _vld.pass_if(prj_dir and prj_name, ValueError, 'Failed to retrieve project directory and name')
+
+        return self._encode(_format_attrs({_ATTR_PRJNAME: prj_name, _ATTR_PRJROOT: prj_dir}))
+
+    def _write_header(self, project_attrs):
+        """ Writes the XML declaration and root start tag (or a placeholder for the project attributes). """
+        self._file.write("<?xml version='1.0' encoding='{}'?>{}<{}".format(self._encoding, _const.CHAR_LF, _TAG_ROOT))
+        if project_attrs:
+            self._file.write(project_attrs)
+        else:
+            self._attr_pos = self._file.tell()
+            self._file.write(_const.CHAR_SPACE * _STREAM_RESERVE)
+        self._file.write('>')
+
+    def _rewrite_header(self, project_attrs):
+        """ Copies the protocol to a new file with the given *project_attrs* in place of the reserved whitespace. """
+        self._file.close()
+        tmp_path = self._path + '.tmp'
+        with open(self._path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(src.read(self._attr_pos))
+            dst.write(project_attrs)
+            src.seek(_STREAM_RESERVE, _os.SEEK_CUR)
+            _shutil.copyfileobj(src, dst)
+        _os.remove(self._path)
+        _os.rename(tmp_path, self._path)
+
+    @property
+    def path(self):
+        """ Returns the full path to the protocol XML that is being written. """
+        return self._path
+
+    @property
+    def count(self):
+        """ Returns the number of entries that have been written to the protocol so far. """
+        return self._count
+
+    @property
+    def index_path(self):
+        """ Returns the full path to the sidecar index file or ``None`` if no index is written. """
+        return self._index.path if self._index else None
+
+    @property
+    def size(self):
+        """ Returns the number of bytes that have been written to the protocol so far. """
+        return self._file.tell()
+
+    def write(self, entry):
+        """ Writes an <Entry> element (and its children) for the given :class:`_Entry` to the protocol file. """
+        data = entry.to_xml(self._pretty).encode(self._encoding, 'xmlcharrefreplace')
+        self._file.write(data)
+        self._count += 1
+        if self._index:
+            # The index points to the <Entry> element itself, without the preceding whitespace
+            length = len(data.lstrip())
+            self._index.add(self._pos + len(data) - length - self._base, length, entry)
+            self._pos += len(data)
+
+    def close(self, project_path):
+        """
+        Writes the closing root tag, sets the project attributes (if not set yet) and closes the protocol file.
+
+        :param project_path:    The full path to the GEONIS project to which the protocol applies.
+        """
+        if not self._owned:
+            # Do not truncate or close a file-like object that was passed in by the caller
+            self._file.write('{}</{}>{}'.format(_spacing(0, self._pretty), _TAG_ROOT, _spacing(0, self._pretty)))
+            if hasattr(self._file, 'flush'):
+                self._file.flush()
+            return
+        try:
+            self._file.write('{}</{}>{}'.format(_spacing(0, self._pretty), _TAG_ROOT, _spacing(0, self._pretty)))
+            self._file.truncate()
+            if self._has_project:
+                return
+            project_attrs = self._get_project_attrs(project_path)
+            if len(project_attrs) > _STREAM_RESERVE:
+                self._rewrite_header(project_attrs)
+                if self._index:
+                    self._base += len(project_attrs) - _STREAM_RESERVE
+                return
+            # Close the start tag right after the attributes: the remaining reserve is whitespace after the tag
+            self._file.seek(self._attr_pos)
+            self._file.write(project_attrs + '>' + _const.CHAR_SPACE * (_STREAM_RESERVE - len(project_attrs)))
+        finally:
+            self._file.close()
+            if self._index:
+                self._index.close(self._base, _os.path.getsize(self._path))
+
+
+class _Tee(object):
+    """
+    Writes protocol entries to a protocol stream and to additional sinks (see :func:`Logger.add_sink`) at once.
+    The sinks receive each entry before the protocol stream does.
+
+    :param stream:  The :class:`_ProtocolStream` or :class:`_RotatingStream` to which the protocol is written.
+    :param sinks:   An iterable of sinks, which should have a *write(entry)* and a *close(project_path)* method.
+    """
+
+    __slots__ = ('stream', 'sinks')
+
+    def __init__(self, stream, sinks):
+        self.stream = stream
+        self.sinks = tuple(sinks)
+
+    @property
+    def path(self):
+        """ Returns the full path to the protocol XML that is being written. """
+        return self.stream.path
+
+    @property
+    def count(self):
+        """ Returns the number of entries that have been written to the protocol so far. """
+        return self.stream.count
+
+    def write(self, entry):
+        """ Writes the given :class:`_Entry` to all sinks and to the protocol stream. """
+        for sink in self.sinks:
+            sink.write(entry)
+        self.stream.write(entry)
+
+    def close(self, project_path):
+        """ Closes the protocol stream and all sinks. """
+        try:
+            self.stream.close(project_path)
+        finally:
+            for sink in self.sinks:
+                sink.close(project_path)
+
+
+class _LineSink(object):
+    """
+    Base class for the line-oriented protocol sinks, which write one line per protocol entry.
+
+    :param output_path: The full path to the output file.
+    :param geometry:    The format of the geometry value: 'esrijson' (default), 'wkt', 'xml' (GEONIS XML) or ``None``.
+    """
+
+    __slots__ = ('_path', '_file', '_geometry', '_count')
+
+    def __init__(self, output_path, geometry=_SINK_ESRIJSON):
+        _vld.pass_if(geometry in (None, _SINK_ESRIJSON, _SINK_WKT, _SINK_XML), ValueError,
+                     'geometry must be {!r}, {!r}, {!r} or None'.format(_SINK_ESRIJSON, _SINK_WKT, _SINK_XML))
+        self._path = _os.path.realpath(output_path.strip())
+        self._geometry = geometry
+        self._count = 0
+
+        dirname = _os.path.dirname(self._path)
+        if not _os.path.isdir(dirname):
+            _os.makedirs(dirname)
+        self._file = open(self._path, 'wb')
+
+    def _get_geometry(self, entry):
+        """ Returns the geometry of the entry in the format of the sink or ``None`` if it is not available. """
+        if not self._geometry:
+            return None
+        if self._geometry == _SINK_XML:
+            entry.serialize()
+            return entry.geometry or None
+        if entry.shape is None:
+            # Entries that have been read from an existing protocol only have a GEONIS XML geometry
+            return None
+        try:
+            if self._geometry == _SINK_WKT:
+                return _geometry.to_wkt(entry.shape)
+            return _geometry.to_esri_json(entry.shape)
+        except _geometry.SERIALIZE_ERRORS as e:
+            _warn('Omitted geometry of protocol entry {!r}: {}'.format(entry.message, e))
+            return None
+
+    def _get_values(self, entry):
+        """ Returns the field values (see _SINK_FIELDS) for the given entry. """
+        values = [entry.msg_type, entry.message, entry.date]
+        values.extend(None if v is None else _tu.to_unicode(v) for v in entry.data_id or (None, None, None, None))
+        values.append(self._get_geometry(entry))
+        return values
+
+    def _write_values(self, values):
+        """ Writes a line with the given field values to the output file. """
+        raise NotImplementedError
+
+    @property
+    def path(self):
+        """ Returns the full path to the output file. """
+        return self._path
+
+    @property
+    def count(self):
+        """ Returns the number of entries that have been written so far. """
+        return self._count
+
+    def write(self, entry):
+        """ Writes a line for the given protocol entry. """
+        self._write_values(self._get_values(entry))
+        self._count += 1
+
+    def close(self, project_path=None):
+        """ Closes the output file. The *project_path* is ignored, because line-oriented formats have no header. """
+        self._file.close()
+
+
+class JsonLinesSink(_LineSink):
+    """
+    JsonLinesSink(output_path, {geometry})
+
+    Protocol sink that writes each protocol entry as a JSON object on a separate line (UTF-8 encoded).
+    The object keys are the same as the XML attribute names of the GEONIS Protocol (e.g. 'messagetype', 'tbl').
+    Use :func:`Logger.add_sink` to write a JSON Lines file along with the GEONIS Protocol XML.
+
+    **Params:**
+
+    -   **output_path** (str, unicode):
+
+        The full path to the output JSON Lines file.
+
+    **Keyword params:**
+
+    -   **geometry** (str):
+
+        The format of the geometry value: 'esrijson' (default, as JSON object), 'wkt', 'xml' or ``None``.
+    """
+
+    __slots__ = ()
+
+    def _write_values(self, values):
+        line = _json.dumps(_ODict(_izip(_SINK_FIELDS, values)), ensure_ascii=False)
+        self._file.write(_tu.to_unicode(line).encode('utf-8') + _const.CHAR_LF)
+
+
+class CsvSink(_LineSink):
+    """
+    CsvSink(output_path, {geometry}, {delimiter})
+
+    Protocol sink that writes each protocol entry as a row in a (UTF-8 encoded) CSV file with a header row.
+    The column names are the same as the XML attribute names of the GEONIS Protocol (e.g. 'messagetype', 'tbl').
+    Use :func:`Logger.add_sink` to write a CSV file along with the GEONIS Protocol XML.
+
+    **Params:**
+
+    -   **output_path** (str, unicode):
+
+        The full path to the output CSV file.
+
+    **Keyword params:**
+
+    -   **geometry** (str):
+
+        The format of the geometry value: 'esrijson' (default, as JSON string), 'wkt', 'xml' or ``None``.
+
+    -   **delimiter** (str):
+
+        The column delimiter. Defaults to a comma.
+    """
+
+    __slots__ = ('_writer', )
+
+    def __init__(self, output_path, geometry=_SINK_ESRIJSON, delimiter=_const.CHAR_COMMA):
+        super(CsvSink, self).__init__(output_path, geometry)
+        self._writer = _csv.writer(self._file, delimiter=delimiter, lineterminator=_const.CHAR_LF)
+        self._writer.writerow(_SINK_FIELDS)
+
+    def _write_values(self, values):
+        if isinstance(values[-1], dict):
+            values[-1] = _json.dumps(values[-1])
+        self._writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in values])
+
+
+class _RotatingStream(object):
+    """
+    Writes a GEONIS XML protocol as multiple numbered part files (e.g. *protocol_001.xml*, *protocol_002.xml*),
+    starting a new part when the current one has reached the maximum number of entries or bytes.
+    When the stream is closed, an index file (e.g. *protocol_parts.xml*) is written, which lists all parts.
+
+    Because each part must be a complete protocol, the project path must be known up front.
+
+    :param output_path:     The full path to the output protocol XML from which the part file names are derived.
+    :param project_path:    The full path to the GEONIS project to which the protocol applies.
+    :param encoding:        Optional encoding to use for the protocol files (default = ISO-8859-1).
+    :param pretty:          If ``True`` (default), entries are written on separate lines and indented by tabs.
+    :param max_entries:     The maximum number of entries per part (optional).
+    :param max_bytes:       The (approximate) maximum size of a part in bytes (optional).
+    :param index:           If ``True``, a sidecar index file is written for each part.
+    """
+
+    __slots__ = ('_path', '_project', '_encoding', '_pretty', '_max_entries', '_max_bytes', '_part', '_parts',
+                 '_index')
+
+    def __init__(self, output_path, project_path, encoding=None, pretty=True, max_entries=None, max_bytes=None,
+                 index=False):
+        _vld.pass_if(max_entries or max_bytes, ValueError, 'Specify max_entries and/or max_bytes to rotate protocols')
+        self._path = _os.path.realpath(output_path.strip())
+        self._project = project_path
+        self._encoding = encoding
+        self._pretty = pretty
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._part = None
+        self._parts = []
+        self._index = index
+
+        dirname = _os.path.dirname(self._path)
+        if not _os.path.isdir(dirname):
+            _os.makedirs(dirname)
+
+        # Validate the project path now, so that the user does not find out after the first part has been written
+        ProtocolWriter._split_prj(project_path)
+
+    def _get_path(self, suffix):
+        """ Returns the output path with the given *suffix* inserted before the file extension. """
+        base, ext = _os.path.splitext(self._path)
+        return base + suffix + ext
+
+    def _is_full(self):
+        """ Returns ``True`` if the current part has reached its maximum number of entries or bytes. """
+        return ((self._max_entries and self._part.count >= self._max_entries) or
+                (self._max_bytes and self._part.size >= self._max_bytes))
+
+    def _close_part(self):
+        """ Closes the current part (if any) and adds it to the list of parts. """
+        if not self._part:
+            return
+        self._part.close(self._project)
+        self._parts.append((_os.path.basename(self._part.path), self._part.count))
+        self._part = None
+
+    @property
+    def path(self):
+        """ Returns the full path to the index file that lists all protocol parts. """
+        return self._get_path(_PARTS_SUFFIX)
+
+    @property
+    def parts(self):
+        """ Returns a list of (file name, number of entries) tuples for all parts that have been completed. """
+        return list(self._parts)
+
+    @property
+    def count(self):
+        """ Returns the number of entries that have been written to all parts so far. """
+        return sum(count for _, count in self._parts) + (self._part.count if self._part else 0)
+
+    def write(self, entry):
+        """ Writes an <Entry> for the given :class:`_Entry` to the current part. Starts a new part if required. """
+        if not self._part:
+            part_path = self._get_path(_PART_SUFFIX.format(len(self._parts) + 1))
+            self._part = _ProtocolStream(part_path, self._project, self._encoding, self._pretty, index=self._index)
+        self._part.write(entry)
+        if self._is_full():
+            self._close_part()
+
+    def close(self, project_path=None):
+        """
+        Closes the last part and writes the index file that lists all parts.
+        The project path has already been set on initialization, so *project_path* is ignored.
+        """
+        self._close_part()
+
+        encoding = self._encoding or _GNLOG_ENCODING
+        prj_dir, prj_name = ProtocolWriter._split_prj(self._project)
+        lines = [u"<?xml version='1.0' encoding='{}'?>".format(encoding),
+                 u'<{}{}>'.format(_TAG_PARTS, _format_attrs({_ATTR_PRJNAME: prj_name, _ATTR_PRJROOT: prj_dir}))]
+        lines.extend(u'{}<{}{} />'.format(_const.CHAR_TAB, _TAG_PART,
+                                          _format_attrs({_ATTR_FILE: name, _ATTR_ENTRIES: count}))
+                     for name, count in self._parts)
+        lines.append(u'</{}>'.format(_TAG_PARTS))
+        with open(self.path, 'wb') as f:
+            f.write((_const.CHAR_LF.join(lines) + _const.CHAR_LF).encode(encoding, 'xmlcharrefreplace'))
+
+
+# Default clock for the protocol entry timestamps (each ProtocolWriter has its own clock)
+_clock = _DelphiClock()
+
+
+class FlushHandle(object):
+    """
+    FlushHandle(output_path, func, *args)
+
+    Handle for a GEONIS Protocol that is being written by a background thread.
+    This object is returned by :func:`Logger.flush` if it was called with ``background=True``.
+
+    The background thread is not a daemon thread: the Python process will wait for the protocol to be written
+    before it exits.
+
+    **Params:**
+
+    -   **output_path** (str, unicode):
+
+        The full path to the output protocol XML that is being written.
 
+    -   **func** (function):
 
-def _get_delphi_time(time=None):
-    """
-    Gets the current time (optionally, for a given time) expressed as a formatted floating point string for Delphi.
+        The function that writes the protocol.
 
-    :param time:    A datetime object. When not set, :func:`now` is used.
-    :return:        A string-formatted floating point value, specifying the number of days since 1899/12/30.
-    :rtype:         str
-    """
-    global _time_cache
+    -   **args**:
 
-    if not time:
-        # get current local time if `time` was not specified
-        time = _dt.now()
-    elif not isinstance(time, _dt):
-        raise TypeError("'time' should be a datetime object or None")
+        The arguments for *func*.
+    """
 
-    time_key = repr(time)
+    __slots__ = ('_path', '_thread', '_error')
 
-    try:
-        # look if this time has already been calculated and return it
-        delphi_time = _time_cache[time_key]
-    except KeyError:
-        # time_key not found: convert datetime object to timestamp float
-        time = _mktime(time.timetuple())
+    def __init__(self, output_path, func, *args):
+        self._path = output_path
+        self._error = None
+        self._thread = _threading.Thread(target=self._run, args=(func, args))
+        self._thread.start()
 
-        # add Delphi epoch offset + UTC time offset (no DST) to timestamp and divide by seconds per day
-        delphi_time = '{:.13f}'.format((abs(_DELPHI_EPOCH) + _TZ_OFFSET + time) / _DAY_SECONDS)
-        _time_cache[time_key] = delphi_time
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            self._error = e
 
-    return delphi_time
+    @property
+    def path(self):
+        """ Returns the full path to the protocol XML that is being written. """
+        return self._path
 
+    @property
+    def done(self):
+        """ Returns ``True`` when the background thread has finished (successfully or not). """
+        return not self._thread.is_alive()
 
-class _TableProps(object):
-    """
-    Dataholder class for table properties (workspace path, table name, GlobalID field).
+    @property
+    def error(self):
+        """ Returns the exception that occurred while writing the protocol (or ``None`` if there was no error). """
+        return self._error
 
-    :param table_path:  The full path to the table or feature class for which the TableProps should be populated.
-    :type table_path:   str, unicode
-    """
-    def __init__(self, table_path):
-        # Extract the workspace root (Geodatabase) path from the table path
-        self.workspace = str(_paths.get_workspace(table_path, True))
+    def wait(self, timeout=None):
+        """
+        Waits until the protocol has been written (or until the timeout expires).
+        If the protocol failed to write, the error is raised again.
 
-        # Store the unqualified table name
-        self.table = _paths.unqualify(table_path)
+        :param timeout: An optional timeout in seconds. If not set, this function blocks until the protocol is written.
+        :type timeout:  float
+        :return:        ``True`` if the protocol has been written, ``False`` if the timeout expired.
+        :rtype:         bool
+        """
+        self._thread.join(timeout)
+        if not self.done:
+            return False
+        if self._error:
+            raise self._error
+        return True
 
-        # Store the GlobalID field name
-        self.globalid_field = _meta.Describe(table_path).globalIDFieldName or _const.FIELD_GLOBALID
+    join = wait
 
 
 class Feature(object):
@@ -159,35 +1591,25 @@ class Feature(object):
 
     def _get_workspace(self):
         """ Extracts a _TableProps object from *table_path* or reuses a memoized one. """
-        global _table_cache
-
-        table = _os.path.normpath(self._table).lower()
-        try:
-            # Get memoized table properties, if any
-            props = _table_cache[table]
-        except KeyError:
-            # Create new _TableProps object and store it
-            props = _TableProps(self._table)
-            _table_cache[table] = props
-        return props
+        return _get_table_props(self._table)
 
-    def _get_dataid_attrs(self):
-        """ Returns a dictionary of attributes that can be used to populate the <dataid> XML element. """
-        props = self._get_workspace()
-        return {
-            _ATTR_CONN:  props.workspace,
-            _ATTR_TABLE: props.table,
-            _ATTR_FIELD: self._gidfld or props.globalid_field,
-            _ATTR_VALUE: self.fid
-        }
-
-    def _add_geometry(self, parent_element):
-        """ Appends a <geometry> XML element for the current record to `parent_element`. """
+    def get_shape(self):
+        """
+        Returns the raw (unserialized) shape of the current Feature, or ``None`` if it has no shape.
+        Esri Geometry instances are returned as EsriJSON strings, so that they can be serialized later on.
+        """
         if not self._shape:
-            return
+            return None
+        return _geometry.get_shape(self._shape)
+
+    @property
+    def table(self):
+        """
+        Returns the path to the table or feature class of the current Feature.
 
-        xml_geom = _geometry.serialize(self._shape)
-        parent_element.append(xml_geom)
+        :rtype: str, unicode
+        """
+        return self._table
 
     @property
     def fid(self):
@@ -198,59 +1620,86 @@ class Feature(object):
         """
         return str(self._guid)
 
+    def get_dataid(self):
+        """
+        Returns a tuple of (connection, table, GlobalID field, GlobalID) values for the <dataid> XML element.
+
+        :rtype: tuple
+        """
+        props = self._get_workspace()
+        return props.workspace, props.table, self._gidfld or props.globalid_field, self.fid
+
     def write_elements(self, parent_element):
         """
-        Adds a <feature> XML element to the *parent_element* based on the current Feature values.
+        Adds a <feature> XML element (and a <geometry> element, if the Feature has a shape)
+        to the *parent_element* based on the current Feature values.
+
+        .. deprecated::         The protocol writers do not build XML elements anymore: logged features are
+                                written as text (see :func:`get_dataid` and :func:`get_shape`).
+                                This method will be removed in a future version.
 
         :param parent_element:  Element
         """
+        _warn('Feature.write_elements() is deprecated and will be removed in a future version', DeprecationWarning, 2)
         feature = _Xml.SubElement(parent_element, _TAG_FEATURE)
-        _Xml.SubElement(feature, _TAG_DATAID, self._get_dataid_attrs())
-        self._add_geometry(parent_element)
+        _Xml.SubElement(feature, _TAG_DATAID, dict(zip((_ATTR_CONN, _ATTR_TABLE, _ATTR_FIELD, _ATTR_VALUE),
+                                                       self.get_dataid())))
+        if self._shape:
+            parent_element.append(_geometry.serialize(self._shape))
 
 
-class Logger(object):
+class ProtocolWriter(object):
     """
-    Logger class to write GEONIS XML protocols (e.g. for validations, reporting etc.).
+    ProtocolWriter()
 
-    .. note::   Because Logger is a singleton, instantiating it multiple times will always refer to the same object.
-                The Logger stores an XML root element, to which all Logger instances write.
-                Once an instance has called the :func:`flush` method, the XML root element will be reset.
-                Calling :func:`flush` will set the project name and path and write out the XML file.
-                After this call, remaining Logger instances or new ones will simply write into a new XML root element.
-    """
+    Writer for a single GEONIS XML protocol (e.g. for validations, reporting etc.).
 
-    __slots__ = '_root',
-    __instance = None
+    Each ProtocolWriter has its own entry buffer, lock, limits and sinks, so that a single process can write
+    several protocols at once (e.g. one per project) without any cross-talk between them.
+    Entries are buffered as compact records: the XML is only built when the protocol is written.
+    Once :func:`flush` has been called, the entry buffer is reset and the writer can be reused for another protocol.
 
-    def __new__(cls):
+    For very large protocols, the writer can also be switched to a *streaming* mode by calling :func:`stream`.
+    In that mode, each entry is written to the output XML file as soon as it has been logged,
+    so that memory usage stays flat, no matter how many entries are written.
 
-        if cls.__instance is not None:
-            return cls.__instance
+    When the writer is used from multiple threads, call :func:`set_concurrent` first.
 
-        Logger.__instance = object.__new__(cls)
-        Logger.__instance._new_root()
-        return Logger.__instance
+    .. seealso::    :class:`Logger` for the process-wide (singleton) protocol writer.
+    """
 
-    @staticmethod
-    def _get_attrs(msg, msg_type):
+    __slots__ = ('_entries', '_stream', '_lock', '_local', '_buffers', '_counter', '_order', '_journal', '_workers',
+                 '_dedup', '_limits', '_sinks', '_clock')
+
+    def __init__(self):
+        self._stream = None
+        self._lock = _threading.RLock()
+        self._local = None
+        self._buffers = []
+        self._counter = _count()
+        self._order = _ORDER_DATE
+        self._journal = None
+        self._workers = 0
+        self._dedup = None
+        self._limits = []
+        self._sinks = []
+        self._clock = _DelphiClock()
+        self._new_buffer()
+
+    def _get_entry(self, msg, msg_type, gn_feature=None):
         """
-        Populates an Entry attribute dictionary and returns it.
+        Creates a compact :class:`_Entry` record and returns it.
         All Entries receive a date attribute, which is a Delphi-compatible floating point value.
 
         :param msg:         The message to set. When not specified, the attribute will be omitted (used for blank line).
         :param msg_type:    The message type (warning, error, etc.)
-        :return:            An keyword argument dictionary
+        :param gn_feature:  An optional feature to log in the <Object> node.
+        :rtype:             _Entry
         """
-        entry_attrs = {
-            _ATTR_MSGTYPE:  str(msg_type),
-            _ATTR_DATE:     _get_delphi_time(),
-            _ATTR_LASTMOD:  str(0),             # For a new Protocol, this will always be 0
-            _ATTR_READONLY: str(False).lower()  # Will this value ever be something else?
-        }
-        if msg not in (_const.CHAR_EMPTY, None):
-            entry_attrs[_ATTR_MSG] = _tu.to_unicode(msg) if isinstance(msg, str) else msg
-        return entry_attrs
+        msg = _get_message(msg)
+        if not gn_feature:
+            return _Entry(msg_type, msg, self._clock.now())
+        return _Entry(msg_type, msg, self._clock.now(), gn_feature.get_dataid(), shape=gn_feature.get_shape())
 
     @staticmethod
     def _split_prj(project_path):
@@ -264,78 +1713,175 @@ class Logger(object):
         # By adding an empty string, we ensure that a slash is added at the end of the path (= protocol spec)
         return _os.path.join(_os.path.realpath(prj_dir.strip()), _const.CHAR_EMPTY), prj_name
 
-    def _new_root(self):
+    def _new_buffer(self):
         """
-        (Re)sets the root element for the GEONIS XML Protocol file.
+        (Re)sets the entry buffer for the GEONIS XML Protocol file.
         """
-        self._root = _Xml.Element(_TAG_ROOT)
-
-    def _set_project(self, project_path):
-        """ Sets the root element attributes (project directory and name). """
-        prj_dir, prj_name = self._split_prj(project_path)
-
-        # Last check if both project settings are present
-        _vld.pass_if(prj_dir and prj_name, ValueError, 'Failed to retrieve project directory and name')
-
-        # Set root project attributes
-        self._root.set(_ATTR_PRJROOT, prj_dir)
-        self._root.set(_ATTR_PRJNAME, prj_name)
+        self._entries = []
+
+    def _get_thread_buffer(self):
+        """ Returns the (open) entry buffer for the current thread. A new buffer is registered if required. """
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or buf.closed:
+            buf = self._local.buffer = _ThreadBuffer()
+            with self._lock:
+                self._buffers.append(buf)
+        return buf
+
+    def _add(self, entry):
+        """ Adds an :class:`_Entry` record to the (thread) buffer or writes it to the protocol file. """
+        journal = self._journal
+        if journal:
+            journal.add(entry)
+
+        if self._local is None:
+            if self._stream:
+                self._stream.write(entry)
+            else:
+                self._entries.append(entry)
+            return
 
-    def _add_entry(self, msg, msg_type, gn_feature=None, function=None):
+        if self._stream:
+            with self._lock:
+                # Check again, because another thread may have ended the streaming mode in the meantime
+                if self._stream:
+                    self._stream.write(entry)
+                    return
+
+        while True:
+            # If a flush closed the buffer in the meantime, the loop will register a new one
+            buf = self._get_thread_buffer()
+            with buf.lock:
+                if not buf.closed:
+                    buf.entries.append((next(self._counter), entry))
+                    return
+
+    def _pop_entries(self):
         """
-        Adds an <Entry> node to the GEONIS XML root node.
-
-        :param msg:         The message to set. When not specified, the attribute will be omitted (used for blank line).
-        :param msg_type:    The message type (warning, error, etc.).
-        :param gn_feature:  An optional feature to log in the <Object> node.
-        :param function:    An optional custom function to log in the <CustomFunctions> node. Not supported yet.
+        Returns an iterable of all buffered :class:`_Entry` records and resets the buffer(s).
+        In concurrent mode, the thread buffers are merged in date order or submission order.
+        """
+        if self._local is None:
+            entries = self._entries
+            self._new_buffer()
+            return entries
+
+        with self._lock:
+            buffers, self._buffers = self._buffers, []
+        queues = []
+        for buf in buffers:
+            with buf.lock:
+                buf.closed = True
+            queues.append(buf.entries)
+
+        if self._order == _ORDER_DATE:
+            # Entries within a thread buffer are ordered by date already, so a k-way merge suffices
+            queues = [((entry.date, seq, entry) for seq, entry in q) for q in queues]
+        return (item[-1] for item in _heapq.merge(*queues))
+
+    def _get_limit(self, msg_type, message):
+        """ Returns the first :class:`_Limit` that applies to an entry or ``None`` if no limit applies. """
+        for limit in self._limits:
+            if limit.matches(msg_type, message):
+                return limit
+        return None
+
+    def _with_limits(self, entries):
         """
-        entry = _Xml.SubElement(self._root, _TAG_ENTRY, self._get_attrs(msg, msg_type))
-        self._add_object(entry, gn_feature)
-        self._add_function(entry, function)
+        Returns the given iterable of (date-ordered) :class:`_Entry` records, merged with the sampled entries
+        of all limits, followed by a summary entry for each limit for which entries have been dropped.
+        The limit counts and samples are reset.
+        """
+        if not self._limits:
+            return entries
+        samples, summaries = [], []
+        for limit in self._limits:
+            sample, summary = limit.pop()
+            samples.append(sample)
+            if summary:
+                summaries.append(self._get_entry(summary, _GNLOG_TYPE_WARNING))
+        return _chain(_merge_by_date(entries, *samples), summaries)
 
     @staticmethod
-    def _add_object(parent, gn_feature):
+    def _with_journal(journal, write_func):
         """
-        Adds an <Object> node to the specified parent (Entry) node.
-
-        :param parent:      The XML Element to which the SubElement should be added.
-        :param gn_feature:  A feature to add to the <Object> node. May be ``None``.
+        Returns a function that calls *write_func* and deletes the checkpoint *journal* once it has succeeded.
+        If *write_func* fails, the journal is kept, so that the protocol can still be recovered.
         """
-        obj = _Xml.SubElement(parent, _TAG_OBJECT)
-        if not gn_feature:
+        def write(*args, **kwargs):
+            try:
+                write_func(*args, **kwargs)
+            except Exception:
+                journal.close(remove=False)
+                raise
+            journal.close()
+        return write
+
+    @staticmethod
+    def _close_stream(stream, xml_path, project_path):
+        """ Finalizes the given :class:`_ProtocolStream` and moves the XML file to *xml_path* (if it differs). """
+        stream.close(project_path)
+        if isinstance(stream, _Tee):
+            stream = stream.stream
+        if isinstance(stream, _RotatingStream):
+            # Rotated protocols consist of multiple files, which stay where they are
             return
-        gn_feature.write_elements(obj)
+        if _os.path.normcase(stream.path) != _os.path.normcase(xml_path):
+            moves = [(stream.path, xml_path)]
+            if stream.index_path:
+                moves.append((stream.index_path, xml_path + _INDEX_SUFFIX))
+            for src, dst in moves:
+                if _os.path.isfile(dst):
+                    _os.remove(dst)
+                _shutil.move(src, dst)
 
     @staticmethod
-    def _add_function(parent, function=None):
+    def _write_entries(xml_path, project_path, encoding, pretty, entries, append=False, workers=0, index=False,
+                       sinks=None, rotation=None):
+        """
+        Writes the given :class:`_Entry` records to a new (or existing) GEONIS Protocol XML file.
+        If *workers* is set, the geometries are serialized by a pool of worker processes.
+        If *index* is ``True``, a sidecar index file is written as well.
+        If *sinks* are specified, the entries are written to these sinks as well (in the same pass).
+        If *rotation* is a (max_entries, max_bytes) tuple, the entries are written to numbered part files instead.
+        Returns the number of written entries.
+        """
+        if workers:
+            entries = _serialize_entries(entries, workers)
+        if rotation:
+            stream = _RotatingStream(xml_path, project_path, encoding, pretty, *rotation, index=index)
+        else:
+            stream = _ProtocolStream(xml_path, project_path, encoding, pretty, append, index)
+        if sinks:
+            stream = _Tee(stream, sinks)
+        try:
+            for entry in entries:
+                stream.write(entry)
+        finally:
+            stream.close(project_path)
+        return stream.count
+
+    def _add_entry(self, msg, msg_type, gn_feature=None, function=None):
         """
-        Adds a <CustomFunctions> node to the specified parent (<Entry>) node.
+        Adds an <Entry> record to the entry buffer (or writes it to the protocol file in streaming mode).
 
-        :param parent:      The XML Element to which the SubElement should be added.
-        :param function:    A function to add to the <CustomFunctions> node. Not supported yet.
+        :param msg:         The message to set. When not specified, the attribute will be omitted (used for blank line).
+        :param msg_type:    The message type (warning, error, etc.).
+        :param gn_feature:  An optional feature to log in the <Object> node.
+        :param function:    An optional custom function to log in the <CustomFunctions> node. Not supported yet.
         """
-        _Xml.SubElement(parent, _TAG_CFUNC)
         _vld.raise_if(function, NotImplementedError, 'Custom functions are not supported yet')
 
-    def _write_tree(self, output_path, encoding):
-        """ Indents the current root element and its children, wraps it into an ElementTree and writes an XML. """
-
-        def indent(element, level=0, last_child=False):
-            spacing = _const.CHAR_LF + level * _const.CHAR_TAB
-            num_children = len(element)
-            if num_children:
-                if _vld.has_value(element.text, True):
-                    element.text = spacing + _const.CHAR_TAB
-                for i, child in enumerate(element, 1):
-                    indent(child, level + 1, i == num_children)
-            if _vld.has_value(element.tail, True):
-                element.tail = spacing[:-1] if last_child else spacing
-
-        indent(self._root)
-        tree = _Xml.ElementTree(self._root)
-        tree.write(output_path, encoding=encoding or _GNLOG_ENCODING, xml_declaration=True)
-        del tree
+        if self._dedup and gn_feature and not self._dedup.add(msg_type, msg, gn_feature.table, gn_feature.fid):
+            # Skip duplicate entry before any table or geometry work is done
+            return
+        limit = self._get_limit(msg_type, msg) if self._limits else None
+        if limit:
+            entry = limit.add(lambda: self._get_entry(msg, msg_type, gn_feature))
+            if entry:
+                self._add(entry)
+            return
+        self._add(self._get_entry(msg, msg_type, gn_feature))
 
     def message(self, message, gn_feature=None):
         """
@@ -407,34 +1953,973 @@ class Logger(object):
         """
         self._add_entry(message, _GNLOG_TYPE_HEADER2, gn_feature)
 
-    def flush(self, output_path, project_path, encoding=None):
+    def log_many(self, entries, fields=None):
+        """
+        Logs multiple entries to the GEONIS XML protocol in a single pass.
+        All entries in the batch share the same timestamp and table properties are only looked up once per table,
+        which makes this function a lot faster than calling :func:`error` (etc.) for each row in a cursor loop.
+
+        Each entry must be a tuple of (message type, message, table, GlobalID, geometry) values, where
+        the message type is either a type name (e.g. 'error', 'warning', 'info') or a type value.
+        The table, GlobalID and geometry values may be ``None`` if the entry does not refer to a feature.
+        Instead of an iterable of tuples, a NumPy structured array (e.g. from ``arcpy.da.TableToNumPyArray``)
+        can be specified as well.
+
+        :param entries: An iterable of (message type, message, table, GlobalID, geometry) tuples or a structured array.
+        :param fields:  When *entries* is a structured array, this optional tuple of 5 field names
+                        specifies which fields hold the message type, message, table, GlobalID and geometry.
+        :type entries:  tuple, list, numpy.ndarray
+        :type fields:   tuple, list
+        :return:        The number of logged entries (excluding suppressed duplicates and entries that exceed
+                        a limit, see :func:`set_dedup` and :func:`set_limit`).
+        :rtype:         int
+        """
+        if hasattr(entries, 'dtype'):
+            # Convert the (selected fields of the) structured array to a list of tuples in one go
+            names = list(fields or entries.dtype.names or ())
+            _vld.pass_if(len(names) == 5, ValueError,
+                         'fields must name 5 fields: message type, message, table, GlobalID and geometry')
+            entries = (entries[names] if fields else entries).tolist()
+
+        date = self._clock.now()
+        table_props = {}
+        add_entry = self._add
+        dedup = self._dedup
+        limits = self._limits
+
+        def make_entry():
+            # Creates the entry for the current row (table properties are only looked up once per table)
+            data_id = None
+            if table:
+                props = table_props.get(table)
+                if not props:
+                    props = table_props[table] = _get_table_props(table)
+                data_id = props.workspace, props.table, props.globalid_field, global_id
+            return _Entry(msg_type, msg, date, data_id, shape=_geometry.get_shape(shape) if shape else None)
+
+        count = 0
+        for msg_type, msg, table, global_id, shape in entries:
+            msg_type, msg = _get_msgtype(msg_type), _get_message(msg)
+            if table:
+                global_id = _get_guid(global_id)
+                if dedup and not dedup.add(msg_type, msg, table, global_id):
+                    continue
+            limit = self._get_limit(msg_type, msg) if limits else None
+            entry = limit.add(make_entry) if limit else make_entry()
+            if entry:
+                add_entry(entry)
+                count += 1
+        return count
+
+    def checkpoint(self, journal_path, every=1000, interval=None):
+        """
+        Enables checkpointing: all entries that are logged from now on are also appended to a write-ahead journal
+        on disk, in batches of *every* entries or every *interval* seconds (whichever comes first).
+        If the process crashes before :func:`flush` is called, the protocol can be rebuilt from the journal
+        using the :func:`recover` function. Only the entries of the last (incomplete) batch can get lost.
+        If *interval* is set, pending entries are committed after that time even if no new entries are logged.
+
+        Entries that are kept in a sample reservoir (see :func:`set_limit`) and the limit summary entries
+        are only created when the protocol is written, so these are not journaled and cannot be recovered.
+
+        Checkpointing ends when :func:`flush` is called: the journal is deleted once the protocol has been written.
+        Call this function with ``None`` as *journal_path* to stop checkpointing (and delete the journal).
+
+        :param journal_path:    The full path to the journal file. An existing file will be overwritten.
+        :param every:           The number of entries per journal batch. Defaults to 1000.
+        :param interval:        An optional maximum number of seconds between two journal batches.
+        :type journal_path:     str, unicode
+        :type every:            int
+        :type interval:         int, float
+        """
+        journal, self._journal = self._journal, None
+        if journal:
+            journal.close()
+        if journal_path:
+            self._journal = _Journal(journal_path, every, interval)
+
+    def set_concurrent(self, enabled=True, order=_ORDER_DATE):
         """
-        Flushes the root element buffer and writes the GEONIS Protocol to an XML file.
+        Enables (or disables) the concurrent mode of the writer, so that it can safely be used from multiple threads.
 
-        Once this function is called, the root element has been reset and you can reuse the Logger
-        for another project or the same one, or you can exit your application.
+        In concurrent mode, each thread appends entries to its own buffer, so that threads do not have to wait
+        for each other. When :func:`flush` is called, the thread buffers are merged into a single protocol.
+        In streaming mode, writes to the protocol file are synchronized instead.
+
+        Note that the mode should not be changed while other threads are logging.
+
+        :param enabled: If ``True`` (default), the concurrent mode is enabled. If ``False``, it is disabled again.
+        :param order:   The order in which the thread buffers are merged: 'date' (default) sorts the entries
+                        by their timestamp and 'submission' keeps the order in which the entries were logged.
+        :type enabled:  bool
+        :type order:    str
+        """
+        _vld.pass_if(order in (_ORDER_DATE, _ORDER_SUBMISSION), ValueError,
+                     'order must be {!r} or {!r}'.format(_ORDER_DATE, _ORDER_SUBMISSION))
+
+        with self._lock:
+            self._order = order
+            if bool(enabled) == (self._local is not None):
+                return
+            if enabled:
+                # Keep the entries that were buffered so far in a separate buffer
+                self._local = _threading.local()
+                self._buffers = [_ThreadBuffer([(next(self._counter), entry) for entry in self._entries])]
+                self._new_buffer()
+                return
+
+            # Merge the thread buffers back into a single buffer
+            entries = list(self._pop_entries())
+            self._local = None
+            self._entries = entries
+
+    def set_dedup(self, enabled=True):
+        """
+        Enables (or disables) the suppression of duplicate feature entries.
+
+        When enabled, a feature entry is skipped if an entry with the same message type, message, table and
+        GlobalID has already been logged for the current protocol. Duplicates are detected before the
+        table properties are looked up or the geometry is processed, so that they hardly cost anything.
+        Entries that do not refer to a feature (e.g. headers or blank lines) are never suppressed.
+        The index is reset when the protocol is flushed.
+
+        The index holds a 64-bit fingerprint of each unique feature entry, which takes about 60 to 100 bytes
+        of memory per entry (i.e. about 100 MB per million unique feature entries).
+
+        :param enabled: If ``True`` (default), duplicates are suppressed. If ``False``, they are logged again.
+        :type enabled:  bool
+        """
+        if bool(enabled) != (self._dedup is not None):
+            self._dedup = _Fingerprints() if enabled else None
+
+    @property
+    def suppressed(self):
+        """
+        Returns the number of duplicate entries that have been suppressed since :func:`set_dedup` was enabled.
+
+        :rtype: int
+        """
+        return self._dedup.suppressed if self._dedup else 0
+
+    def set_limit(self, limit, msg_type=None, message=None, sample=False):
+        """
+        Limits the number of entries of a certain category (message type and/or message) in the protocol,
+        e.g. to log at most 1000 warnings for a rule that produces millions of them.
+
+        Entries that exceed the limit are counted, but not stored. When the protocol is written,
+        a summary warning is added for each limit that has been exceeded, stating how many entries were dropped.
+        Optionally, a random sample of entries (reservoir sampling) can be logged instead of the first entries.
+        Sampled entries are kept aside until the protocol is written: in streaming mode, they are written last.
+
+        If an entry matches multiple limits, only the first limit that was set applies.
+        The counts are reset when the protocol is flushed, but the limits remain in effect.
+
+        :param limit:       The maximum number of entries of the category. If ``None``, the limit is removed.
+        :param msg_type:    The message type (name or value) of the category. If ``None`` (default), any type.
+        :param message:     A regular expression that should match the start of the message (e.g. a rule name).
+                            If ``None`` (default), any message matches.
+        :param sample:      If ``True``, a random sample of *limit* entries is logged instead of the first ones.
+                            Defaults to ``False``.
+        :type limit:        int
+        :type msg_type:     str, int
+        :type message:      str, unicode
+        :type sample:       bool
+        """
+        msg_type = None if msg_type is None else _get_msgtype(msg_type)
+        message = None if message is None else _tu.to_unicode(message)
+        pattern = None if message is None else _re.compile(message, _re.UNICODE)
+        _vld.pass_if(limit is None or (isinstance(limit, (int, long)) and not isinstance(limit, bool) and limit >= 0),
+                     ValueError, 'limit must be a positive integer, 0 or None')
+
+        with self._lock:
+            key = msg_type, message
+            limits = [lim for lim in self._limits if lim.key != key]
+            if limit is not None:
+                limits.append(_Limit(limit, msg_type, pattern, sample))
+            self._limits = limits
+
+    def add_sink(self, sink):
+        """
+        Adds an output sink, to which the protocol entries are written as well when the protocol is written.
+        This way, the entries can be exported to other formats in the same pass as the GEONIS Protocol XML.
+        Available sinks are :class:`JsonLinesSink` and :class:`CsvSink`, but any object that has a
+        *write(entry)* and a *close(project_path)* method can be used (see :class:`ProtocolReader` for
+        the entry attributes). The sinks are closed (and removed from the writer) by :func:`flush`.
+
+        Sinks must be added before :func:`stream` is called, if the writer should run in streaming mode.
+
+        :param sink:    The sink to add.
+        """
+        _vld.raise_if(self._stream, RuntimeError, 'Sinks must be added before the streaming mode starts')
+        _vld.pass_if(hasattr(sink, 'write') and hasattr(sink, 'close'), TypeError,
+                     'sink must have a write() and a close() method')
+        with self._lock:
+            self._sinks.append(sink)
+
+    def set_geometry_workers(self, workers):
+        """
+        Sets the number of worker processes that serialize the feature geometries when the protocol is written.
+
+        Feature geometries are not serialized when they are logged: the raw shapes are kept until the protocol
+        is written by :func:`flush` or :func:`merge_fragments` (or when an entry is written in streaming mode).
+        By default, the geometries are serialized one by one while the protocol is written.
+        For protocols with many (complex) geometries, a pool of worker processes can serialize them instead.
+
+        :param workers: The number of worker processes. If ``None``, the number of CPUs is used.
+                        If 0, the geometries are serialized by the writing thread itself (default).
+        :type workers:  int
+
+        .. warning::    On Windows, each worker process imports the main module of the calling process again,
+                        so the calling script must protect its entry point with an ``if __name__ == '__main__':``
+                        guard. If Python does not run as a standalone interpreter (e.g. for a geoprocessing tool
+                        in ArcMap or ArcGIS Pro), no worker processes are started and the geometries are serialized
+                        by the writing thread (see :func:`gntools.common.geometry.serialize_many`).
+        """
+        if workers is None:
+            workers = _mp.cpu_count()
+        _vld.pass_if(isinstance(workers, (int, long)) and not isinstance(workers, bool) and workers >= 0, ValueError,
+                     'workers must be a positive integer or 0')
+        self._workers = workers
+
+    def set_time_resolution(self, seconds):
+        """
+        Sets the resolution of the entry timestamps (i.e. the 'date' attribute) of the protocol.
+        By default, timestamps are truncated to whole seconds. Each protocol writer has its own resolution.
+
+        :param seconds: The timestamp resolution in seconds (e.g. 0.001 for milliseconds or 60 for minutes).
+        :type seconds:  float, int
+        """
+        self._clock.resolution = seconds
+
+    def stream(self, output_path, project_path=None, encoding=None, pretty=True, max_entries=None, max_bytes=None,
+               index=False):
+        """
+        Switches the writer to streaming mode: the GEONIS Protocol XML file is opened immediately and
+        all entries that are logged from now on are written to that file straight away.
+        Entries that have been logged before this call (if any) are written to the file first.
+
+        The streaming mode ends when :func:`flush` is called, which finalizes the XML file.
+
+        If *max_entries* and/or *max_bytes* are set, the protocol is split (rotated) into numbered part files
+        (e.g. *protocol_001.xml*, *protocol_002.xml* for output path *protocol.xml*) as soon as a limit is reached.
+        Each part is a complete protocol for the same project, so *project_path* is required in that case.
+        When :func:`flush` is called, an index file that lists all parts is written (e.g. *protocol_parts.xml*).
+        Note that the part files are not moved if :func:`flush` is called with a different output path.
+        To rotate a buffered protocol, pass the same limits to :func:`flush` instead.
 
         :param output_path:     The full path to the output protocol XML that should be written.
         :param project_path:    The full path to the GEONIS project to which the protocol applies.
+                                If not specified (default), the project must be set when :func:`flush` is called.
         :keyword encoding:      Optional encoding to use for the protocol file (default = ISO-8859-1).
+        :keyword pretty:        If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+        :keyword max_entries:   The maximum number of entries per protocol part (rotation).
+        :keyword max_bytes:     The (approximate) maximum size in bytes per protocol part (rotation).
+        :keyword index:         If ``True``, a sidecar index file (see :class:`ProtocolIndex`) is written
+                                for the protocol (or for each part). Defaults to ``False``.
         :type output_path:      str, unicode
         :type project_path:     str, unicode
         :type encoding:         str, unicode
+        :type pretty:           bool
+        :type max_entries:      int
+        :type max_bytes:        int
+        :type index:            bool
 
         .. warning::            The user must have write access in the specified output directory.
         """
+        _vld.raise_if(self._stream, RuntimeError, 'Protocol writer is already streaming to {}'.format(
+                      _tu.to_repr(self._stream.path if self._stream else None)))
+
+        if max_entries or max_bytes:
+            stream = _RotatingStream(output_path, project_path, encoding, pretty, max_entries, max_bytes, index)
+        else:
+            stream = _ProtocolStream(output_path, project_path, encoding, pretty, index=index)
+        with self._lock:
+            if self._sinks:
+                stream, self._sinks = _Tee(stream, self._sinks), []
+            for entry in self._pop_entries():
+                stream.write(entry)
+            self._stream = stream
+
+    def flush(self, output_path, project_path, encoding=None, pretty=True, background=False, append=False,
+              index=False, max_entries=None, max_bytes=None):
+        """
+        Flushes the entry buffer and writes the GEONIS Protocol to an XML file.
 
-        # Set path and check directory of XML
-        xml_path = _os.path.realpath(output_path.strip())
-        dirname, filename = _os.path.split(xml_path)
-        if not _os.path.isdir(dirname):
-            _os.makedirs(dirname)
+        Once this function is called, the entry buffer has been reset and you can reuse the writer
+        for another project or the same one, or you can exit your application.
+
+        If the writer is in streaming mode (see :func:`stream`), the streamed XML file will be closed and
+        moved to *output_path* (if it differs). The *encoding*, *pretty*, *index* and rotation options
+        are ignored in that case.
+
+        If *max_entries* and/or *max_bytes* are set, the buffered protocol is split (rotated) into numbered part files
+        and an index file that lists all parts is written, exactly as in streaming mode (see :func:`stream`).
+
+        Sinks that have been added using :func:`add_sink` receive the same entries while the protocol is written.
+        New table properties are saved to the persistent table store, if in use (see :func:`use_table_store`).
+
+        :param output_path:     The full path to the output protocol XML that should be written.
+                                This can also be a writable file-like object (e.g. an open file or socket wrapper),
+                                to which the encoded XML is written directly, or ``None`` to return the encoded XML
+                                as bytes. Both are not supported in streaming mode or in combination with *append*
+                                or *index*. A file-like object is not closed after the protocol has been written.
+        :param project_path:    The full path to the GEONIS project to which the protocol applies.
+        :keyword encoding:      Optional encoding to use for the protocol file (default = ISO-8859-1).
+        :keyword pretty:        If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+        :keyword background:    If ``True``, the protocol is written by a background thread and a
+                                :class:`FlushHandle` is returned immediately. Defaults to ``False``.
+                                New entries can be logged while the protocol is being written.
+        :keyword append:        If ``True`` and *output_path* already exists, the entries are appended to the
+                                existing protocol, which keeps its project attributes and encoding.
+                                The existing file is not parsed, so appending is fast, even for large protocols.
+                                Appending is not supported in streaming mode. Defaults to ``False``.
+        :keyword index:         If ``True``, a sidecar index file (*output_path* + '.idx') is written as well,
+                                which allows for fast lookups using a :class:`ProtocolIndex`.
+                                Cannot be combined with *append*. Defaults to ``False``.
+        :keyword max_entries:   The maximum number of entries per protocol part (rotation).
+        :keyword max_bytes:     The (approximate) maximum size in bytes per protocol part (rotation).
+        :type output_path:      str, unicode, file, None
+        :type project_path:     str, unicode
+        :type encoding:         str, unicode
+        :type pretty:           bool
+        :type background:       bool
+        :type append:           bool
+        :type index:            bool
+        :type max_entries:      int
+        :type max_bytes:        int
+        :return:                The encoded protocol XML if *output_path* is ``None``, a :class:`FlushHandle`
+                                if *background* is ``True`` or ``None`` otherwise.
+        :rtype:                 str, FlushHandle
+
+        .. warning::            The user must have write access in the specified output directory.
+        """
+
+        _vld.raise_if(append and self._stream, ValueError, 'Cannot append to a protocol in streaming mode')
+        _vld.raise_if(append and index, ValueError, 'Cannot write an index when appending to a protocol')
+        rotation = (max_entries, max_bytes) if (max_entries or max_bytes) and not self._stream else None
+        _vld.raise_if(append and rotation, ValueError, 'Cannot rotate a protocol when appending to it')
+
+        buffer = None
+        if output_path is None or _is_file_like(output_path):
+            # Write the encoded XML to memory or to the given file-like object (no paths or directories involved)
+            _vld.raise_if(self._stream, ValueError, 'Cannot write a streamed protocol to a file-like object')
+            _vld.raise_if(append or index or rotation, ValueError,
+                          'Cannot append, rotate or write an index when writing a protocol to a file-like object')
+            _vld.raise_if(background and output_path is None, ValueError,
+                          'Cannot return the protocol as bytes when writing it in the background')
+            if output_path is None:
+                buffer = output_path = _io.BytesIO()
+            xml_path = output_path
+        else:
+            # Set path and check directory of XML
+            xml_path = _os.path.realpath(output_path.strip())
+            dirname, filename = _os.path.split(xml_path)
+            if not _os.path.isdir(dirname):
+                _os.makedirs(dirname)
+
+        # Make sure that the project path is set before the buffer is handed over
+        self._split_prj(project_path)
+        if self._dedup:
+            self._dedup.clear()
+        save_table_store()
+
+        if self._stream:
+            # Finalize the streamed XML (with the sampled and summary entries, if any) and end the streaming mode
+            with self._lock:
+                stream, self._stream = self._stream, None
+                for entry in self._with_limits(()):
+                    stream.write(entry)
+            write_func, args = self._close_stream, (stream, xml_path, project_path)
+        else:
+            # Write XML (the XML elements are built and written for one entry at a time)
+            sinks, self._sinks = self._sinks, []
+            write_func, args = self._write_entries, (xml_path, project_path, encoding, pretty,
+                                                     self._with_limits(self._pop_entries()), append, self._workers,
+                                                     index, sinks, rotation)
+
+        if self._journal:
+            # Checkpointing ends here: the journal is deleted once the protocol has been written
+            journal, self._journal = self._journal, None
+            write_func = self._with_journal(journal, write_func)
+
+        if background:
+            path = getattr(xml_path, 'name', None) if _is_file_like(xml_path) else xml_path
+            return FlushHandle(path, write_func, *args)
+        write_func(*args)
+        if buffer is not None:
+            return buffer.getvalue()
+
+    def write_fragment(self, fragment_path):
+        """
+        Flushes the entry buffer to a protocol *fragment* file instead of a GEONIS Protocol XML.
+
+        This is meant for worker processes (e.g. in a ``multiprocessing.Pool``): each worker logs its entries
+        as usual and writes them to its own fragment file. The coordinating process then calls
+        :func:`merge_fragments` to combine all fragments into a single GEONIS Protocol.
+        The fragment file contains pickled batches of entries, ordered by date.
+
+        :param fragment_path:   The full path to the fragment file that should be written.
+        :type fragment_path:    str, unicode
+        :return:                The number of entries that were written to the fragment.
+        :rtype:                 int
+        """
+        _vld.raise_if(self._stream, RuntimeError, 'Cannot write a protocol fragment in streaming mode')
+        entries = self._with_limits(sorted(self._pop_entries(), key=_attrgetter('date')))
+        return _write_fragment(fragment_path, entries)
+
+    def merge_fragments(self, output_path, project_path, fragment_paths, encoding=None, pretty=True,
+                        max_entries=None, max_bytes=None):
+        """
+        Merges protocol fragment files (see :func:`write_fragment`) and the entries that were buffered by this
+        writer (if any) into a single GEONIS Protocol XML file, ordered by the entry date.
+
+        The merge is a streaming k-way merge: only a single batch of entries per fragment is held in memory.
+        Once this function is called, the entry buffer has been reset. The fragment files are left untouched.
+        Like :func:`flush`, this function feeds and closes the sinks, resets the duplicate filter,
+        ends checkpointing and saves the table store (if any of these are in use).
+
+        :param output_path:     The full path to the output protocol XML that should be written.
+        :param project_path:    The full path to the GEONIS project to which the protocol applies.
+        :param fragment_paths:  An iterable of fragment file paths.
+        :keyword encoding:      Optional encoding to use for the protocol file (default = ISO-8859-1).
+        :keyword pretty:        If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+        :keyword max_entries:   The maximum number of entries per protocol part (rotation, see :func:`flush`).
+        :keyword max_bytes:     The (approximate) maximum size in bytes per protocol part (rotation).
+        :type output_path:      str, unicode
+        :type project_path:     str, unicode
+        :type fragment_paths:   tuple, list
+        :type encoding:         str, unicode
+        :type pretty:           bool
+        :type max_entries:      int
+        :type max_bytes:        int
+        """
+        _vld.raise_if(self._stream, RuntimeError, 'Cannot merge protocol fragments in streaming mode')
+
+        self._split_prj(project_path)
+        if self._dedup:
+            self._dedup.clear()
+        save_table_store()
+
+        sources = [_read_fragment(path) for path in fragment_paths]
+        sources.append(self._with_limits(sorted(self._pop_entries(), key=_attrgetter('date'))))
+        sinks, self._sinks = self._sinks, []
+        rotation = (max_entries, max_bytes) if max_entries or max_bytes else None
+
+        write_func = self._write_entries
+        if self._journal:
+            journal, self._journal = self._journal, None
+            write_func = self._with_journal(journal, write_func)
+        write_func(output_path, project_path, encoding, pretty, _merge_by_date(*sources),
+                   workers=self._workers, sinks=sinks, rotation=rotation)
+
+
+class Logger(ProtocolWriter):
+    """
+    Logger class to write GEONIS XML protocols (e.g. for validations, reporting etc.).
+
+    .. note::   Because Logger is a singleton, instantiating it multiple times will always refer to the same object.
+                All Logger instances write to the same entry buffer, which is reset once an instance has called
+                the :func:`flush` method.
+
+    .. seealso::    :class:`ProtocolWriter` for the available methods and for writing several protocols at once.
+    """
+
+    __slots__ = ()
+    __instance = None
+    __instance_lock = _threading.Lock()
+
+    def __new__(cls):
+
+        with cls.__instance_lock:
+            if cls.__instance is not None:
+                return cls.__instance
+
+            instance = object.__new__(cls)
+            ProtocolWriter.__init__(instance)
+            Logger.__instance = instance
+        return Logger.__instance
+
+    def __init__(self):
+        # The singleton has already been initialized (once) by __new__
+        pass
+
+
+class ProtocolReader(object):
+    """
+    ProtocolReader(xml_path, {geometry})
+
+    Reads an existing GEONIS Protocol XML file entry by entry.
+
+    The protocol is parsed incrementally and each <Entry> element is discarded as soon as it has been read,
+    so that memory usage stays constant, no matter how large the protocol is.
+    Iterating over the reader yields lightweight entry records with the following attributes:
+
+    - **msg_type**: the message type value (e.g. 3 for a warning);
+    - **message**: the (unicode) message or ``None`` for blank lines;
+    - **date**: the Delphi-formatted date string;
+    - **data_id**: a (connection, table, GlobalID field, GlobalID) tuple or ``None``;
+    - **geometry**: the GEONIS XML geometry string (only if *geometry* is ``True``) or ``None``.
+
+    **Params:**
+
+    -   **xml_path** (str, unicode):
 
-        # Set project root attributes
-        self._set_project(project_path)
+        The full path to the GEONIS Protocol XML file.
 
-        # Write XML
-        self._write_tree(output_path, encoding)
+    **Keyword params:**
+
+    -   **geometry** (bool):
+
+        If ``True``, the geometry of each entry is read as well. Defaults to ``False``,
+        which is faster if the geometries are not needed (e.g. for aggregations).
+    """
+
+    __slots__ = ('_path', '_geometry', '_project')
+
+    def __init__(self, xml_path, geometry=False):
+        self._path = _os.path.realpath(xml_path)
+        self._geometry = geometry
+        self._project = None
+
+    def _read_project(self):
+        """ Reads the project attributes of the root element (without parsing the rest of the file). """
+        if self._project is None:
+            for _, element in _Xml.iterparse(self._path, ('start', )):
+                _vld.pass_if(element.tag == _TAG_ROOT, ValueError,
+                             '{} is not a GEONIS Protocol'.format(_tu.to_repr(self._path)))
+                self._project = element.get(_ATTR_PRJNAME), element.get(_ATTR_PRJROOT)
+                break
+        return self._project
+
+    def __iter__(self):
+        root = None
+        for event, element in _Xml.iterparse(self._path, ('start', 'end')):
+            if root is None:
+                _vld.pass_if(element.tag == _TAG_ROOT, ValueError,
+                             '{} is not a GEONIS Protocol'.format(_tu.to_repr(self._path)))
+                root = element
+                self._project = root.get(_ATTR_PRJNAME), root.get(_ATTR_PRJROOT)
+            elif event == 'end' and element.tag == _TAG_ENTRY:
+                yield _read_entry(element, self._geometry)
+                # Discard the entry (and all entries before it) to keep memory usage constant
+                root.clear()
+
+    @property
+    def path(self):
+        """ Returns the path to the protocol XML file. """
+        return self._path
+
+    @property
+    def project(self):
+        """ Returns the name of the GEONIS project (currentproject attribute) to which the protocol applies. """
+        return self._read_project()[0]
+
+    @property
+    def project_root(self):
+        """ Returns the root directory (projectroot attribute) of the GEONIS project. """
+        return self._read_project()[1]
+
+    def counts(self, *keys):
+        """
+        Reads the whole protocol and counts its entries, grouped by the given key(s).
+
+        Keys can be 'type' (message type value), 'message', 'table' or 'connection', or a function that
+        returns a key for an entry record. If multiple keys are specified, the counts are grouped by key tuples.
+        If no keys are specified, the entries are counted by message type.
+
+        Example:
+
+            >>> reader = ProtocolReader(r'C:/temp/protocol.xml')
+            >>> reader.counts('type', 'table')
+            Counter({(4, 'ele_kabel'): 3012, (3, 'ele_kabel'): 12, (5, None): 2})
+
+        :param keys:    The key(s) by which the entries should be grouped.
+        :type keys:     str, function
+        :rtype:         collections.Counter
+        """
+        keys = keys or (_READER_TYPE, )
+        for k in keys:
+            _vld.pass_if(callable(k) or k in _READER_KEYS, ValueError,
+                         'Keys must be functions or one of {}'.format(', '.join(sorted(_READER_KEYS))))
+        getters = [k if callable(k) else _READER_KEYS[k] for k in keys]
+        if len(getters) == 1:
+            get_key = getters[0]
+        else:
+            def get_key(entry):
+                return tuple(g(entry) for g in getters)
+        return _Counter(get_key(entry) for entry in self)
+
+
+class ProtocolIndex(object):
+    """
+    ProtocolIndex(xml_path)
+
+    Provides random access to the entries of a GEONIS Protocol XML file by means of its sidecar index file,
+    which is written when the protocol is flushed (or streamed) with the *index* option (see :class:`Logger`).
+
+    The index holds a small record for each entry, which is used to look up entries by position or to find entries
+    by message type, table and/or GlobalID. Only the entries that are returned are read from the protocol file.
+    Entry records have the same attributes as the ones returned by a :class:`ProtocolReader`.
+
+    Example:
+
+        >>> index = ProtocolIndex(r'C:/temp/protocol.xml')
+        >>> len(index)
+        250000
+        >>> page = index[1000:1050]
+        >>> failures = list(index.find('error', table='ele_kabel'))
+
+    **Params:**
+
+    -   **xml_path** (str, unicode):
+
+        The full path to the GEONIS Protocol XML file (the index file is expected at *xml_path* + '.idx').
+
+    :raises ValueError: If the index file is invalid or if the protocol has changed since the index was written.
+    """
+
+    __slots__ = ('_path', '_index_path', '_base', '_declaration', '_count')
+
+    def __init__(self, xml_path):
+        self._path = _os.path.realpath(xml_path)
+        self._index_path = self._path + _INDEX_SUFFIX
+
+        with open(self._index_path, 'rb') as f:
+            magic, self._base, size = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+        _vld.pass_if(magic == _INDEX_MAGIC, ValueError, '{} is not a protocol index'.format(
+                     _tu.to_repr(self._index_path)))
+        _vld.pass_if(size == _os.path.getsize(self._path), ValueError, '{} is outdated'.format(
+                     _tu.to_repr(self._index_path)))
+        self._count = (_os.path.getsize(self._index_path) - _INDEX_HEADER.size) // _INDEX_RECORD.size
+
+        # Entries are parsed as separate XML snippets, which need the declaration to be decoded correctly
+        with open(self._path, 'rb') as f:
+            match = _ENCODING_PATTERN.match(f.read(_APPEND_SCAN))
+        self._declaration = "<?xml version='1.0' encoding='{}'?>".format(match.group(1) if match else 'utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._count)
+            if step == 1:
+                return self._read(self._records(start, stop))
+            return self._read(_chain.from_iterable(self._records(i, i + 1) for i in xrange(start, stop, step)))
+        if item < 0:
+            item += self._count
+        if not 0 <= item < self._count:
+            raise IndexError('protocol index out of range')
+        return self._read(self._records(item, item + 1))[0]
+
+    def _records(self, start=0, stop=None):
+        """ Yields the (offset, length, message type, table hash, GlobalID hash) index records in the given range. """
+        stop = self._count if stop is None else stop
+        with open(self._index_path, 'rb') as f:
+            f.seek(_INDEX_HEADER.size + start * _INDEX_RECORD.size)
+            while start < stop:
+                size = min(_INDEX_BATCH, stop - start)
+                data = f.read(size * _INDEX_RECORD.size)
+                for i in xrange(size):
+                    yield _INDEX_RECORD.unpack_from(data, i * _INDEX_RECORD.size)
+                start += size
+
+    def _read(self, records, geometry=False):
+        """ Reads the protocol entries for the given index records and returns them as a list. """
+        entries = []
+        with open(self._path, 'rb') as f:
+            for record in records:
+                offset, length = record[:2]
+                f.seek(self._base + offset)
+                entries.append(_read_entry(_Xml.fromstring(self._declaration + f.read(length)), geometry))
+        return entries
+
+    @property
+    def path(self):
+        """ Returns the path to the protocol XML file. """
+        return self._path
 
-        # Re-instantiate the root element
-        self._new_root()
+    def find(self, msg_type=None, table=None, global_id=None, geometry=False):
+        """
+        Yields the entries that match the given message type, table and/or GlobalID, in protocol order.
+        Only the index is scanned: matching entries are read from the protocol file by seeking to them.
+
+        :param msg_type:    The message type (name or value) of the entries to find (optional).
+        :param table:       The (unqualified) table name of the entries to find (optional).
+        :param global_id:   The GlobalID of the entries to find (optional).
+        :param geometry:    If ``True``, the geometries of the entries are read as well. Defaults to ``False``.
+        :type msg_type:     str, int
+        :type table:        str, unicode
+        :type global_id:    str, unicode, gpf.common.guids.Guid
+        :type geometry:     bool
+        :rtype:             generator
+        """
+        msg_type = None if msg_type is None else _get_msgtype(msg_type)
+        global_id = None if global_id is None else _get_guid(global_id)
+        table_hash = None if table is None else _get_table_hash(table)
+        guid_hash = None if global_id is None else _get_guid_hash(global_id)
+
+        matches = []
+        for record in self._records():
+            if ((msg_type is None or record[2] == msg_type) and
+                    (table_hash is None or record[3] == table_hash) and
+                    (guid_hash is None or record[4] == guid_hash)):
+                matches.append(record)
+            if len(matches) == _INDEX_BATCH:
+                for entry in self._verify(self._read(matches, geometry), table, global_id):
+                    yield entry
+                matches = []
+        for entry in self._verify(self._read(matches, geometry), table, global_id):
+            yield entry
+
+    @staticmethod
+    def _verify(entries, table, global_id):
+        """ Filters out entries that only matched the index because of a hash collision. """
+        for entry in entries:
+            if entry.data_id is None and (table is not None or global_id is not None):
+                # Non-feature entries have a zero hash in the index, which a query hash can collide with
+                continue
+            if table is not None and entry.data_id[1].lower() != table.lower():
+                continue
+            if global_id is not None and entry.data_id[3].upper() != global_id:
+                continue
+            yield entry
+
+
+def _get_entry_key(entry):
+    """ Returns the 64-bit (table, GlobalID, message) key of a feature entry, which identifies it across protocols. """
+    table, global_id = entry.data_id[1], entry.data_id[3]
+    return _hash64(u'{}\0{}\0{}'.format(_tu.to_unicode(table).lower(), global_id.upper(), entry.message or u''))
+
+
+def _get_project_path(reader):
+    """ Returns the full GEONIS project path of the protocol that is read by the given :class:`ProtocolReader`. """
+    return _os.path.join(reader.project_root or _const.CHAR_EMPTY, reader.project or _const.CHAR_EMPTY)
+
+
+def diff_protocols(old_path, new_path, output_path, project_path=None, encoding=None, pretty=True):
+    """
+    Compares two GEONIS Protocols (e.g. of two validation runs) and writes a new protocol that lists
+    the new, resolved and unchanged feature entries, each in a section that starts with a header entry.
+
+    Feature entries are identified by their table, GlobalID and message. Entries that do not refer to a feature
+    (e.g. headers) are not compared. The protocols are streamed: only the keys of the smaller protocol
+    (a 64-bit hash per entry) and of the entries that both protocols have in common are held in memory.
+    Each protocol is parsed once: the feature entries of the smaller protocol are spilled to a temporary
+    fragment file while their keys are collected, and are read back from there once the larger protocol
+    has been compared. The sections are buffered in temporary fragment files next to the output protocol.
+
+    :param old_path:        The full path to the old (previous) protocol XML.
+    :param new_path:        The full path to the new (current) protocol XML.
+    :param output_path:     The full path to the output protocol XML that should be written.
+    :param project_path:    The full path to the GEONIS project for the output protocol.
+                            If not specified, the project of the new protocol is used.
+    :keyword encoding:      Optional encoding to use for the output protocol (default = ISO-8859-1).
+    :keyword pretty:        If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+    :type old_path:         str, unicode
+    :type new_path:         str, unicode
+    :type output_path:      str, unicode
+    :type project_path:     str, unicode
+    :type encoding:         str, unicode
+    :type pretty:           bool
+    :return:                A tuple of (new, resolved, unchanged) entry counts.
+    :rtype:                 tuple
+    """
+    old_reader, new_reader = ProtocolReader(old_path, True), ProtocolReader(new_path, True)
+    project_path = project_path or _get_project_path(new_reader)
+    ProtocolWriter._split_prj(project_path)
+    old_smaller = _os.path.getsize(old_reader.path) <= _os.path.getsize(new_reader.path)
+    small, large = (old_reader, new_reader) if old_smaller else (new_reader, old_reader)
+
+    output_path = _os.path.realpath(output_path.strip())
+    dirname = _os.path.dirname(output_path)
+    if not _os.path.isdir(dirname):
+        _os.makedirs(dirname)
+
+    sections = (_DIFF_NEW, _DIFF_RESOLVED, _DIFF_UNCHANGED)
+    paths = [output_path + _DIFF_SUFFIX.format(i) for i in xrange(len(sections))]
+    spill_path = output_path + _DIFF_SUFFIX.format(len(sections))
+    writers = []
+    spill = None
+    try:
+        # Collect the keys of the smaller protocol and spill its feature entries, so that it is only parsed once
+        keys = set()
+        spill = _FragmentWriter(spill_path)
+        for entry in small:
+            if entry.data_id:
+                keys.add(_get_entry_key(entry))
+                spill.add(entry)
+        spill.close()
+        common = set()
+
+        writers.extend(_FragmentWriter(path) for path in paths)
+        new, resolved, unchanged = writers
+        small_only = resolved if old_smaller else new
+        large_only = new if old_smaller else resolved
+
+        for entry in large:
+            if not entry.data_id:
+                continue
+            key = _get_entry_key(entry)
+            if key not in keys:
+                large_only.add(entry)
+                continue
+            common.add(key)
+            if not old_smaller:
+                unchanged.add(entry)
+        keys = None
+
+        for entry in _read_fragment(spill_path):
+            if _get_entry_key(entry) not in common:
+                small_only.add(entry)
+            elif old_smaller:
+                unchanged.add(entry)
+
+        for writer in writers:
+            writer.close()
+
+        def get_entries():
+            for section, writer, path in _izip(sections, writers, paths):
+                yield _Entry(_GNLOG_TYPE_HEADER1, _get_message(section.format(writer.count)), _get_delphi_time())
+                for entry in _read_fragment(path):
+                    yield entry
+
+        ProtocolWriter._write_entries(output_path, project_path, encoding, pretty, get_entries())
+        return tuple(writer.count for writer in writers)
+    finally:
+        for writer in writers:
+            writer.close()
+        if spill:
+            spill.close()
+        for path in paths + [spill_path]:
+            if _os.path.isfile(path):
+                _os.remove(path)
+
+
+def merge_protocols(output_path, protocol_paths, project_path=None, encoding=None, pretty=True, unique=False):
+    """
+    Merges multiple GEONIS Protocols into a single protocol, ordered by the entry date.
+    The merge is a streaming k-way merge: each protocol is read once and only one entry per protocol
+    is held in memory at a time.
+
+    :param output_path:     The full path to the output protocol XML that should be written.
+    :param protocol_paths:  An iterable of protocol XML paths.
+    :param project_path:    The full path to the GEONIS project for the output protocol.
+                            If not specified, the project of the first protocol is used.
+    :keyword encoding:      Optional encoding to use for the output protocol (default = ISO-8859-1).
+    :keyword pretty:        If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+    :keyword unique:        If ``True``, a feature entry with the same table, GlobalID and message as an entry
+                            that has already been merged, is skipped. Only the (64-bit) keys are held in memory.
+                            Defaults to ``False``.
+    :type output_path:      str, unicode
+    :type protocol_paths:   tuple, list
+    :type project_path:     str, unicode
+    :type encoding:         str, unicode
+    :type pretty:           bool
+    :type unique:           bool
+    :return:                The number of merged entries.
+    :rtype:                 int
+    """
+    readers = [ProtocolReader(path, True) for path in protocol_paths]
+    _vld.pass_if(readers, ValueError, 'At least one protocol is required')
+    project_path = project_path or _get_project_path(readers[0])
+    entries = _merge_by_date(*readers)
+
+    if unique:
+        def get_unique(merged):
+            keys = set()
+            for entry in merged:
+                if entry.data_id:
+                    key = _get_entry_key(entry)
+                    if key in keys:
+                        continue
+                    keys.add(key)
+                yield entry
+        entries = get_unique(entries)
+
+    return ProtocolWriter._write_entries(output_path, project_path, encoding, pretty, entries)
+
+
+def use_table_store(store_path):
+    """
+    Persists the table properties that are used by :class:`Feature` objects (workspace, table name and GlobalID field)
+    in a small JSON store file, so that tables are only described once (instead of once in every new process).
+    Stored table properties are discarded when the geodatabase has changed. This is detected by the GEONIS version
+    table or, if there is none, by the system catalog table of a File Geodatabase.
+    If neither can be read (e.g. for an SDE database without a GEONIS version table), a warning is issued
+    and the tables of that geodatabase are described in every process, as if no store were used.
+
+    New table properties are saved in batches: when a protocol is flushed, when :func:`save_table_store` is called
+    and when the process exits.
+
+    :param store_path:  The full path to the JSON store file (e.g. in the user's temp directory).
+                        If ``None``, the persistent store will not be used anymore.
+    :type store_path:   str, unicode
+    """
+    global _table_store
+    save_table_store()
+    _table_store = None if store_path is None else _TableStore(store_path)
+
+
+def save_table_store():
+    """
+    Writes the new table properties (if any) to the persistent table store (see :func:`use_table_store`).
+    This is done automatically when a protocol is flushed and when the process exits.
+    """
+    if _table_store:
+        _table_store.save()
+
+
+# Save the table store (if any) when the process exits
+_atexit.register(save_table_store)
+
+
+def prewarm_tables(workspace):
+    """
+    Caches the properties of all tables and feature classes of the given *workspace* (including those in
+    feature datasets), so that the first :class:`Feature` of each table does not have to describe the table anymore.
+    If a persistent table store is in use (see :func:`use_table_store`), the properties are stored as well,
+    and tables of which the properties have already been stored are not described again.
+
+    :param workspace:   The path to the workspace (e.g. File Geodatabase or SDE connection file).
+    :type workspace:    str, unicode
+    :return:            The number of tables for which the properties have been cached.
+    :rtype:             int
+    """
+    count = 0
+    for dirpath, _, filenames in _arcpy.da.Walk(workspace, datatype=_PREWARM_TYPES):
+        for filename in filenames:
+            _get_table_props(_os.path.join(dirpath, filename))
+            count += 1
+    save_table_store()
+    return count
+
+
+def recover(journal_path, output_path, project_path, encoding=None, pretty=True):
+    """
+    Rebuilds a GEONIS Protocol XML file from a checkpoint journal (see :func:`Logger.checkpoint`),
+    e.g. after the process that wrote the journal has crashed.
+    A damaged batch at the end of the journal (i.e. a partially written one) is skipped with a warning.
+    The journal file itself is left untouched.
+    Entries that were kept in a sample reservoir (see :func:`Logger.set_limit`) are not part of the journal.
+
+    :param journal_path:    The full path to the journal file.
+    :param output_path:     The full path to the output protocol XML that should be written.
+    :param project_path:    The full path to the GEONIS project to which the protocol applies.
+    :param encoding:        Optional encoding to use for the protocol file (default = ISO-8859-1).
+    :param pretty:          If ``True`` (default), the XML is indented. Set to ``False`` to omit all whitespace.
+    :type journal_path:     str, unicode
+    :type output_path:      str, unicode
+    :type project_path:     str, unicode
+    :type encoding:         str, unicode
+    :type pretty:           bool
+    :return:                The number of recovered entries.
+    :rtype:                 int
+    """
+    stream = _ProtocolStream(output_path, project_path, encoding, pretty)
+    try:
+        for entry in _read_fragment(journal_path, True):
+            stream.write(entry)
+    finally:
+        stream.close(project_path)
+    return stream.count
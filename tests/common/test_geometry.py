@@ -14,12 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from xml.etree.cElementTree import Element
 from xml.etree.cElementTree import tostring
 
 import pytest
 
+from gntools.common import geometry
 from gntools.common.geometry import GeometrySerializationError
 from gntools.common.geometry import serialize
+from gntools.common.geometry import serialize_many
+from gntools.common.geometry import serialize_to_bytes
+from gntools.common.geometry import to_wkt
 
 
 def test_points():
@@ -112,7 +117,7 @@ def test_polygons():
            '<BezierCurve esrienum="15"><Point esrienum="1" x="11" y="11" /><Point esrienum="1" x="10" y="17" />' \
            '<Point esrienum="1" x="15" y="15" /><Point esrienum="1" x="18" y="20" /></BezierCurve>' \
            '<Line esrienum="13"><Point esrienum="1" x="15" y="15" /><Point esrienum="1" x="11" y="11" /></Line>' \
-           '</Ring><Ring esrienum="11" isexterior="true"><CircularArc esrienum="14" isCCW="false" isMinor="true">' \
+           '</Ring><Ring esrienum="11" isexterior="true"><CircularArc esrienum="14" isCCW="false" isMinor="false">' \
            '<Point esrienum="1" x="20" y="14" /><Point esrienum="1" x="15" y="15" />' \
            '<Point esrienum="1" x="20" y="16" /></CircularArc><Line esrienum="13">' \
            '<Point esrienum="1" x="20" y="16" /><Point esrienum="1" x="15" y="15" /></Line></Ring></Polygon></geometry>'
@@ -355,3 +360,175 @@ def test_polygons():
 
     with pytest.raises(GeometrySerializationError):
         serialize('{"rings": []}')
+
+
+def test_wkt():
+    assert to_wkt('{"x": -118.15, "y": 33.80, "z": 10.0}') == 'POINT (-118.15 33.8)'
+    assert to_wkt((2600000, 1200000.5)) == 'POINT (2600000.0 1200000.5)'
+    assert to_wkt('{"x": "NaN", "y": 22.2}') == 'POINT EMPTY'
+    assert to_wkt('{"paths": [[[0, 0], [1, 1]]]}') == 'LINESTRING (0.0 0.0, 1.0 1.0)'
+    assert to_wkt('{"paths": [[[0, 0], [1, 1]], [[2, 2], [3, 3, 1]]]}') == \
+        'MULTILINESTRING ((0.0 0.0, 1.0 1.0), (2.0 2.0, 3.0 3.0))'
+    assert to_wkt('{"curvePaths": [[[0, 0], {"c": [[2, 0], [1, 1]]}]]}') == 'LINESTRING (0.0 0.0, 1.0 1.0, 2.0 0.0)'
+
+    exterior = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    interior = [[2, 2], [2, 4], [4, 4], [4, 2], [2, 2]]
+    assert to_wkt({'rings': [exterior, interior]}) == \
+        'POLYGON ((0.0 0.0, 10.0 0.0, 10.0 10.0, 0.0 10.0, 0.0 0.0), (2.0 2.0, 2.0 4.0, 4.0 4.0, 4.0 2.0, 2.0 2.0))'
+    assert to_wkt({'rings': [exterior, exterior]}).startswith('MULTIPOLYGON (((0.0 0.0')
+
+    with pytest.raises(NotImplementedError):
+        to_wkt('{"points": [[0, 0]]}')
+
+
+@pytest.mark.parametrize('rings', [
+    [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], [[2, 2], [2, 4], [4, 4], [4, 2], [2, 2]]],
+    [[[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]], [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]],
+    [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], [[20, 0], [30, 0], [30, 10], [20, 10], [20, 0]]],
+])
+def test_wkt_exterior_rings(rings):
+    # The WKT polygons must start at the same rings that the GEONIS XML marks as exterior rings
+    exterior = [ring.get('isexterior') == 'true' for ring in serialize({'rings': rings}).iter('Ring')]
+    wkt = to_wkt({'rings': rings})
+    expected = 1 + sum(exterior[1:])
+    assert wkt.startswith('MULTIPOLYGON' if expected > 1 else 'POLYGON')
+    assert wkt.count('((') == expected
+
+
+def _indent(element, level):
+    """ Returns the ElementTree output of *element*, where each element is on a new line and indented by tabs. """
+    indent = '\n' + '\t' * level
+    if not len(element):
+        return indent + tostring(element)
+    start = tostring(Element(element.tag, element.attrib))[:-len(' />')] + '>'
+    children = ''.join(_indent(child, level + 1) for child in element)
+    return '{}{}{}{}</{}>'.format(indent, start, children, indent, element.tag)
+
+
+@pytest.mark.parametrize('shape', [
+    '{"x": -118.15, "y": 33.80, "z": 10.0}',
+    (2600000.123456789, 1200000.5),
+    {},
+    '{"paths": [[[0, 0], [1, 1]]]}',
+    '{"paths": [[[0, 0], [1, 1]], [[2, 2]]]}',
+    '{"curvePaths": [[[6, 3], [5, 3], {"b": [[3, 2], [6, 1], [2, 4]]}, [1, 2], {"c": [[0, 2], [0, 3]]}]]}',
+    '{"curveRings": [[[11, 11], [10, 10], [10, 11], {"a": [[15, 15], [20, 20], 0, 1, 0.5, 2, 0.3]}, [11, 11]], '
+    '[[15, 15], {"c": [[20, 16], [20, 14]]}, [15, 15]], [[1, 1]]]}',
+])
+def test_serialize_to_bytes(shape):
+    assert serialize_to_bytes(shape) == tostring(serialize(shape))
+    assert serialize_to_bytes(shape, 3) == _indent(serialize(shape), 3)
+
+
+def test_serialize_to_bytes_errors():
+    for shape, error in (('{"x": "NaN", "y": 22.2}', GeometrySerializationError),
+                         ('{"paths": []}', GeometrySerializationError),
+                         ('{"points": [[0, 0]]}', NotImplementedError)):
+        with pytest.raises(error):
+            serialize_to_bytes(shape)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_serialize_many(workers):
+    geometries = ['{{"x": {}, "y": 1}}'.format(i) for i in range(25)]
+    geometries[7] = '{"paths": [[[0, 0], [1, 1]]]}'
+    expected = [serialize_to_bytes(g) for g in geometries]
+    assert list(serialize_many(iter(geometries), workers, chunksize=4)) == expected
+    assert list(serialize_many(geometries[:4], long(workers), chunksize=long(2))) == expected[:4]
+
+    geometries[3] = '{"x": "NaN", "y": 1}'
+    results = list(serialize_many(geometries, workers, chunksize=4, strict=False))
+    assert isinstance(results[3], GeometrySerializationError)
+    assert results[4:] == expected[4:]
+    with pytest.raises(GeometrySerializationError):
+        list(serialize_many(geometries, workers, chunksize=4))
+    with pytest.raises(ValueError):
+        list(serialize_many(geometries, 0))
+    with pytest.raises(ValueError):
+        list(serialize_many(geometries, True))
+
+
+def test_serialize_many_host(monkeypatch):
+    # No worker processes are started if Python is embedded in a host application
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a process pool was started')
+
+    monkeypatch.setattr(geometry._sys, 'executable', 'C:\\Program Files (x86)\\ArcGIS\\Desktop10.6\\bin\\ArcMap.exe')
+    monkeypatch.setattr(geometry._mp, 'Pool', no_pool)
+    geometries = ['{{"x": {}, "y": 1}}'.format(i) for i in range(10)]
+    assert list(serialize_many(geometries, 2, chunksize=4)) == [serialize_to_bytes(g) for g in geometries]
+    assert list(serialize_many(geometries[:2])) == [serialize_to_bytes(g) for g in geometries[:2]]
+
+
+def test_is_clockwise(monkeypatch):
+    np = pytest.importorskip('numpy')
+
+    angles = [i * 2 * np.pi / 100 for i in range(100)]
+    ring = [[2600000 + np.cos(a) * 50, 1200000 + np.sin(a) * 50, 3.0] for a in angles]
+    ring.append(ring[0])
+    reverse = list(reversed(ring))
+    ragged = [p[:2] for p in ring[:10]] + ring[10:]
+
+    assert geometry.is_clockwise(ring) and geometry.is_clockwise(ragged) and not geometry.is_clockwise(reverse)
+    assert geometry.is_clockwise(np.array(ring)) and not geometry.is_clockwise(np.array(reverse))
+    assert geometry._get_array(ragged) is None
+    curved = ring[:50] + [{'c': [ring[51], ring[50]]}] + ring[52:]
+    assert geometry._get_array(curved) is None and geometry.is_clockwise(curved)
+    assert geometry._get_array(ring[:10]) is None
+    vectorized = geometry._get_shoelace(ring)
+
+    monkeypatch.setattr(geometry, '_np', None)
+    assert geometry.is_clockwise(ring) and not geometry.is_clockwise(reverse)
+    assert geometry._get_shoelace(ring) == pytest.approx(vectorized)
+
+
+def test_arcs():
+    assert geometry.get_angle((0, 0), (1, 0), (0, 1)) == pytest.approx(90)
+    assert geometry.get_angle((5, 5), (7, 5), (3, 5)) == pytest.approx(180)
+    points = (2614837.9, 1208259.8), (2614830.1, 1208265.6), (2614837.9, 1208271.8)
+    center = geometry.get_arc_center(*points)
+    radii = [((x - center[0]) ** 2 + (y - center[1]) ** 2) ** 0.5 for x, y in points]
+    assert radii == pytest.approx([radii[0]] * 3, abs=1e-6)
+    assert geometry.get_arc_center((1, 0), (0, 1), (-1, 0)) == pytest.approx((0, 0))
+    assert geometry.is_minor((1, 0), (0.6, 0.8), (0, 1))
+    assert not geometry.is_minor((1, 0), (-1, 0), (0, 1))
+    assert not geometry.is_minor((15, 15), (20, 14), (20, 16))
+    assert not geometry.is_minor((1, 0), (0, 1), (-1, 0))  # semicircle
+    with pytest.raises(GeometrySerializationError):
+        geometry.get_arc_center((0, 0), (1, 1), (2, 2))
+
+
+def test_arc_properties():
+    np = pytest.importorskip('numpy')
+
+    rng = np.random.RandomState(42)
+    arcs = [tuple(tuple(p) for p in 2600000 + rng.rand(3, 2) * 100) for _ in range(50)]
+    centers, clockwise, minor = geometry.get_arc_properties(arcs)
+    assert 0 < minor.sum() < len(arcs)
+    for (s, m, e), center, cw, mn in zip(arcs, centers, clockwise, minor):
+        assert tuple(center) == geometry.get_arc_center(s, m, e)
+        assert cw == geometry.is_clockwise([s, m, e, s])
+        assert mn == geometry.is_minor(s, m, e)
+    with pytest.raises(GeometrySerializationError):
+        geometry.get_arc_properties([((0, 0), (1, 1), (2, 2))])
+    _, _, minor = geometry.get_arc_properties([((1, 0), (0.6, 0.8), (0, 1)), ((1, 0), (-1, 0), (0, 1))])
+    assert list(minor) == [True, False]
+
+    path = [[0, 0]]
+    for i in range(1, 13):
+        path.append({'c': [[i * 10, 0], [i * 10 - 5, (-1) ** i * 2]]})
+    shape = {'curvePaths': [path]}
+    assert serialize_to_bytes(shape) == tostring(serialize(shape))
+
+
+def test_serialize_arc_kernel(monkeypatch):
+    pytest.importorskip('numpy')
+
+    # Both serializers calculate many arcs with the batch kernel
+    calls = []
+    get_arc_properties = geometry.get_arc_properties
+    monkeypatch.setattr(geometry, 'get_arc_properties', lambda arcs: calls.append(arcs) or get_arc_properties(arcs))
+    ring = [[0, 0]] + [{'c': [[i, 0], [i - 0.5, 0.25]]} for i in range(1, 11)] + [[0, -1], [0, 0]]
+    shape = {'curveRings': [ring]}
+    assert serialize_to_bytes(shape) == tostring(serialize(shape))
+    assert len(calls) == 2 and calls[0] == calls[1]
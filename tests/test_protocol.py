@@ -0,0 +1,856 @@
+# coding: utf-8
+#
+# Copyright 2019 Geocom Informatik AG / VertiGIS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+from xml.etree import cElementTree as Xml
+
+import pytest
+
+import gntools.protocol as protocol
+
+TEST_TABLE = 'C:/temp/test.gdb/ele_kabel'
+TEST_GUID = '{459B46CE-6370-48AE-B3CC-220026D49EC2}'
+TEST_POINT = '{"x": 2600000.5, "y": 1200000.25}'
+
+
+class _FakeProps(object):
+    workspace = 'C:\\temp\\test.gdb'
+    table = 'ele_kabel'
+    globalid_field = 'GlobalID'
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    # Prevent Describe() calls on the test table and use a new writer, so that no state leaks between tests
+    monkeypatch.setitem(protocol._table_cache, os.path.normpath(TEST_TABLE).lower(), _FakeProps())
+    return protocol.ProtocolWriter()
+
+
+def test_stream(writer, tmpdir):
+    xml_path = str(tmpdir.join('stream.xml'))
+    writer.stream(xml_path)
+    writer.error('Error', protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.blank()
+    assert not writer._entries
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+
+    root = Xml.parse(xml_path).getroot()
+    assert root.get('currentproject') == 'project.gnp'
+    entries = root.findall('Entry')
+    assert len(entries) == 2
+    with open(xml_path, 'rb') as f:
+        start_tag = f.read().split('\n')[1]
+    assert start_tag.startswith('<ObjectLog currentproject="project.gnp"') and '" >' not in start_tag
+    assert entries[0].get('message') == 'Error'
+    assert entries[0].find('Object/feature/dataid').get('val') == TEST_GUID
+    assert entries[0].find('Object/geometry/Point').get('x') == '2600000.5'
+    assert entries[1].get('message') is None
+
+
+def test_flush_buffered(writer, tmpdir):
+    xml_path = str(tmpdir.join('buffered.xml'))
+    writer.warn('Warning', protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.info(u'Info \xe4')
+    assert all(isinstance(e, protocol._Entry) for e in writer._entries)
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+    assert not writer._entries
+
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    assert [e.get('messagetype') for e in entries] == ['3', '5']
+    assert entries[0].find('Object/feature/dataid').get('tbl') == 'ele_kabel'
+    assert entries[0].find('Object/geometry/Point').get('y') == '1200000.25'
+    assert entries[1].get('message') == u'Info \xe4'
+
+
+@pytest.mark.parametrize('pretty', [True, False])
+def test_flush_append(writer, tmpdir, pretty):
+    xml_path = str(tmpdir.join('append.xml'))
+    writer.info('First')
+    writer.flush(xml_path, 'C:/temp/project.gnp', pretty=pretty)
+    writer.warn(u'Second \xe4')
+    writer.error('Third')
+    writer.flush(xml_path, 'C:/temp/other.gnp', encoding='utf-8', pretty=pretty, append=True)
+
+    root = Xml.parse(xml_path).getroot()
+    assert root.get('currentproject') == 'project.gnp'
+    assert [e.get('message') for e in root.findall('Entry')] == ['First', u'Second \xe4', 'Third']
+
+    # Appending to a missing protocol simply creates it
+    new_path = str(tmpdir.join('new.xml'))
+    writer.info('New')
+    writer.flush(new_path, 'C:/temp/project.gnp', append=True)
+    assert len(Xml.parse(new_path).getroot().findall('Entry')) == 1
+
+
+def test_flush_append_invalid(writer, tmpdir):
+    xml_path = tmpdir.join('invalid.xml')
+    xml_path.write('<Other />')
+    writer.info('Entry')
+    with pytest.raises(ValueError):
+        writer.flush(str(xml_path), 'C:/temp/project.gnp', append=True)
+    assert xml_path.read() == '<Other />'
+
+
+def test_log_many(writer):
+    count = writer.log_many([
+        ('error', 'Error', TEST_TABLE, TEST_GUID, TEST_POINT),
+        (protocol._GNLOG_TYPE_WARNING, 'Warning', TEST_TABLE, TEST_GUID.lower(), None),
+        ('info', 'Info', None, None, None)
+    ])
+    assert count == 3
+    assert [e.msg_type for e in writer._entries] == [4, 3, 5]
+    assert len(set(e.date for e in writer._entries)) == 1
+    assert writer._entries[1].data_id == ('C:\\temp\\test.gdb', 'ele_kabel', 'GlobalID', TEST_GUID)
+    assert writer._entries[2].data_id is None
+
+    with pytest.raises(ValueError):
+        writer.log_many([('bad', 'Bad type', None, None, None)])
+
+
+def test_log_many_array(writer):
+    np = pytest.importorskip('numpy')
+
+    dtype = [('OBJECTID', int), ('TYPE', 'S10'), ('MSG', 'S20'), ('TBL', object), ('GID', object), ('SHAPE', object)]
+    rows = np.array([(1, 'error', 'Error', TEST_TABLE, TEST_GUID, TEST_POINT),
+                     (2, 'info', 'Info', None, None, None)], dtype=dtype)
+    assert writer.log_many(rows, ('TYPE', 'MSG', 'TBL', 'GID', 'SHAPE')) == 2
+    assert [(e.msg_type, e.message) for e in writer._entries] == [(4, 'Error'), (5, 'Info')]
+    assert writer._entries[0].data_id[-1] == TEST_GUID and writer._entries[0].shape == TEST_POINT
+    assert writer._entries[1].data_id is None
+
+    # Without field names, the array must only hold the 5 entry fields
+    assert writer.log_many(rows[['TYPE', 'MSG', 'TBL', 'GID', 'SHAPE']].copy()) == 2
+    assert len(writer._entries) == 4
+    with pytest.raises(ValueError):
+        writer.log_many(rows)
+    with pytest.raises(ValueError):
+        writer.log_many(rows, ('TYPE', 'MSG'))
+
+
+@pytest.mark.parametrize('order', ['date', 'submission'])
+def test_concurrent(writer, tmpdir, order):
+    def work(n):
+        for i in range(100):
+            writer.warn('Thread {} warning {}'.format(n, i))
+
+    writer.set_concurrent(order=order)
+    writer.info('Start')
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    xml_path = str(tmpdir.join('concurrent.xml'))
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+    messages = [e.get('message') for e in Xml.parse(xml_path).getroot().findall('Entry')]
+    assert len(messages) == 401
+    assert messages[0] == 'Start'
+    for n in range(4):
+        thread_messages = [m for m in messages if m.startswith('Thread {} '.format(n))]
+        assert thread_messages == ['Thread {} warning {}'.format(n, i) for i in range(100)]
+
+
+def test_fragments(writer, tmpdir):
+    fragments = []
+    for n in range(3):
+        for i in range(5):
+            writer.error('Worker {} error {}'.format(n, i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+        fragments.append(str(tmpdir.join('fragment{}.pkl'.format(n))))
+        assert writer.write_fragment(fragments[-1]) == 5
+        assert not writer._entries
+
+    writer.info('Coordinator')
+    xml_path = str(tmpdir.join('merged.xml'))
+    writer.merge_fragments(xml_path, 'C:/temp/project.gnp', fragments)
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    assert len(entries) == 16
+    assert [e.get('date') for e in entries] == sorted(e.get('date') for e in entries)
+    assert [e.get('message') for e in entries][:2] == ['Worker 0 error 0', 'Worker 0 error 1']
+    assert entries[-1].get('message') == 'Coordinator'
+
+
+def test_merge_fragments_sinks(writer, tmpdir):
+    fragment = str(tmpdir.join('fragment.pkl'))
+    for i in range(15):
+        writer.error('Worker error {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.write_fragment(fragment)
+
+    jsonl_path = str(tmpdir.join('merged.jsonl'))
+    writer.add_sink(protocol.JsonLinesSink(jsonl_path))
+    writer.set_dedup()
+    writer.error('Coordinator', protocol.Feature(TEST_TABLE, TEST_GUID))
+    writer.merge_fragments(str(tmpdir.join('merged.xml')), 'C:/temp/project.gnp', [fragment], max_entries=10)
+    assert not writer._sinks
+
+    with open(jsonl_path, 'rb') as f:
+        assert len(f.read().splitlines()) == 16
+    index = Xml.parse(str(tmpdir.join('merged_parts.xml'))).getroot()
+    assert [p.get('entries') for p in index.findall('Part')] == ['10', '6']
+
+    # The duplicate filter has been reset, so the same feature entry is logged again
+    writer.error('Coordinator', protocol.Feature(TEST_TABLE, TEST_GUID))
+    assert len(writer._entries) == 1
+
+
+def test_flush_background(writer, tmpdir):
+    xml_path = str(tmpdir.join('background.xml'))
+    for i in range(50):
+        writer.warn('Warning {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    handle = writer.flush(xml_path, 'C:/temp/project.gnp', background=True)
+    writer.info('Next protocol')
+    assert handle.wait()
+    assert handle.done and handle.error is None
+    assert len(Xml.parse(xml_path).getroot().findall('Entry')) == 50
+    assert len(writer._entries) == 1
+
+    handle = writer.flush(str(tmpdir.join('bad.xml')), 'C:/temp/project.gnp', encoding='bad', background=True)
+    with pytest.raises(LookupError):
+        handle.wait()
+    assert isinstance(handle.error, LookupError)
+
+
+def test_flush_compact(writer, tmpdir):
+    pretty_path = str(tmpdir.join('pretty.xml'))
+    compact_path = str(tmpdir.join('compact.xml'))
+    feature = protocol.Feature(TEST_TABLE, TEST_GUID, '{"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}')
+    writer.error('Error', feature)
+    writer.flush(pretty_path, 'C:/temp/project.gnp')
+    writer.error('Error', feature)
+    writer.flush(compact_path, 'C:/temp/project.gnp', pretty=False)
+
+    with open(compact_path, 'rb') as f:
+        compact = f.read().split('\n', 1)[1]
+    assert '\n' not in compact and '\t' not in compact
+    pretty_root = Xml.parse(pretty_path).getroot()
+    compact_root = Xml.parse(compact_path).getroot()
+    assert len(compact_root.findall('Entry/Object/geometry/Polygon/Ring/Line/Point')) == 6
+    assert [e.tag for e in pretty_root.iter()] == [e.tag for e in compact_root.iter()]
+
+
+def test_feature_write_elements(writer):
+    element = Xml.Element('Object')
+    with pytest.deprecated_call():
+        protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT).write_elements(element)
+    assert element.find('feature/dataid').get('val') == TEST_GUID
+    assert element.find('geometry/Point').get('x') == '2600000.5'
+
+
+def test_write_indented():
+    parts = []
+    protocol._write_indented(parts.append, '<a x="1"><b y="&amp;"><c /></b><d /></a>', 1)
+    assert ''.join(parts) == '\n\t<a x="1">\n\t\t<b y="&amp;">\n\t\t\t<c />\n\t\t</b>\n\t\t<d />\n\t</a>'
+
+
+def test_stream_rotation(writer, tmpdir):
+    xml_path = str(tmpdir.join('rotated.xml'))
+    writer.stream(xml_path, 'C:/temp/project.gnp', max_entries=10)
+    for i in range(25):
+        writer.warn('Warning {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+
+    index = Xml.parse(str(tmpdir.join('rotated_parts.xml'))).getroot()
+    parts = [(p.get('file'), p.get('entries')) for p in index.findall('Part')]
+    assert parts == [('rotated_001.xml', '10'), ('rotated_002.xml', '10'), ('rotated_003.xml', '5')]
+    for name, count in parts:
+        root = Xml.parse(str(tmpdir.join(name))).getroot()
+        assert root.get('currentproject') == 'project.gnp'
+        assert len(root.findall('Entry')) == int(count)
+
+    with pytest.raises(ValueError):
+        writer.stream(xml_path, max_bytes=1000)
+
+
+def test_flush_rotation(writer, tmpdir):
+    xml_path = str(tmpdir.join('buffered.xml'))
+    for i in range(25):
+        writer.warn('Warning {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.flush(xml_path, 'C:/temp/project.gnp', max_entries=10)
+
+    assert not tmpdir.join('buffered.xml').check()
+    index = Xml.parse(str(tmpdir.join('buffered_parts.xml'))).getroot()
+    parts = [(p.get('file'), p.get('entries')) for p in index.findall('Part')]
+    assert parts == [('buffered_001.xml', '10'), ('buffered_002.xml', '10'), ('buffered_003.xml', '5')]
+    for name, count in parts:
+        assert len(Xml.parse(str(tmpdir.join(name))).getroot().findall('Entry')) == int(count)
+
+    with pytest.raises(ValueError):
+        writer.flush(xml_path, 'C:/temp/project.gnp', append=True, max_bytes=1000)
+    with pytest.raises(ValueError):
+        writer.flush(None, 'C:/temp/project.gnp', max_entries=10)
+
+
+def test_checkpoint_recover(writer, tmpdir):
+    journal_path = str(tmpdir.join('journal.pkl'))
+    writer.checkpoint(journal_path, every=10)
+    for i in range(25):
+        writer.error('Error {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+
+    # Simulate a crash: the last 5 entries were not committed yet and the last batch is damaged
+    with open(journal_path, 'rb') as f:
+        data = f.read()
+    with open(journal_path, 'wb') as f:
+        f.write(data[:-20])
+    xml_path = str(tmpdir.join('recovered.xml'))
+    with pytest.warns(UserWarning):
+        assert protocol.recover(journal_path, xml_path, 'C:/temp/project.gnp') == 10
+    assert len(Xml.parse(xml_path).getroot().findall('Entry')) == 10
+
+    writer.flush(str(tmpdir.join('flushed.xml')), 'C:/temp/project.gnp')
+    assert not os.path.exists(journal_path)
+
+
+def test_checkpoint_interval(writer, tmpdir):
+    journal_path = str(tmpdir.join('journal.pkl'))
+    writer.checkpoint(journal_path, every=1000, interval=0.05)
+    for i in range(3):
+        writer.error('Error {}'.format(i))
+
+    # The pending batch is committed by the timer, although no new entries are logged
+    deadline = time.time() + 5
+    while not os.path.getsize(journal_path) and time.time() < deadline:
+        time.sleep(0.01)
+    assert [e.message for e in protocol._read_fragment(journal_path)] == ['Error 0', 'Error 1', 'Error 2']
+
+    writer.checkpoint(None)
+    assert not os.path.exists(journal_path)
+
+
+def test_delphi_clock(monkeypatch):
+    clock = protocol._DelphiClock()
+    monkeypatch.setattr(protocol._time, 'time', lambda: 1500000000.75)
+    expected = '{:.13f}'.format((abs(protocol._DELPHI_EPOCH) + protocol._TZ_OFFSET + 1500000000) / 86400.)
+    assert clock.now() == expected
+
+    # Clock never goes back in time
+    monkeypatch.setattr(protocol._time, 'time', lambda: 1499999000.0)
+    assert clock.now() == expected
+
+    clock.resolution = 0.5
+    assert clock.format(1500000000.75) > expected
+    with pytest.raises(ValueError):
+        clock.resolution = 0
+
+    # Cache does not grow beyond its limit
+    for i in xrange(protocol._CLOCK_CACHE_SIZE * 3):
+        clock.format(1500000000 + i)
+    assert len(clock._cache) <= protocol._CLOCK_CACHE_SIZE
+
+    date = protocol._dt(2018, 6, 1, 12, 30, 15, 999)
+    assert protocol._get_delphi_time(date) == '{:.13f}'.format(
+        (abs(protocol._DELPHI_EPOCH) + protocol._TZ_OFFSET + protocol._mktime(date.timetuple())) / 86400.)
+
+
+class _FakeDescribe(object):
+    calls = []
+
+    def __init__(self, element):
+        self.calls.append(element)
+        self.globalIDFieldName = 'GLOBALID'
+
+
+def _no_version_table(path, *args, **kwargs):
+    raise RuntimeError('cannot open {}'.format(path))
+
+
+def _make_gdb(tmpdir):
+    # Fake File Geodatabase folder with a system catalog table
+    gdb = tmpdir.mkdir('test.gdb')
+    gdb.join(protocol._GDB_CATALOG).write('')
+    return gdb
+
+
+@pytest.fixture
+def describe(monkeypatch):
+    # Start with an empty table cache and count the (fake) Describe() calls
+    monkeypatch.setattr(protocol, '_table_cache', {})
+    monkeypatch.setattr(protocol._meta, 'Describe', _FakeDescribe)
+    monkeypatch.setattr(protocol._cursors, 'SearchCursor', _no_version_table)
+    monkeypatch.setattr(_FakeDescribe, 'calls', [])
+    return _FakeDescribe
+
+
+def test_table_store(describe, tmpdir):
+    store_path = str(tmpdir.join('store', 'tables.json'))
+    table_path = str(_make_gdb(tmpdir).join('ele_kabel'))
+
+    protocol.use_table_store(store_path)
+    try:
+        assert protocol._get_table_props(table_path).globalid_field == 'GLOBALID'
+        assert len(describe.calls) == 1
+        assert not os.path.exists(store_path)
+        protocol.save_table_store()
+        assert os.path.isfile(store_path)
+
+        # A new process (i.e. empty memory cache) uses the stored properties
+        protocol._table_cache.clear()
+        protocol.use_table_store(store_path)
+        props = protocol._get_table_props(table_path)
+        assert (props.table, props.globalid_field) == ('ele_kabel', 'GLOBALID')
+        assert len(describe.calls) == 1
+
+        # Stored properties survive lock files, which change the modification time of the geodatabase folder
+        protocol._table_cache.clear()
+        gdb_path = os.path.dirname(table_path)
+        lock_path = os.path.join(gdb_path, '_gdb.HOST.1234.5678.sr.lock')
+        with open(lock_path, 'wb'):
+            pass
+        os.utime(gdb_path, (0, os.path.getmtime(gdb_path) + 10))
+        protocol.use_table_store(store_path)
+        protocol._get_table_props(table_path)
+        assert len(describe.calls) == 1
+        os.remove(lock_path)
+
+        # Stored properties are discarded when the geodatabase schema has changed
+        protocol._table_cache.clear()
+        catalog_path = os.path.join(gdb_path, protocol._GDB_CATALOG)
+        os.utime(catalog_path, (0, os.path.getmtime(catalog_path) + 10))
+        protocol.use_table_store(store_path)
+        protocol._get_table_props(table_path)
+        assert len(describe.calls) == 2
+    finally:
+        protocol.use_table_store(None)
+
+
+def test_prewarm_tables(describe, tmpdir, monkeypatch):
+    store_path = str(tmpdir.join('tables.json'))
+    gdb_path = str(_make_gdb(tmpdir))
+    walked = []
+
+    def walk(workspace, datatype=None):
+        walked.append((workspace, datatype))
+        yield gdb_path, ['fds'], ['ele_kabel']
+        yield os.path.join(gdb_path, 'fds'), [], ['ele_muffe', 'ele_trasse']
+
+    monkeypatch.setattr(protocol._arcpy.da, 'Walk', walk)
+    protocol.use_table_store(store_path)
+    try:
+        assert protocol.prewarm_tables(gdb_path) == 3
+        assert walked == [(gdb_path, ['FeatureClass', 'Table'])]
+        assert len(describe.calls) == 3
+
+        # Prewarmed tables (also those in a feature dataset) are not described again in a new process
+        protocol._table_cache.clear()
+        protocol.use_table_store(store_path)
+        props = protocol._get_table_props(os.path.join(gdb_path, 'fds', 'ele_muffe'))
+        assert props.table == 'ele_muffe' and props.workspace == gdb_path
+        assert protocol.prewarm_tables(gdb_path) == 3
+        assert len(describe.calls) == 3
+    finally:
+        protocol.use_table_store(None)
+
+
+def test_table_store_threads(describe, tmpdir):
+    store_path = str(tmpdir.join('tables.json'))
+    gdb = _make_gdb(tmpdir)
+
+    def describe(offset):
+        for i in range(offset, 400, 4):
+            protocol._get_table_props(str(gdb.join('table_{}'.format(i))))
+
+    protocol.use_table_store(store_path)
+    try:
+        threads = [threading.Thread(target=describe, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        protocol.save_table_store()
+        with open(store_path, 'rb') as f:
+            stored = json.load(f)
+        assert sum(len(ws[protocol._STORE_TABLES]) for ws in stored.values()) == 400
+        assert sorted(os.listdir(str(tmpdir))) == ['tables.json', 'test.gdb']
+    finally:
+        protocol.use_table_store(None)
+
+
+def test_table_store_no_stamp(describe, tmpdir):
+    # Without a GEONIS version table, the tables of an SDE database are not stored
+    store = protocol._TableStore(str(tmpdir.join('tables.json')))
+    table_path = str(tmpdir.join('test.sde', 'ele_kabel'))
+    with pytest.warns(UserWarning, match='Table store is not used'):
+        store.put(table_path, protocol._TableProps.from_record(('a', 'b', 'c')))
+    assert store.get(table_path) is None
+    store.save()
+    assert not tmpdir.join('tables.json').check()
+
+
+def test_table_store_save_error(describe, tmpdir):
+    tmpdir.join('blocked').write('')
+    store = protocol._TableStore(str(tmpdir.join('blocked', 'tables.json')))
+    store.put(str(_make_gdb(tmpdir).join('ele_kabel')), protocol._TableProps.from_record(('a', 'b', 'c')))
+    with pytest.warns(UserWarning):
+        store.save()
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_deferred_geometry(writer, tmpdir, workers):
+    xml_path = str(tmpdir.join('deferred.xml'))
+    writer.set_geometry_workers(long(workers))
+    for i in range(3):
+        writer.error('Error {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.warn('Bad', protocol.Feature(TEST_TABLE, TEST_GUID, '{"x": 1'))
+    assert all(e.geometry is None and e.shape for e in writer._entries)
+
+    with pytest.warns(UserWarning):
+        writer.flush(xml_path, 'C:/temp/project.gnp')
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    assert [e.find('Object/geometry/Point').get('x') for e in entries[:3]] == ['2600000.5'] * 3
+    assert entries[3].find('Object/geometry') is None
+    assert entries[3].find('Object/feature/dataid') is not None
+    with pytest.raises(ValueError):
+        writer.set_geometry_workers(True)
+
+
+def test_deferred_geometry_host(writer, tmpdir, monkeypatch):
+    # In a host application (e.g. ArcMap), the geometries are serialized without a process pool
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a process pool was started')
+
+    monkeypatch.setattr(protocol._geometry._sys, 'executable', 'C:\\Program Files\\ArcGIS\\Pro\\bin\\ArcGISPro.exe')
+    monkeypatch.setattr(protocol._geometry._mp, 'Pool', no_pool)
+    xml_path = str(tmpdir.join('host.xml'))
+    writer.set_geometry_workers(2)
+    for i in range(3):
+        writer.error('Error {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    assert [e.find('Object/geometry/Point').get('x') for e in entries] == ['2600000.5'] * 3
+
+
+def test_dedup(writer, tmpdir):
+    writer.set_dedup()
+    feature = protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT)
+    writer.error('Error', feature)
+    writer.error('Error', protocol.Feature(TEST_TABLE.upper(), TEST_GUID.lower()))
+    writer.warn('Error', feature)
+    writer.blank()
+    writer.blank()
+    assert writer.log_many([('error', 'Error', TEST_TABLE, TEST_GUID, None),
+                            ('error', u'Other', TEST_TABLE, TEST_GUID, None)]) == 1
+    assert len(writer._entries) == 5
+    assert writer.suppressed == 2
+
+    # Empty messages have the same fingerprint in both logging APIs
+    writer.error('', feature)
+    assert writer.log_many([('error', None, TEST_TABLE, TEST_GUID, None)]) == 0
+    assert len(writer._entries) == 6
+    assert writer.suppressed == 3
+
+    # The index is reset for a new protocol
+    writer.flush(str(tmpdir.join('dedup.xml')), 'C:/temp/project.gnp')
+    writer.error('Error', feature)
+    assert len(writer._entries) == 1
+    assert writer.suppressed == 3
+
+
+@pytest.mark.parametrize('sample', [False, True])
+def test_limits(writer, tmpdir, sample):
+    xml_path = str(tmpdir.join('limits.xml'))
+    writer.set_limit(3, 'warning', 'Rule A', sample)
+    try:
+        for i in range(10):
+            writer.warn('Rule A: {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+            writer.error('Rule A: {}'.format(i))
+        assert writer.log_many([('warning', 'Rule A: 10', None, None, None),
+                                ('warning', 'Rule B', None, None, None)]) == 1
+        writer.flush(xml_path, 'C:/temp/project.gnp')
+    finally:
+        writer.set_limit(None, 'warning', 'Rule A')
+    assert not writer._limits
+    writer.set_limit(long(3))
+    writer.set_limit(None)
+    with pytest.raises(ValueError):
+        writer.set_limit(3.0)
+    with pytest.raises(ValueError):
+        writer.set_limit(True)
+
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    warnings = [e.get('message') for e in entries if e.get('messagetype') == '3']
+    assert len([e for e in entries if e.get('messagetype') == '4']) == 10
+    assert len(warnings) == 5
+    assert 'Rule B' in warnings
+    assert warnings[-1].startswith('8 more entries were not logged')
+    if not sample:
+        assert warnings[:3] == ['Rule A: 0', 'Rule A: 1', 'Rule A: 2']
+
+
+def test_reader(writer, tmpdir):
+    xml_path = str(tmpdir.join('read.xml'))
+    writer.error('Error', protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.error('Error', protocol.Feature(TEST_TABLE, TEST_GUID))
+    writer.info(u'Info \xe4')
+    writer.blank()
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+
+    reader = protocol.ProtocolReader(xml_path, geometry=True)
+    assert reader.project == 'project.gnp'
+    entries = list(reader)
+    assert [e.msg_type for e in entries] == [4, 4, 5, 2]
+    assert [e.message for e in entries] == ['Error', 'Error', u'Info \xe4', None]
+    assert entries[0].data_id == ('C:\\temp\\test.gdb', 'ele_kabel', 'GlobalID', TEST_GUID)
+    assert Xml.fromstring(entries[0].geometry).find('Point').get('x') == '2600000.5'
+    assert entries[1].geometry is None and entries[2].data_id is None
+
+    # Entries that have been read can be written again (without any differences)
+    copy_path = str(tmpdir.join('copy.xml'))
+    writer._write_entries(copy_path, 'C:/temp/project.gnp', None, True, entries)
+    with open(xml_path, 'rb') as original, open(copy_path, 'rb') as copy:
+        assert original.read() == copy.read()
+
+    reader = protocol.ProtocolReader(xml_path)
+    assert reader.counts() == {4: 2, 5: 1, 2: 1}
+    assert reader.counts('table', 'message')[('ele_kabel', 'Error')] == 2
+    assert reader.counts(lambda e: e.geometry is None)[True] == 4
+    with pytest.raises(ValueError):
+        reader.counts('bad')
+
+
+@pytest.mark.parametrize('pretty', [True, False])
+def test_index(writer, tmpdir, pretty):
+    xml_path = str(tmpdir.join('indexed.xml'))
+    other_guid = '{00000000-0000-0000-0000-000000000001}'
+    writer.stream(str(tmpdir.join('streamed.xml')), index=True)
+    writer.header(u'Header \xe4')
+    for i in range(5):
+        writer.error('Error {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID if i % 2 else other_guid, TEST_POINT))
+        writer.warn('Warning {}'.format(i), protocol.Feature(TEST_TABLE, TEST_GUID))
+    # Long project path that does not fit in the reserved header space
+    writer.flush(xml_path, 'C:/{}/project.gnp'.format('x' * protocol._STREAM_RESERVE))
+    assert os.path.isfile(xml_path + '.idx')
+
+    index = protocol.ProtocolIndex(xml_path)
+    assert len(index) == 11
+    assert index[0].message == u'Header \xe4'
+    assert [e.message for e in index[-2:]] == ['Error 4', 'Warning 4']
+    assert [e.message for e in index[1:6:2]] == ['Error 0', 'Error 1', 'Error 2']
+    assert [e.message for e in index.find('error', 'ELE_KABEL', TEST_GUID.lower())] == ['Error 1', 'Error 3']
+    assert len(list(index.find('warning'))) == 5
+    assert not list(index.find(table='ele_muffe'))
+    geometry = next(index.find('error', geometry=True)).geometry
+    assert Xml.fromstring(geometry).find('Point') is not None
+
+    # Buffered protocols can be indexed as well, an outdated index is detected
+    writer.info('Info')
+    writer.flush(xml_path, 'C:/temp/project.gnp', pretty=pretty, index=True)
+    assert protocol.ProtocolIndex(xml_path)[0].message == 'Info'
+    writer.info('Appended')
+    writer.flush(xml_path, 'C:/temp/project.gnp', pretty=pretty, append=True)
+    with pytest.raises(ValueError):
+        protocol.ProtocolIndex(xml_path)
+
+
+def test_index_collision(writer, tmpdir, monkeypatch):
+    xml_path = str(tmpdir.join('collision.xml'))
+    writer.info('Info')
+    writer.error('Error', protocol.Feature(TEST_TABLE, TEST_GUID))
+    writer.flush(xml_path, 'C:/temp/project.gnp', index=True)
+
+    # Non-feature entries are indexed with zero hashes: a query hash that collides with them must not match
+    monkeypatch.setattr(protocol, '_get_table_hash', lambda table: 0)
+    monkeypatch.setattr(protocol, '_get_guid_hash', lambda global_id: 0)
+    index = protocol.ProtocolIndex(xml_path)
+    assert not list(index.find(table='ele_kabel'))
+    assert not list(index.find(global_id=TEST_GUID))
+    assert [e.message for e in index.find('info')] == ['Info']
+
+
+def _guid(i):
+    return '{{00000000-0000-0000-0000-{:012d}}}'.format(i)
+
+
+@pytest.mark.parametrize('padding', [(0, 50), (50, 0)])
+def test_diff_protocols(writer, monkeypatch, tmpdir, padding):
+    paths = []
+    for name, guids, pad in (('old', (1, 2), padding[0]), ('new', (2, 3), padding[1])):
+        paths.append(str(tmpdir.join(name + '.xml')))
+        writer.header('Validation')
+        for i in guids:
+            writer.error('Error', protocol.Feature(TEST_TABLE, _guid(i), TEST_POINT))
+        writer.warn('Warning', protocol.Feature(TEST_TABLE, _guid(1)))
+        for _ in range(pad):
+            writer.info('Padding')
+        writer.flush(paths[-1], 'C:/temp/{}.gnp'.format(name))
+
+    # Each protocol is parsed only once
+    parsed = []
+    iterate = protocol.ProtocolReader.__iter__
+    monkeypatch.setattr(protocol.ProtocolReader, '__iter__', lambda self: parsed.append(self.path) or iterate(self))
+
+    diff_path = str(tmpdir.join('diff.xml'))
+    assert protocol.diff_protocols(paths[0], paths[1], diff_path) == (1, 1, 2)
+    assert not tmpdir.listdir(lambda p: p.ext == '.tmp')
+    assert len(parsed) == len(set(parsed)) == 2
+
+    reader = protocol.ProtocolReader(diff_path, geometry=True)
+    assert reader.project == 'new.gnp'
+    entries = [(e.message, e.data_id and e.data_id[3]) for e in reader]
+    assert entries == [('New entries (1)', None), ('Error', _guid(3)),
+                       ('Resolved entries (1)', None), ('Error', _guid(1)),
+                       ('Unchanged entries (2)', None), ('Error', _guid(2)), ('Warning', _guid(1))]
+    assert all(e.geometry for e in reader if e.message == 'Error')
+
+
+def test_merge_protocols(writer, tmpdir):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmpdir.join('run{}.xml'.format(i))))
+        writer.error('Error', protocol.Feature(TEST_TABLE, _guid(i % 2)))
+        writer.info('Run {}'.format(i))
+        writer.flush(paths[-1], 'C:/temp/project.gnp')
+
+    merge_path = str(tmpdir.join('merged.xml'))
+    assert protocol.merge_protocols(merge_path, paths) == 6
+    assert protocol.merge_protocols(merge_path, paths, 'C:/temp/other.gnp', unique=True) == 5
+    reader = protocol.ProtocolReader(merge_path)
+    assert reader.project == 'other.gnp'
+    assert [e.message for e in reader].count('Error') == 2
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_sinks(writer, tmpdir, streaming):
+    import csv
+    import json
+
+    xml_path = str(tmpdir.join('sinks.xml'))
+    jsonl_path, csv_path = str(tmpdir.join('sinks.jsonl')), str(tmpdir.join('sinks.csv'))
+    writer.add_sink(protocol.JsonLinesSink(jsonl_path))
+    writer.add_sink(protocol.CsvSink(csv_path, geometry='wkt', delimiter=';'))
+    if streaming:
+        writer.stream(xml_path)
+        with pytest.raises(RuntimeError):
+            writer.add_sink(object())
+    writer.error(u'Error \xe4', protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+    writer.blank()
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+    assert not writer._sinks
+
+    with open(jsonl_path, 'rb') as f:
+        records = [json.loads(line) for line in f]
+    assert records[0] == {'messagetype': 4, 'message': u'Error \xe4', 'date': records[0]['date'],
+                          'con': 'C:\\temp\\test.gdb', 'tbl': 'ele_kabel', 'fld': 'GlobalID', 'val': TEST_GUID,
+                          'geometry': {'x': 2600000.5, 'y': 1200000.25}}
+    assert records[1]['message'] is None and records[1]['geometry'] is None
+
+    with open(csv_path, 'rb') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    assert rows[0] == list(protocol._SINK_FIELDS)
+    assert rows[1][1].decode('utf-8') == u'Error \xe4'
+    assert rows[1][-1] == 'POINT (2600000.5 1200000.25)'
+    assert len(rows) == 3
+
+    # The XML protocol is written in the same pass
+    entries = Xml.parse(xml_path).getroot().findall('Entry')
+    assert entries[0].find('Object/geometry/Point').get('x') == '2600000.5'
+    assert entries[0].get('date') == records[0]['date']
+
+
+def test_flush_file_like(writer, tmpdir):
+    import io
+    import re
+
+    def log_entries():
+        writer.warn('Warning', protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+        writer.info(u'Info \xe4')
+
+    def strip_dates(xml):
+        return re.sub(r' (last)?(change)?date="[^"]*"', '', xml)
+
+    xml_path = str(tmpdir.join('file.xml'))
+    log_entries()
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+    with open(xml_path, 'rb') as f:
+        expected = strip_dates(f.read())
+
+    log_entries()
+    data = writer.flush(None, 'C:/temp/project.gnp')
+    assert strip_dates(data) == expected
+
+    output = io.BytesIO()
+    log_entries()
+    assert writer.flush(output, 'C:/temp/project.gnp') is None
+    assert not output.closed
+    assert strip_dates(output.getvalue()) == expected
+
+    with pytest.raises(ValueError):
+        writer.flush(None, 'C:/temp/project.gnp', background=True)
+    with pytest.raises(ValueError):
+        writer.flush(io.BytesIO(), 'C:/temp/project.gnp', index=True)
+    writer.stream(xml_path)
+    with pytest.raises(ValueError):
+        writer.flush(None, 'C:/temp/project.gnp')
+    writer.flush(xml_path, 'C:/temp/project.gnp')
+
+
+def test_logger_singleton():
+    assert protocol.Logger() is protocol.Logger()
+    assert isinstance(protocol.Logger(), protocol.ProtocolWriter)
+
+
+def test_protocol_writers(writer, tmpdir):
+    writers = [protocol.ProtocolWriter() for _ in range(4)]
+    assert protocol.ProtocolWriter() is not writers[0]
+    writers[0].set_limit(2)
+
+    def work(n, other):
+        for i in range(5):
+            other.error('Error {} {}'.format(n, i), protocol.Feature(TEST_TABLE, TEST_GUID, TEST_POINT))
+        other.flush(str(tmpdir.join('writer{}.xml'.format(n))), 'C:/temp/project{}.gnp'.format(n))
+
+    writer.info('Other')
+    threads = [threading.Thread(target=work, args=args) for args in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for n in range(4):
+        root = Xml.parse(str(tmpdir.join('writer{}.xml'.format(n)))).getroot()
+        assert root.get('currentproject') == 'project{}.gnp'.format(n)
+        messages = [e.get('message') for e in root.findall('Entry')]
+        assert all(m.startswith('Error {}'.format(n)) for m in messages[:2])
+        assert len(messages) == (3 if n == 0 else 5)
+    assert [e.message for e in writer._entries] == ['Other']
+
+
+def test_serialize_entries():
+    entries = [protocol._Entry(5, 'Info {}'.format(i), '0', shape=TEST_POINT if i % 3 else None) for i in range(10)]
+    results = list(protocol._serialize_entries(iter(entries), 2))
+    assert [e.message for e in results] == [e.message for e in entries]
+    assert [bool(e.geometry) for e in results] == [bool(i % 3) for i in range(10)]
+
+
+def test_entry_to_xml():
+    shape = '{"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}'
+    entry = protocol._Entry(4, 'Error', '0', ('C:\\temp\\test.gdb', 'ele_kabel', 'GlobalID', TEST_GUID), shape=shape)
+    serialized = protocol._Entry(4, 'Error', '0', entry.data_id, shape=shape)
+    serialized.serialize()
+    assert entry.to_xml() == serialized.to_xml()
+    assert entry.to_xml(False) == serialized.to_xml(False)
+    assert Xml.fromstring(entry.to_xml()).find('Object/geometry/Polygon/Ring') is not None
+
+
+def test_writer_clocks(writer, monkeypatch):
+    monkeypatch.setattr(protocol._time, 'time', lambda: 1500000000.75)
+    fine = protocol.ProtocolWriter()
+    fine.set_time_resolution(0.5)
+    fine.info('Fine')
+    writer.info('Coarse')
+    assert float(fine._entries[0].date) > float(writer._entries[0].date)
+    assert writer._clock.resolution == protocol.Logger()._clock.resolution == protocol._CLOCK_RESOLUTION